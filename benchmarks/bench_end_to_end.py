@@ -0,0 +1,202 @@
+# End-to-end benchmark of the whole broker: query_web -> request_ingester_rabbit -> find_did -> state_updater,
+# all in this process, against the in-process broker and db stand-ins. Each tool runs on its own thread
+# with its own connection, just as they would as separate services.
+#
+# Workloads:
+#   new_queries         One client sending queries the broker has never seen (POST /query latency)
+#   repeat_queries      One client re-sending queries that are already done
+#   concurrent_clients  Several clients sending new queries at once
+#   completion          How long new queries take to be done, from the POST to the last file being recorded
+#   file_add_storm      A flood of status_add_file messages through the state updater
+#
+# The results are printed as JSON (latencies in ms, rates per second), along with the commit they were
+# measured at, so runs can be compared across commits.
+#
+# Run from the repo root: python -m benchmarks.bench_end_to_end
+import argparse
+import io
+import json
+import logging
+import pickle
+import subprocess
+import threading
+import time
+from typing import Callable, List, Optional
+from func_adl import EventDataset
+from func_adl_request_broker.db_access import ADLRequestInfo
+from func_adl_request_broker.rpc_client import RabbitRPCClient
+from benchmarks.fake_broker import FakeBroker
+from benchmarks.fake_db import FakeDBAccess
+import tools.query_web as query_web
+import tools.request_ingester_rabbit as request_ingester
+import tools.state_updater as state_updater
+
+
+class Body(io.BytesIO):
+    'What hug hands /query as the body of the POST'
+    def __init__(self, data:bytes):
+        io.BytesIO.__init__(self, data)
+        self.stream = io.BytesIO(data)
+        self.stream_len = len(data)
+
+
+def make_query(i:int) -> bytes:
+    'A pickled query. Queries with different i are different requests.'
+    a = EventDataset('localds://mc16_13TeV.311309.MadGraphPythia8EvtGen_A14NNPDF31LO_HSS_LLP_mH125_mS5_ltlow.deriv.DAOD_EXOT15.e7270_e5984_s3234_r9364_r9315_p3795') \
+        .SelectMany('lambda e: e.Jets("AntiKt4EMTopoJets")') \
+        .Select('lambda j: j.pt()/1000.0') \
+        .AsROOTTTree('output.root', f'tree{i}', 'JetPt') \
+        .value(executor=lambda a: a)
+    return pickle.dumps(a)
+
+
+def percentiles(latencies:List[float]) -> dict:
+    'p50 and p99 (ms) of a list of latencies in seconds'
+    s = sorted(latencies)
+    at = lambda p: s[min(len(s) - 1, int(p * len(s)))] * 1000.0
+    return {'n': len(s), 'p50_ms': at(0.50), 'p99_ms': at(0.99)}
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Pipeline:
+    r'''
+    The broker, running on threads. find_did is played by a stand-in that splits every request into
+    files_per_request jobs, and reports each file straight away.
+    '''
+    def __init__(self, round_trip:float, files_per_request:int, updater_workers:int, coalesce_ms:float = 0):
+        self.broker = FakeBroker(threaded=True)
+        self.db = FakeDBAccess(round_trip=round_trip)
+        self._files_per_request = files_per_request
+        self._connections = []
+
+        self._start(lambda connection, channel: request_ingester.setup_consumers(channel, self.db))
+        self._start(self._setup_find_did)
+        if updater_workers > 1:
+            self._start(lambda connection, channel: state_updater.setup_router(channel, updater_workers))
+            for shard in range(updater_workers):
+                self._start(lambda connection, channel, shard=shard: state_updater.setup_consumers(connection, channel, self.db, shard=shard, coalesce_ms=coalesce_ms))
+        else:
+            self._start(lambda connection, channel: state_updater.setup_consumers(connection, channel, self.db, coalesce_ms=coalesce_ms))
+
+        # query_web, talking to all of that
+        query_web._rpc_client = RabbitRPCClient('localhost', 'user', 'pass', connection_factory=self.broker.connection_factory)
+        query_web._db = self.db
+        query_web.result_cache.clear()
+
+    def _start(self, setup:Callable):
+        'Run a tool on its own thread and connection'
+        connection = self.broker.connection_factory()
+        channel = connection.channel()
+        setup(connection, channel)
+        self._connections.append(connection)
+        threading.Thread(target=channel.start_consuming, daemon=True).start()
+
+    def _setup_find_did(self, connection, channel):
+        channel.queue_declare(queue='find_did')
+
+        def on_request(ch, method, properties, body):
+            hash = properties.headers['hash']
+            ch.basic_publish(exchange='', routing_key='status_number_jobs', body=json.dumps({'hash': hash, 'njobs': self._files_per_request}))
+            ch.basic_publish(exchange='', routing_key='status_change_state', body=json.dumps({'hash': hash, 'phase': 'running'}))
+            for i in range(self._files_per_request):
+                ch.basic_publish(exchange='', routing_key='status_add_file', body=json.dumps({'hash': hash, 'file': f'{hash}_{i}.root', 'treename': 'tree'}))
+            ch.basic_ack(delivery_tag=method.delivery_tag)
+        channel.basic_consume(queue='find_did', on_message_callback=on_request)
+
+    def query(self, data:bytes) -> dict:
+        'POST /query'
+        return query_web.query(Body(data))
+
+    def wait_for(self, test:Callable[[], bool], timeout:float = 120.0):
+        end = time.monotonic() + timeout
+        while not test():
+            if time.monotonic() > end:
+                raise RuntimeError('Timed out waiting for the pipeline')
+            time.sleep(0.001)
+
+    def close(self):
+        query_web._rpc_client.close()
+        query_web._rpc_client = None
+        query_web._db = None
+        for c in self._connections:
+            c.close()
+
+
+def timed(f:Callable) -> float:
+    start = time.perf_counter()
+    f()
+    return time.perf_counter() - start
+
+
+def run(args) -> dict:
+    results = {'commit': git_commit(), 'config': vars(args)}
+    queries = [make_query(i) for i in range(args.n + args.clients * args.n)]
+    p = Pipeline(args.round_trip_ms / 1000.0, args.files_per_request, args.updater_workers, args.coalesce_ms)
+    try:
+        # New queries, one after the other
+        start = time.perf_counter()
+        latencies = [timed(lambda q=q: p.query(q)) for q in queries[:args.n]]
+        results['new_queries'] = dict(percentiles(latencies), per_sec=len(latencies) / sum(latencies))
+
+        # ... and how long until they are all done
+        p.wait_for(lambda: p.db.n_done() >= args.n)
+        elapsed = time.perf_counter() - start
+        n_status = args.n * (args.files_per_request + 2)
+        results['completion'] = {'seconds': elapsed, 'status_msgs_per_sec': n_status / elapsed}
+
+        # Ask for them again - they are all done now
+        latencies = [timed(lambda q=q: p.query(q)) for q in queries[:args.n] * args.repeats]
+        results['repeat_queries'] = dict(percentiles(latencies), per_sec=len(latencies) / sum(latencies))
+
+        # Several clients at once, each with its own new queries
+        latencies = []
+        lock = threading.Lock()
+        def client(c:int):
+            mine = [timed(lambda q=q: p.query(q)) for q in queries[args.n * (c + 1):args.n * (c + 2)]]
+            with lock:
+                latencies.extend(mine)
+        threads = [threading.Thread(target=client, args=(c,)) for c in range(args.clients)]
+        elapsed = timed(lambda: ([t.start() for t in threads], [t.join() for t in threads]))
+        results['concurrent_clients'] = dict(percentiles(latencies), clients=args.clients, per_sec=len(latencies) / elapsed)
+        p.wait_for(lambda: p.db.n_done() >= len(queries))
+
+        # A storm of files for requests that aren't done yet
+        for i in range(args.storm_requests):
+            p.db.store.save_results(f'storm{i}', ADLRequestInfo(done=False, files=[], jobs=args.storm, phase='running', hash=f'storm{i}', message=None, log=None))
+        published = p.broker.published['status_updates']
+        elapsed = timed(lambda: (
+            [p.broker.publish('status_add_file', json.dumps({'hash': f'storm{i % args.storm_requests}', 'file': f'storm_{i}.root', 'treename': 'tree'}), None)
+             for i in range(args.storm)],
+            p.wait_for(lambda: p.broker.published['status_updates'] - published >= args.storm)))
+        results['file_add_storm'] = {'messages': args.storm, 'msgs_per_sec': args.storm / elapsed}
+    finally:
+        p.close()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='End-to-end latency and throughput of the broker')
+    parser.add_argument('-n', type=int, default=100, help='Number of new queries (per client for the concurrent run)')
+    parser.add_argument('--repeats', type=int, default=5, help='Times each done query is sent again')
+    parser.add_argument('--clients', type=int, default=8, help='Number of concurrent clients')
+    parser.add_argument('--files-per-request', type=int, default=10, help='Files find_did makes for each request')
+    parser.add_argument('--storm', type=int, default=5000, help='Number of status_add_file messages in the storm')
+    parser.add_argument('--storm-requests', type=int, default=50, help='Number of requests the storm is spread over')
+    parser.add_argument('--round-trip-ms', type=float, default=0.5, help='Simulated db round trip')
+    parser.add_argument('--updater-workers', type=int, default=1, help='State updater workers (STATE_UPDATER_WORKERS)')
+    parser.add_argument('--coalesce-ms', type=float, default=0, help='State updater status merge window (STATUS_COALESCE_MS)')
+    args = parser.parse_args()
+
+    # The tools log every request - that would swamp the timing.
+    logging.getLogger().setLevel(logging.WARNING)
+    print(json.dumps(run(args)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+# Measure the per-request cost of the /query RPC call against an in-process broker stand-in.
+#
+# Compares opening a fresh connection + reply queue for every request (what query_web used to do)
+# with the long lived RabbitRPCClient.
+#
+# Run from the repo root: python -m benchmarks.bench_rpc_client
+import argparse
+import json
+import time
+import pika
+from func_adl_request_broker.rpc_client import RabbitRPCClient
+from benchmarks.fake_broker import FakeBroker
+
+
+def start_responder(broker:FakeBroker):
+    'Stand in for the ingester: answer every as_request with a canned status'
+    connection = broker.connection_factory()
+    channel = connection.channel()
+    channel.queue_declare(queue='as_request')
+    reply = json.dumps({'files': [], 'phase': 'waiting_for_data', 'done': False, 'jobs': -1, 'log': None, 'message': None})
+
+    def respond(ch, method, properties, body):
+        ch.basic_publish(exchange='', routing_key=properties.reply_to,
+                         properties=pika.BasicProperties(correlation_id=properties.correlation_id),
+                         body=reply)
+        ch.basic_ack(delivery_tag=method.delivery_tag)
+
+    channel.basic_consume(queue='as_request', on_message_callback=respond)
+    return connection
+
+
+def time_per_request(n:int, make_call) -> float:
+    'Return the mean seconds per call'
+    start = time.perf_counter()
+    for _ in range(n):
+        make_call()
+    return (time.perf_counter() - start) / n
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Per-request cost of the /query RPC call')
+    parser.add_argument('-n', type=int, default=500, help='Number of requests to time')
+    parser.add_argument('--connect-latency-ms', type=float, default=2.0, help='Simulated connection open time')
+    parser.add_argument('--method-latency-ms', type=float, default=0.2, help='Simulated synchronous AMQP method round trip')
+    args = parser.parse_args()
+
+    broker = FakeBroker(connect_latency=args.connect_latency_ms/1000.0, method_latency=args.method_latency_ms/1000.0)
+    start_responder(broker)
+    body = b'x' * 1024
+
+    def per_request_call():
+        c = RabbitRPCClient('localhost', 'user', 'pass', connection_factory=broker.connection_factory)
+        c.call(body)
+        c.close()
+
+    pooled = RabbitRPCClient('localhost', 'user', 'pass', connection_factory=broker.connection_factory)
+
+    results = {
+        'per_request_connection_us': time_per_request(args.n, per_request_call) * 1e6,
+        'pooled_client_us': time_per_request(args.n, lambda: pooled.call(body)) * 1e6,
+    }
+    print(json.dumps(results))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,55 @@
+# Measure status_add_file throughput (messages/sec) of the state updater, one write per message
+# against batched writes, using the in-process broker and db stand-ins.
+#
+# Run from the repo root: python -m benchmarks.bench_state_updater
+import argparse
+import json
+import time
+from func_adl_request_broker.db_access import ADLRequestInfo
+from tools.state_updater import setup_consumers
+from benchmarks.fake_broker import FakeBroker
+from benchmarks.fake_db import FakeDBAccess
+
+
+def run(n_messages:int, n_requests:int, round_trip:float, batch_size:int, batch_ms:float) -> float:
+    'Push n_messages file adds through the state updater and return messages/sec'
+    broker = FakeBroker()
+    db = FakeDBAccess(round_trip=round_trip)
+    for i in range(n_requests):
+        db.store.save_results(f'hash{i}', ADLRequestInfo(done=False, files=[], jobs=n_messages, phase='running', hash=f'hash{i}', message=None, log=None))
+
+    connection = broker.connection_factory()
+    channel = connection.channel()
+    setup_consumers(connection, channel, db, batch_size=batch_size, batch_ms=batch_ms)
+
+    for i in range(n_messages):
+        broker.publish('status_add_file', json.dumps({'hash': f'hash{i % n_requests}', 'file': f'file{i}.root', 'treename': 'tree'}), None)
+
+    start = time.perf_counter()
+    while broker.depth('status_add_file') > 0 or len(channel.unacked) > 0:
+        connection.process_data_events(time_limit=0.001)
+    elapsed = time.perf_counter() - start
+
+    assert db.n_files(f'hash{i}' for i in range(n_requests)) == n_messages
+    return n_messages / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='status_add_file throughput of the state updater')
+    parser.add_argument('-n', type=int, default=2000, help='Number of status_add_file messages')
+    parser.add_argument('--requests', type=int, default=10, help='Number of requests the files are spread over')
+    parser.add_argument('--round-trip-ms', type=float, default=0.5, help='Simulated db round trip')
+    parser.add_argument('--batch-size', type=int, default=100, help='Batch size for the batched run')
+    parser.add_argument('--batch-ms', type=float, default=50, help='Longest a message waits for its batch')
+    args = parser.parse_args()
+
+    rt = args.round_trip_ms / 1000.0
+    results = {
+        'per_message_msgs_per_sec': run(args.n, args.requests, rt, 0, args.batch_ms),
+        'batched_msgs_per_sec': run(args.n, args.requests, rt, args.batch_size, args.batch_ms),
+    }
+    print(json.dumps(results))
+
+
+if __name__ == '__main__':
+    main()
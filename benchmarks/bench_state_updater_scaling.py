@@ -0,0 +1,69 @@
+# Measure how the state updater's throughput (messages/sec) grows with the number of workers the
+# updates are spread over (STATE_UPDATER_WORKERS), using the in-process broker and db stand-ins.
+# Every message costs one simulated db round trip, so a single worker is limited by the db latency.
+#
+# Run from the repo root: python -m benchmarks.bench_state_updater_scaling
+import argparse
+import json
+import threading
+import time
+from func_adl_request_broker.db_access import ADLRequestInfo
+from tools.state_updater import STATUS_QUEUES, ShardWorker, setup_consumers, setup_router, shard_queue
+from benchmarks.fake_broker import FakeBroker
+from benchmarks.fake_db import FakeDBAccess
+
+
+def run(n_messages:int, n_requests:int, round_trip:float, workers:int, prefetch:int) -> float:
+    'Push n_messages phase changes and file adds through the state updater and return messages/sec'
+    broker = FakeBroker(threaded=True)
+    db = FakeDBAccess(round_trip=round_trip)
+    for i in range(n_requests):
+        db.store.save_results(f'hash{i}', ADLRequestInfo(done=False, files=[], jobs=n_messages, phase='running', hash=f'hash{i}', message=None, log=None))
+
+    connection = broker.connection_factory()
+    channel = connection.channel()
+    if workers > 1:
+        setup_router(channel, workers)
+        for shard in range(workers):
+            ShardWorker(shard, broker.connection_factory, db, prefetch=prefetch).start()
+        queues = [shard_queue(q, s) for q in STATUS_QUEUES for s in range(workers)] + list(STATUS_QUEUES)
+    else:
+        setup_consumers(connection, channel, db, prefetch=prefetch)
+        queues = list(STATUS_QUEUES)
+
+    for i in range(n_messages):
+        hash = f'hash{i % n_requests}'
+        if i % 2 == 0:
+            broker.publish('status_add_file', json.dumps({'hash': hash, 'file': f'file{i}.root', 'treename': 'tree'}), None)
+        else:
+            broker.publish('status_change_state', json.dumps({'hash': hash, 'phase': f'phase{i}'}), None)
+
+    start = time.perf_counter()
+    pump = threading.Thread(target=channel.start_consuming, daemon=True)
+    pump.start()
+    while sum(broker.depth(q) for q in queues) > 0 or broker.published['status_updates'] < n_messages:
+        time.sleep(0.001)
+    elapsed = time.perf_counter() - start
+
+    broker.consumers.clear()
+    connection.close()
+    assert db.n_files(f'hash{i}' for i in range(n_requests)) == (n_messages + 1) // 2
+    return n_messages / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='State updater throughput against the number of workers')
+    parser.add_argument('-n', type=int, default=2000, help='Number of status messages')
+    parser.add_argument('--requests', type=int, default=100, help='Number of requests the messages are spread over')
+    parser.add_argument('--round-trip-ms', type=float, default=0.5, help='Simulated db round trip')
+    parser.add_argument('--prefetch', type=int, default=20, help='Prefetch limit of each worker')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8], help='Worker counts to measure')
+    args = parser.parse_args()
+
+    results = {f'workers_{w}_msgs_per_sec': run(args.n, args.requests, args.round_trip_ms / 1000.0, w, args.prefetch)
+               for w in args.workers}
+    print(json.dumps(results))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,225 @@
+# An in-process stand-in for a RabbitMQ broker, with just enough of the pika BlockingConnection
+# interface for the broker tools to run against it. Used by the benchmarks.
+#
+# Everything runs in the calling thread - messages are only delivered when someone pumps
+# a connection (process_data_events, start_consuming, etc.). Synchronous AMQP methods (connection
+# open, queue_declare) can be given an artificial latency to model the network round trip.
+import threading
+import time
+from collections import defaultdict, deque
+from itertools import count
+from types import SimpleNamespace
+from typing import Callable, Optional
+import pika
+
+
+class FakeBroker:
+    def __init__(self, connect_latency:float = 0.0, method_latency:float = 0.0, threaded:bool = False):
+        r'''
+        Arguments:
+            connect_latency     Seconds it takes to open a connection (TCP + AMQP handshake)
+            method_latency      Seconds for each synchronous AMQP method round trip (queue_declare, etc.)
+            threaded            If true, each connection only delivers to its own consumers, so every
+                                connection has to be pumped by its own thread. Otherwise pumping any
+                                connection delivers to everyone.
+        '''
+        self.connect_latency = connect_latency
+        self.method_latency = method_latency
+        self.threaded = threaded
+        self.queues = defaultdict(deque)
+        self.consumers = {}
+        self.lock = threading.RLock()
+        self.published = defaultdict(int)
+        self.exchanges = defaultdict(set)
+        self._queue_names = count(1)
+        self._delivery_tags = count(1)
+
+    def connection_factory(self, parameters=None) -> 'FakeConnection':
+        'Drop in replacement for pika.BlockingConnection'
+        return FakeConnection(self)
+
+    def new_queue_name(self) -> str:
+        return f'amq.gen-{next(self._queue_names)}'
+
+    def publish(self, routing_key:str, body:bytes, properties:Optional[pika.BasicProperties], exchange:str = ''):
+        'Put a message on a queue, or on every queue bound to a (fanout) exchange'
+        with self.lock:
+            targets = [routing_key] if exchange == '' else self.exchanges[exchange]
+            for q in targets:
+                self.queues[q].append((properties if properties is not None else pika.BasicProperties(), body))
+            self.published[routing_key if exchange == '' else exchange] += 1
+
+    def deliver(self, connection:Optional['FakeConnection'] = None) -> int:
+        r'''
+        Deliver queued messages to their consumers until nothing more can be delivered (either no messages are
+        left, or the consumers are at their prefetch limit). Returns the number of messages delivered.
+
+        Arguments:
+            connection          Only deliver to consumers on this connection. Consumers are called
+                                in the thread that pumps their connection, and outside the broker lock, so
+                                connections in different threads run in parallel.
+        '''
+        n_delivered = 0
+        while True:
+            ready = []
+            with self.lock:
+                for q_name, (channel, callback, auto_ack) in list(self.consumers.items()):
+                    if connection is not None and channel.connection is not connection:
+                        continue
+                    q = self.queues[q_name]
+                    while len(q) > 0 and channel.is_open and channel.can_take_message(auto_ack):
+                        properties, body = q.popleft()
+                        tag = next(self._delivery_tags)
+                        if not auto_ack:
+                            channel.unacked[tag] = (q_name, properties, body)
+                        method = SimpleNamespace(delivery_tag=tag, routing_key=q_name, redelivered=False)
+                        ready.append((callback, channel, method, properties, body))
+            if len(ready) == 0:
+                return n_delivered
+            for callback, channel, method, properties, body in ready:
+                callback(channel, method, properties, body)
+            n_delivered += len(ready)
+
+    def depth(self, queue:str) -> int:
+        'Number of messages waiting in a queue'
+        return len(self.queues[queue])
+
+
+class FakeChannel:
+    def __init__(self, connection:'FakeConnection'):
+        self.connection = connection
+        self._broker = connection._broker
+        self.unacked = {}
+        self.prefetch_count = 0
+        self.is_open = True
+
+    def can_take_message(self, auto_ack:bool) -> bool:
+        return auto_ack or self.prefetch_count == 0 or len(self.unacked) < self.prefetch_count
+
+    def queue_declare(self, queue:str = '', exclusive:bool = False, **kwargs):
+        time.sleep(self._broker.method_latency)
+        name = queue if queue != '' else self._broker.new_queue_name()
+        with self._broker.lock:
+            q = self._broker.queues[name]
+        if exclusive:
+            self.connection._exclusive_queues.append(name)
+        return SimpleNamespace(method=SimpleNamespace(queue=name, message_count=len(q)))
+
+    def exchange_declare(self, exchange:str, exchange_type:str = 'direct', **kwargs):
+        time.sleep(self._broker.method_latency)
+        with self._broker.lock:
+            self._broker.exchanges[exchange]
+
+    def queue_bind(self, queue:str, exchange:str, routing_key:Optional[str] = None, **kwargs):
+        time.sleep(self._broker.method_latency)
+        with self._broker.lock:
+            self._broker.exchanges[exchange].add(queue)
+
+    def basic_qos(self, prefetch_count:int = 0, **kwargs):
+        time.sleep(self._broker.method_latency)
+        self.prefetch_count = prefetch_count
+
+    def basic_consume(self, queue:str, on_message_callback:Callable, auto_ack:bool = False, **kwargs):
+        time.sleep(self._broker.method_latency)
+        with self._broker.lock:
+            self._broker.consumers[queue] = (self, on_message_callback, auto_ack)
+
+    def basic_publish(self, exchange:str, routing_key:str, body:bytes, properties:Optional[pika.BasicProperties] = None, **kwargs):
+        self._broker.publish(routing_key, body, properties, exchange)
+
+    def basic_ack(self, delivery_tag:int = 0, multiple:bool = False):
+        if multiple:
+            for t in [t for t in self.unacked if t <= delivery_tag]:
+                del self.unacked[t]
+        else:
+            del self.unacked[delivery_tag]
+
+    def basic_nack(self, delivery_tag:int = 0, multiple:bool = False, requeue:bool = True):
+        tags = [t for t in self.unacked if t <= delivery_tag] if multiple else [delivery_tag]
+        for t in tags:
+            q_name, properties, body = self.unacked.pop(t)
+            if requeue:
+                with self._broker.lock:
+                    self._broker.queues[q_name].append((properties, body))
+
+    def start_consuming(self):
+        'Keep delivering until the connection is closed'
+        while self.is_open and self.connection.is_open:
+            self.connection.process_data_events(time_limit=0.01)
+
+    def stop_consuming(self):
+        self.is_open = False
+
+    def close(self):
+        self.is_open = False
+
+
+class FakeConnection:
+    def __init__(self, broker:FakeBroker):
+        time.sleep(broker.connect_latency)
+        self._broker = broker
+        self._exclusive_queues = []
+        self._timers = []
+        self._timer_ids = count(1)
+        self._channels = []
+        self.is_open = True
+
+    def channel(self) -> FakeChannel:
+        time.sleep(self._broker.method_latency)
+        c = FakeChannel(self)
+        self._channels.append(c)
+        return c
+
+    def call_later(self, delay:float, callback:Callable) -> int:
+        timer_id = next(self._timer_ids)
+        self._timers.append((time.monotonic() + delay, timer_id, callback))
+        return timer_id
+
+    def remove_timeout(self, timer_id:int):
+        self._timers = [t for t in self._timers if t[1] != timer_id]
+
+    def add_callback_threadsafe(self, callback:Callable):
+        self.call_later(0, callback)
+
+    def _run_timers(self) -> int:
+        now = time.monotonic()
+        due = [t for t in self._timers if t[0] <= now]
+        self._timers = [t for t in self._timers if t[0] > now]
+        for _, _, callback in sorted(due, key=lambda t: t[0]):
+            callback()
+        return len(due)
+
+    def _deliver(self) -> int:
+        return self._broker.deliver(self if self._broker.threaded else None)
+
+    def process_data_events(self, time_limit:Optional[float] = 0):
+        'Deliver whatever is waiting. If there is nothing, idle briefly (never longer than the time limit) and try again.'
+        n = self._deliver() + self._run_timers()
+        if n == 0 and time_limit:
+            wait = time_limit
+            if len(self._timers) > 0:
+                wait = max(0.0, min(wait, min(t[0] for t in self._timers) - time.monotonic()))
+            time.sleep(min(wait, 0.001))
+            self._deliver()
+            self._run_timers()
+
+    def sleep(self, duration:float):
+        time.sleep(duration)
+        self.process_data_events()
+
+    def close(self):
+        self.is_open = False
+        for c in self._channels:
+            c.is_open = False
+        with self._broker.lock:
+            for q in self._exclusive_queues:
+                self._broker.queues.pop(q, None)
+                for bound in self._broker.exchanges.values():
+                    bound.discard(q)
+            for q in [q for q, (ch, _, _) in self._broker.consumers.items() if ch.connection is self]:
+                del self._broker.consumers[q]
+            # Anything in flight goes back on the queue, as it would with a real broker
+            for c in self._channels:
+                for q_name, properties, body in c.unacked.values():
+                    self._broker.queues[q_name].appendleft((properties, body))
+                c.unacked.clear()
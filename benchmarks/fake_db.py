@@ -0,0 +1,57 @@
+# A stand-in for a remote request store (MongoDB), for the benchmarks: the in-process MemoryDBAccess, with
+# every call made to it counted as a round trip to the db server, which can be given an artificial latency.
+import threading
+import time
+from typing import Iterable, Iterator, Optional
+from func_adl_request_broker.db_access import MAX_LIST_PAGE
+from func_adl_request_broker.memory_db_access import MemoryDBAccess
+
+# Calls that take more than one round trip against MongoDB (a find, then the inserts).
+_ROUND_TRIPS = {'claim_requests': 2}
+
+
+class FakeDBAccess:
+    r'''
+    Wraps a MemoryDBAccess and counts, and delays, every call made to it, by method name. Look at the
+    requests with the helpers below (or through store) so the benchmark's own checks aren't counted.
+    '''
+    def __init__(self, round_trip:float = 0.0, store:Optional[MemoryDBAccess] = None):
+        r'''
+        Arguments:
+            round_trip          Seconds each call to the db takes
+            store               The requests. None starts with an empty MemoryDBAccess.
+        '''
+        self.store = store if store is not None else MemoryDBAccess()
+        self.round_trip = round_trip
+        self.round_trips = 0
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name:str):
+        attr = getattr(self.store, name)
+        if name.startswith('_') or not callable(attr):
+            return attr
+
+        def remote(*args, **kwargs):
+            trips = _ROUND_TRIPS.get(name, 1)
+            with self._lock:
+                self.round_trips += trips
+            time.sleep(self.round_trip * trips)
+            return attr(*args, **kwargs)
+        return remote
+
+    def _requests(self) -> Iterator[dict]:
+        'Every request, newest first, as list_requests gives them'
+        cursor = None
+        while True:
+            page, cursor = self.store.list_requests(cursor=cursor, limit=MAX_LIST_PAGE)
+            yield from page
+            if cursor is None:
+                return
+
+    def n_done(self) -> int:
+        'The number of requests that are done'
+        return sum(1 for r in self._requests() if r['done'])
+
+    def n_files(self, hashes:Iterable[str]) -> int:
+        'The number of files recorded for the requests'
+        return sum(len(self.store.lookup_results(h).files) for h in hashes)
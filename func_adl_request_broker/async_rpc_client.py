@@ -0,0 +1,93 @@
+# asyncio RPC client for talking to the request ingester over RabbitMQ.
+import asyncio
+import time
+import uuid
+import logging
+from typing import Dict, Optional
+import aio_pika
+from func_adl_request_broker.rpc_client import RPCTimeout
+from func_adl_request_broker.metrics import MESSAGES_PUBLISHED, RPC_CONNECT_SECONDS, SENT_AT_HEADER
+
+
+class AsyncRabbitRPCClient:
+    r'''
+    asyncio version of RabbitRPCClient. One robust connection (it reconnects on its own) and one reply
+    queue are shared by every request made on the event loop. Each request waits on a future that is
+    completed when the reply with its correlation id arrives, so any number of requests can be in flight
+    at once without tying up a thread.
+    '''
+    def __init__(self, host:str, user:str, password:str, request_queue:str = 'as_request'):
+        r'''
+        Create the client. Call connect before making any requests.
+
+        Arguments:
+            host                The RabbitMQ node address
+            user                Username for the RabbitMQ node
+            password            Password for the RabbitMQ node
+            request_queue       The queue that requests are sent to
+        '''
+        self._host = host
+        self._user = user
+        self._password = password
+        self._request_queue = request_queue
+        self._connection = None
+        self._channel = None
+        self._callback_queue = None
+        self._pending: Dict[str, asyncio.Future] = {}
+
+    async def connect(self):
+        'Open the connection, declare the request queue and our reply queue'
+        logging.info("Opening connection to RabbitMQ")
+        with RPC_CONNECT_SECONDS.time():
+            self._connection = await aio_pika.connect_robust(host=self._host, login=self._user, password=self._password)
+            self._channel = await self._connection.channel()
+            await self._channel.declare_queue(self._request_queue)
+
+            # Name the reply queue ourselves so it can be re-declared under the same name when the
+            # robust connection reconnects.
+            self._callback_queue = await self._channel.declare_queue(f'query_web.reply.{uuid.uuid4()}', exclusive=True)
+            await self._callback_queue.consume(self._on_response, no_ack=True)
+
+    async def close(self):
+        'Close down the connection'
+        if self._connection is not None:
+            await self._connection.close()
+            self._connection = None
+
+    async def _on_response(self, message:aio_pika.abc.AbstractIncomingMessage):
+        'A reply has come back. Hand it to whoever is waiting for it. Replies nobody is waiting for are dropped.'
+        future = self._pending.get(message.correlation_id)
+        if future is not None and not future.done():
+            future.set_result(message.body)
+
+    async def call(self, body:bytes, timeout:Optional[float] = None, headers:Optional[dict] = None,
+                   correlation_id:Optional[str] = None) -> bytes:
+        r'''
+        Send a request and wait for the reply.
+
+        Arguments:
+            body                The body of the request message
+            timeout             Seconds to wait for the reply. None means wait forever.
+            headers             AMQP headers to send along with the request. The time it was sent is added.
+            correlation_id      The (unique) correlation id of the request. A new one is made if not given.
+
+        Returns:
+            The body of the reply message
+
+        Exceptions:
+            RPCTimeout          The reply did not arrive within the timeout
+        '''
+        corr_id = correlation_id if correlation_id is not None else str(uuid.uuid4())
+        future = asyncio.get_running_loop().create_future()
+        self._pending[corr_id] = future
+        try:
+            await self._channel.default_exchange.publish(
+                aio_pika.Message(body=body, correlation_id=corr_id, reply_to=self._callback_queue.name,
+                                 headers=dict(headers or {}, **{SENT_AT_HEADER: time.time()})),
+                routing_key=self._request_queue)
+            MESSAGES_PUBLISHED.inc(queue=self._request_queue)
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            raise RPCTimeout(f'No reply after waiting for the request {corr_id}')
+        finally:
+            del self._pending[corr_id]
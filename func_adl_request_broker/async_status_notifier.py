@@ -0,0 +1,67 @@
+# asyncio version of the status change fan out in status_notifier, for the query_web_async front end: the
+# events are read off the status exchange on the event loop and handed to the coroutines waiting on them.
+import asyncio
+import json
+import logging
+from typing import Dict, List
+import aio_pika
+from func_adl_request_broker.status_notifier import STATUS_EXCHANGE
+
+
+class AsyncStatusNotifier:
+    r'''
+    StatusNotifier for coroutines. Each waiter subscribes to a request hash and gets an asyncio queue the
+    events for that hash are put on. Everything runs on the one event loop, so there is no locking.
+    '''
+    def __init__(self):
+        self._subscribers: Dict[str, List[asyncio.Queue]] = {}
+
+    def subscribe(self, hash:str) -> asyncio.Queue:
+        'Start collecting the events for a request'
+        q = asyncio.Queue()
+        self._subscribers.setdefault(hash, []).append(q)
+        return q
+
+    def unsubscribe(self, hash:str, q:asyncio.Queue):
+        'Stop collecting events'
+        subs = self._subscribers.get(hash, [])
+        if q in subs:
+            subs.remove(q)
+        if len(subs) == 0:
+            self._subscribers.pop(hash, None)
+
+    def notify(self, event:dict):
+        'Pass an event to everyone waiting on its request'
+        for q in self._subscribers.get(event['hash'], []):
+            q.put_nowait(event)
+
+
+class AsyncRabbitStatusListener:
+    r'''
+    Listens to the status exchange and passes every event to an AsyncStatusNotifier. The connection is a
+    robust one, so it reconnects (and re-binds its queue) on its own.
+    '''
+    def __init__(self, notifier:AsyncStatusNotifier):
+        self._notifier = notifier
+        self._connection = None
+
+    async def connect(self, host:str, user:str, password:str):
+        'Connect, and start passing on events'
+        self._connection = await aio_pika.connect_robust(host=host, login=user, password=password)
+        channel = await self._connection.channel()
+        exchange = await channel.declare_exchange(STATUS_EXCHANGE, aio_pika.ExchangeType.FANOUT)
+        q = await channel.declare_queue(exclusive=True)
+        await q.bind(exchange)
+        await q.consume(self._on_event, no_ack=True)
+
+    async def _on_event(self, message:aio_pika.abc.AbstractIncomingMessage):
+        try:
+            self._notifier.notify(json.loads(message.body))
+        except (ValueError, KeyError, TypeError) as e:
+            logging.warning(f'Ignoring a malformed status event ({e}): {message.body[:200]!r}')
+
+    async def close(self):
+        'Close down the connection'
+        if self._connection is not None:
+            await self._connection.close()
+            self._connection = None
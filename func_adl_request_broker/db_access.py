@@ -1,11 +1,66 @@
 # Test out db access
+import abc
 import ast
+import hashlib
+import json
+import logging
+import math
+import os
+import sqlite3
+import threading
+import time
 from collections import namedtuple
-from typing import Optional, Union
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Iterable, List, Optional, Tuple, Union
+import bson
 import pymongo
+import gridfs
 from func_adl.xAOD.backend.ast.ast_hash import calc_ast_hash
 
-ADLRequestInfo = namedtuple('ADLRequestInfo', 'done files jobs phase hash message log')
+# A request's record. Fields that were not loaded from the db (see lookup_results) are None.
+# For a crashed request, log is a short excerpt and log_ref refers to the full log (see open_log).
+ADLRequestInfo = namedtuple('ADLRequestInfo', 'done files jobs phase hash message log log_ref', defaults=(None,)*8)
+
+# The fields needed to report a request's status - everything but the (potentially large) file list and log.
+STATUS_FIELDS = ('done', 'jobs', 'phase', 'hash', 'message', 'log_ref')
+
+# Largest page of files lookup_results will slice out of a file list when no max is given
+_MAX_FILES_PAGE = 2**31 - 1
+
+# Errors from the db that mean an update didn't happen, but might if it is tried again
+DB_ERRORS = (pymongo.errors.PyMongoError, sqlite3.Error)
+
+# How many lines from the end of a crash log are kept with the request
+LOG_EXCERPT_LINES = 20
+
+# How long (seconds) requests are kept in FuncADLDBAccess. None leaves it as the db was set up (by whichever
+# process last set it), and KEEP_FOREVER turns expiry off.
+#   done            Done requests, from the last time anyone looked them up
+#   crashed         Crashed requests (and their logs), from when they crashed
+#   unfinished      Requests that never finished, from when they were created
+#   touch_interval  How often lookups are written back as last access times
+Retention = namedtuple('Retention', 'done crashed unfinished touch_interval', defaults=(None, None, None, 60.0))
+
+# A retention time that keeps requests forever
+KEEP_FOREVER = math.inf
+
+# Most requests list_requests returns at once
+MAX_LIST_PAGE = 500
+
+def retention_from_env() -> Retention:
+    r'''
+    The retention policy from RETAIN_DONE_SECONDS, RETAIN_CRASHED_SECONDS, RETAIN_UNFINISHED_SECONDS and
+    RETAIN_TOUCH_INTERVAL (seconds, default 60). A retention of "forever" keeps those requests forever; unset
+    leaves the db as it is, so only the service (or admin job) configured with them has to have them.
+    '''
+    def ttl(name:str) -> Optional[float]:
+        value = os.environ.get(name, '').strip()
+        if value == '':
+            return None
+        return KEEP_FOREVER if value.lower() == 'forever' else float(value)
+    return Retention(done=ttl('RETAIN_DONE_SECONDS'), crashed=ttl('RETAIN_CRASHED_SECONDS'),
+                     unfinished=ttl('RETAIN_UNFINISHED_SECONDS'),
+                     touch_interval=float(os.environ.get('RETAIN_TOUCH_INTERVAL', '60')))
 
 def hash_from_arg (arg:Union[ast.AST, str]):
     'Return the hash from the arg. If it is a string, then it is the hash. Otherwise it is an ast to be hashed.'
@@ -14,35 +69,379 @@ def hash_from_arg (arg:Union[ast.AST, str]):
     return calc_ast_hash(arg)    
 
 def obj_from_dict (r:dict) -> ADLRequestInfo:
-    return ADLRequestInfo(done=r['done'],
-                files=r['files'],
-                jobs=r['jobs'],
-                phase=r['phase'],
-                hash=r['hash'],
-                message=r['message'] if 'message' in r else None,
-                log=r['log'] if 'log' in r else None)
-
-class FuncADLDBAccess:
-    def __init__ (self, db_server):
+    return ADLRequestInfo(done=r.get('done'),
+                files=r.get('files'),
+                jobs=r.get('jobs'),
+                phase=r.get('phase'),
+                hash=r.get('hash'),
+                message=r.get('message'),
+                log=r.get('log'),
+                log_ref=r.get('log_ref'))
+
+def file_key (entry) -> str:
+    r'''
+    The key a file list entry is stored under in a request's file_index. Field names can't have '.'s in them,
+    which file names will, so it is a hash of the entry.
+    '''
+    return hashlib.sha1(json.dumps(list(entry) if isinstance(entry, tuple) else entry).encode('utf-8')).hexdigest()
+
+def dict_from_obj (hash:str, results:ADLRequestInfo) -> dict:
+    r'''
+    Build the db document for a request. Along with the file list, which is kept in the order files arrive
+    in, there is file_index, with a key for each file in the list (see file_key), so a file can be checked
+    for and added without reading or rewriting the list.
+    '''
+    d = {
+        'done': results.done,
+        'files': results.files,
+        'file_index': {file_key(f): True for f in (results.files or [])},
+        'jobs': results.jobs,
+        'phase': results.phase,
+        'hash': hash
+    }
+    if results.log:
+        d['log'] = results.log
+    if results.message:
+        d['message'] = results.message
+    if results.log_ref:
+        d['log_ref'] = results.log_ref
+    return d
+
+def log_text (log) -> str:
+    'The crash log as a single string - it can come in as a list of lines'
+    if log is None:
+        return ''
+    if isinstance(log, (list, tuple)):
+        return '\n'.join(str(l) for l in log)
+    return str(log)
+
+def log_excerpt (text:str, n_lines:int = LOG_EXCERPT_LINES) -> str:
+    'The last n_lines of a log'
+    lines = text.splitlines()
+    if len(lines) <= n_lines:
+        return text
+    return '\n'.join(['...'] + lines[-n_lines:])
+
+# Update pipeline stage that marks a request done once all its files are in. The number of jobs is -1 until
+# it is known, and we can't be done before then. A request saved without a file list has no files yet
+# ($size fails on a missing or null list).
+_update_done_stage = {'$set': {'done': {'$or': ['$done', {'$and': [
+    {'$gte': ['$jobs', 0]},
+    {'$gte': [{'$size': {'$ifNull': ['$files', []]}}, '$jobs']}
+]}]}}}
+
+def _utcnow() -> datetime:
+    return datetime.now(timezone.utc)
+
+def _age_cutoff(seconds:float) -> datetime:
+    'The time seconds ago'
+    return _utcnow() - timedelta(seconds=seconds)
+
+def _add_file_op(hash:str, entry:Tuple[str,str]) -> pymongo.UpdateOne:
+    'Append (file, treename) to the request\'s file list if it is not already in its file_index'
+    key = f'file_index.{file_key(list(entry))}'
+    return pymongo.UpdateOne({'hash': hash, key: {'$exists': False}}, {'$push': {'files': list(entry)}, '$set': {key: True}})
+
+class DBAccess(abc.ABC):
+    r'''
+    Where the requests are stored. FuncADLDBAccess (MongoDB) documents what each method does in detail. MemoryDBAccess
+    and SQLiteDBAccess do the same for requests held in this process or in a local SQLite file. Use open_db
+    to pick one by URL.
+
+    Every update is atomic, so any number of ingesters, updaters and web front ends can share a store
+    (as long as it is not in memory).
+    '''
+    @abc.abstractmethod
+    def lookup_results(self, arg:Union[str,ast.AST], fields:Optional[Iterable[str]] = None,
+                       files_from:int = 0, max_files:Optional[int] = None) -> Optional[ADLRequestInfo]:
+        r'''
+        Look up a request.
+
+        Arguments:
+            arg             The hash of the AST (or the AST itself)
+            fields          If given, only these fields are loaded (the hash always is). The rest are None.
+            files_from      Skip this many files at the start of the file list
+            max_files       If given, load at most this many files
+
+        Returns:
+            The request, or None if it isn't there.
+        '''
+
+    @abc.abstractmethod
+    def save_results(self, arg:str, results:ADLRequestInfo) -> ADLRequestInfo:
+        'Store a request under the hash, replacing whatever was there, and return what was stored'
+
+    @abc.abstractmethod
+    def claim_request(self, arg:Union[str,ast.AST], results:ADLRequestInfo,
+                      files_from:int = 0, max_files:Optional[int] = None) -> Tuple[ADLRequestInfo, bool]:
+        r'''
+        Look up a request, creating it from results if it isn't there, atomically.
+
+        Arguments:
+            arg             The hash of the AST (or the AST itself)
+            results         What to store if the request is new
+            files_from      Skip this many files of a request that is already there
+            max_files       If given, return at most this many files of a request that is already there
+
+        Returns:
+            (request, created) created is True for exactly one of any number of callers claiming the
+                               same new request at once.
+        '''
+
+    @abc.abstractmethod
+    def claim_requests(self, args:List[Union[str,ast.AST]], results:ADLRequestInfo) -> List[Tuple[ADLRequestInfo, bool]]:
+        'claim_request for many requests (with no duplicates) at once. Returns (request, created) for each, in order.'
+
+    @abc.abstractmethod
+    def add_files(self, files:Dict[str, List[Tuple[str,str]]]) -> int:
+        r'''
+        add_file for many requests at once.
+
+        Arguments:
+            files           Dictionary of request hash to the list of (file, treename) to add to it
+
+        Returns:
+            The number of requests that were found.
+        '''
+
+    @abc.abstractmethod
+    def set_phase(self, arg:Union[str,ast.AST], phase:str) -> bool:
+        'Set the phase of a request. Returns True if the request was found.'
+
+    @abc.abstractmethod
+    def set_jobs(self, arg:Union[str,ast.AST], njobs:int) -> bool:
+        'Set the number of jobs of a request, marking it done if that many files are in. Returns True if the request was found.'
+
+    @abc.abstractmethod
+    def mark_crashed(self, arg:Union[str,ast.AST], message:str, log, phase:Optional[str] = None, njobs:Optional[int] = None) -> bool:
+        r'''
+        Mark a request done because it crashed.
+
+        Arguments:
+            arg             The hash of the AST (or the AST itself)
+            message         Message describing the crash
+            log             The log from the crash (a string or list of lines). The request keeps the last
+                            few lines, and the full log can be read back with open_log.
+            phase           If given, set the phase in the same write
+            njobs           If given, set the number of jobs in the same write
+
+        Returns:
+            True if the request was found, False otherwise.
+        '''
+
+    @abc.abstractmethod
+    def open_log(self, arg:Union[str,ast.AST]):
+        'The full crash log of a request, as a binary file-like object of utf-8 text, or None if there is none'
+
+    @abc.abstractmethod
+    def list_requests(self, phase:Optional[str] = None, min_age:Optional[float] = None, max_age:Optional[float] = None,
+                      cursor:Optional[str] = None, limit:int = 50) -> Tuple[List[dict], Optional[str]]:
+        r'''
+        List requests, newest first, a page at a time.
+
+        Arguments:
+            phase           Only requests in this phase
+            min_age         Only requests created at least this many seconds ago
+            max_age         Only requests created at most this many seconds ago
+            cursor          Where the page starts - the next_cursor of the last page, or None for the first
+            limit           Most requests to return (at most MAX_LIST_PAGE)
+
+        Returns:
+            (requests, next_cursor) next_cursor is None on the last page.
+        '''
+
+    def lookup_status(self, arg:Union[str,ast.AST]) -> Optional[ADLRequestInfo]:
+        'Look up a request without loading its file list or log (which come back as None)'
+        return self.lookup_results(arg, fields=STATUS_FIELDS)
+
+    def add_file(self, arg:Union[str,ast.AST], file_ref:str, treename:str) -> bool:
+        r'''
+        Add a file to the list of files for a request, and mark the request as done if this was the last
+        file we were waiting for.
+
+        Arguments:
+            arg             The hash of the AST (or the AST itself)
+            file_ref        The file that is ready
+            treename        The tree in the file
+
+        Returns:
+            True if the request was found, False otherwise.
+
+        Notes:
+            A file that is already in the list is not added again, and the order files are added in
+            is kept.
+        '''
+        return self.add_files({hash_from_arg(arg): [(file_ref, treename)]}) > 0
+
+    def update_status(self, arg:Union[str,ast.AST], phase:Optional[str] = None, njobs:Optional[int] = None) -> bool:
+        r'''
+        Set the phase and/or number of jobs of a request at once (see set_phase and set_jobs).
+
+        Arguments:
+            arg             The hash of the AST (or the AST itself)
+            phase           The new phase, or None to leave it as it is
+            njobs           The number of jobs, or None to leave it as it is
+
+        Returns:
+            True if the request was found, False otherwise.
+        '''
+        found = True
+        if njobs is not None:
+            found = self.set_jobs(arg, njobs)
+        if phase is not None and found:
+            found = self.set_phase(arg, phase)
+        return found
+
+class FuncADLDBAccess(DBAccess):
+    def __init__ (self, db_server, retention:Optional[Retention] = None):
+        r'''
+        Arguments:
+            db_server       The MongoDB URL
+            retention       How long to keep requests. None reads it from the environment (see retention_from_env).
+
+        Notes:
+            Old requests are removed by MongoDB itself, with TTL indexes: done requests on their last_access
+            time, crashed requests on crashed_at, and unfinished ones on created. The indexes are shared by
+            everything using the db, so they are only changed for the parts of the retention given - the
+            rest are left as they are - and this process follows whatever the db ends up with. A lookup doesn't write
+            last_access itself - the hashes looked up are collected and written in one update every
+            touch_interval seconds by a background thread, so lookups cost no more than they did. Requests
+            saved before retention was turned on have none of these times, and are kept.
+        '''
         self._client = pymongo.MongoClient(db_server)
         self._db = self._client.adl_queries
         self._query_collection = self._db.query_collection
+        self._retention = retention if retention is not None else retention_from_env()
+
+        # Each request must be stored only once - this is what makes claim_request safe. The others are
+        # for listing requests by their state (_id is in order of creation, see list_requests).
+        self._unique_hash_index()
+        self._query_collection.create_index('done')
+        self._query_collection.create_index([('phase', pymongo.ASCENDING), ('_id', pymongo.DESCENDING)])
 
-    def lookup_results(self, arg:Union[str,ast.AST]) -> Optional[ADLRequestInfo]:
+        # Crash logs can be large, so they are kept out of the request documents, one file per request hash.
+        self._logs = gridfs.GridFS(self._db, collection='crash_logs')
+
+        # The retention actually in force
+        self._ttl = Retention(done=self._ttl_index('expire_done', 'last_access', self._retention.done, {'done': True, 'crashed': False}),
+                              crashed=self._ttl_index('expire_crashed', 'crashed_at', self._retention.crashed),
+                              unfinished=self._ttl_index('expire_unfinished', 'created', self._retention.unfinished, {'done': False}),
+                              touch_interval=self._retention.touch_interval)
+
+        self._touched = set()
+        self._touch_lock = threading.Lock()
+        if any(ttl is not None for ttl in self._ttl[:3]):
+            threading.Thread(target=self._housekeeping, name='db-housekeeping', daemon=True).start()
+
+    def _unique_hash_index(self):
+        r'''
+        Create the unique index on hash. Before it, two clients sending the same new query at once could
+        both store it - any copies like that are deleted first, keeping the oldest (the one updates went to).
+        '''
+        try:
+            self._query_collection.create_index('hash', unique=True)
+            return
+        except pymongo.errors.OperationFailure as e:
+            if e.code != 11000:
+                raise
+        copies = self._query_collection.aggregate([
+            {'$group': {'_id': '$hash', 'ids': {'$push': '$_id'}, 'n': {'$sum': 1}}},
+            {'$match': {'n': {'$gt': 1}}}])
+        extra = [i for c in copies for i in sorted(c['ids'])[1:]]
+        logging.warning(f'Deleting {len(extra)} copies of requests that were stored more than once, so hash can be a unique index.')
+        self._query_collection.delete_many({'_id': {'$in': extra}})
+        self._query_collection.create_index('hash', unique=True)
+
+    def _ttl_index(self, name:str, field:str, ttl:Optional[float], partial:Optional[dict] = None) -> Optional[float]:
+        r'''
+        Create, change or drop a TTL index so it matches a retention time, and return the time the db now has
+        (None if it keeps them forever). A ttl of None leaves the index as it is.
+        '''
+        existing = self._query_collection.index_information().get(name)
+        if ttl is None:
+            return None if existing is None else existing.get('expireAfterSeconds')
+        if ttl == KEEP_FOREVER:
+            if existing is not None:
+                logging.warning(f'Turning off {name} - those requests are now kept forever.')
+                self._query_collection.drop_index(name)
+            return None
+        if existing is None:
+            options = {} if partial is None else {'partialFilterExpression': partial}
+            self._query_collection.create_index(field, name=name, expireAfterSeconds=int(ttl), **options)
+        elif existing.get('expireAfterSeconds') != int(ttl):
+            logging.warning(f'Changing {name} from {existing.get("expireAfterSeconds")} to {int(ttl)} seconds.')
+            self._db.command('collMod', self._query_collection.name, index={'name': name, 'expireAfterSeconds': int(ttl)})
+        return int(ttl)
+
+    def _new_times(self) -> dict:
+        'The times a new request document starts with'
+        now = _utcnow()
+        return {'created': now, 'last_access': now, 'crashed': False}
+
+    def _touch(self, hashes:Iterable[str]):
+        'Note that requests were looked up - they are written at the next flush_touches'
+        if self._ttl.done is not None:
+            with self._touch_lock:
+                self._touched.update(hashes)
+
+    def flush_touches(self) -> int:
+        'Write the last access time of the requests looked up since the last flush, and return how many there were'
+        with self._touch_lock:
+            touched, self._touched = self._touched, set()
+        if len(touched) > 0:
+            self._query_collection.update_many({'hash': {'$in': list(touched)}}, {'$set': {'last_access': _utcnow()}})
+        return len(touched)
+
+    def expire_logs(self) -> int:
+        'Delete the crash logs older than the crashed request retention, and return how many there were'
+        if self._ttl.crashed is None:
+            return 0
+        old = [f._id for f in self._logs.find({'uploadDate': {'$lt': _age_cutoff(self._ttl.crashed)}})]
+        for log_id in old:
+            self._logs.delete(log_id)
+        return len(old)
+
+    def _housekeeping(self):
+        'Flush the touches every touch_interval, and remove old crash logs (which TTL indexes can\'t) about every hour'
+        last_log_purge = 0.0
+        while True:
+            time.sleep(self._ttl.touch_interval)
+            try:
+                self.flush_touches()
+                if time.monotonic() - last_log_purge > 3600:
+                    self.expire_logs()
+                    last_log_purge = time.monotonic()
+            except pymongo.errors.PyMongoError as e:
+                logging.warning(f'Unable to update request retention ({e}).')
+
+    def lookup_results(self, arg:Union[str,ast.AST], fields:Optional[Iterable[str]] = None,
+                       files_from:int = 0, max_files:Optional[int] = None) -> Optional[ADLRequestInfo]:
         r'''
         Look up the ast hash in the database to see if this query has been requested already. Return its info if it has, otherwise
         return none.
 
         Arguments:
             arg                   The AST that we are going to do the lookup for
+            fields                If given, only these fields of ADLRequestInfo are loaded (the hash always is). The
+                                  rest are None.
+            files_from            Skip this many files at the start of the file list
+            max_files             If given, load at most this many files. Files only ever get added to the end of
+                                  the list, so a client can page through it, or pick up just the new ones, by
+                                  starting from the number it has already seen.
 
         Returns:
             None                Nothing was found in the DB
             (done, [file])      A list of associated files. Done is true if the query has been processed, otherwise it is marked
                                 as in progress.
         '''
-        r = self._query_collection.find_one({'hash': hash_from_arg(arg)})
-        return None if r is None else obj_from_dict(r)
+        projection = {'file_index': 0} if fields is None else dict({f: 1 for f in fields}, hash=1, _id=0)
+        if (files_from > 0 or max_files is not None) and (fields is None or 'files' in fields):
+            projection['files'] = {'$slice': [files_from, max_files if max_files is not None else _MAX_FILES_PAGE]}
+        r = self._query_collection.find_one({'hash': hash_from_arg(arg)}, projection)
+        if r is None:
+            return None
+        self._touch([r['hash']])
+        return obj_from_dict(r)
 
     def save_results(self, arg:str, results:ADLRequestInfo) -> ADLRequestInfo:
         '''
@@ -53,17 +452,267 @@ class FuncADLDBAccess:
             results         The results that are to be stored in the db.
         '''
         hash = hash_from_arg(arg)
-        d = {
-            'done': results.done,
-            'files': results.files,
-            'jobs': results.jobs,
-            'phase': results.phase,
-            'hash': hash
-        }
-        if results.log:
-            d['log'] = results.log
-        if results.message:
-            d['message'] = results.message
-
-        self._query_collection.update({'hash': hash}, d, upsert=True)
-        return obj_from_dict(d)
\ No newline at end of file
+        d = dict_from_obj(hash, results)
+        self._query_collection.replace_one({'hash': hash}, dict(d, **self._new_times()), upsert=True)
+        return obj_from_dict(d)
+
+    def claim_request(self, arg:Union[str,ast.AST], results:ADLRequestInfo,
+                      files_from:int = 0, max_files:Optional[int] = None) -> Tuple[ADLRequestInfo, bool]:
+        r'''
+        Look up a request, creating it if it isn't there, in a single atomic operation. If many callers try
+        to claim the same new request at once, exactly one of them will be told it created it.
+
+        Arguments:
+            arg             The hash of the AST (or the AST itself)
+            results         What to store if the request is new
+            files_from      Load the file list of a request that is already there from this file on
+            max_files       ... and at most this many of them (see lookup_results)
+
+        Returns:
+            (info, created) The request as it is in the db, and True if this call created it.
+        '''
+        hash = hash_from_arg(arg)
+        d = dict_from_obj(hash, results)
+        new_fields = dict({k: v for k, v in d.items() if k != 'hash'}, **self._new_times())
+        projection = {'file_index': 0}
+        if files_from > 0 or max_files is not None:
+            projection['files'] = {'$slice': [files_from, max_files if max_files is not None else _MAX_FILES_PAGE]}
+        try:
+            r = self._query_collection.find_one_and_update({'hash': hash}, {'$setOnInsert': new_fields}, projection=projection,
+                                                           upsert=True, return_document=pymongo.ReturnDocument.BEFORE)
+        except pymongo.errors.DuplicateKeyError:
+            # Two upserts raced, and the unique index let only the other one insert.
+            r = self._query_collection.find_one({'hash': hash}, projection)
+        if r is None:
+            return obj_from_dict(d), True
+        self._touch([hash])
+        return obj_from_dict(r), False
+
+    def claim_requests(self, args:List[Union[str,ast.AST]], results:ADLRequestInfo) -> List[Tuple[ADLRequestInfo, bool]]:
+        r'''
+        claim_request for many requests at once: one lookup for all of them, and one bulk write that creates
+        the ones that are missing.
+
+        Arguments:
+            args            The hashes of the ASTs (or the ASTs themselves). There should be no duplicates.
+            results         What to store for any request that is new
+
+        Returns:
+            List of (info, created), in the same order as args
+        '''
+        hashes = [hash_from_arg(a) for a in args]
+        found = {r['hash']: r for r in self._query_collection.find({'hash': {'$in': hashes}}, {'file_index': 0})}
+
+        missing = [h for h in hashes if h not in found]
+        created = set()
+        if len(missing) > 0:
+            new_fields = dict({k: v for k, v in dict_from_obj('', results).items() if k != 'hash'}, **self._new_times())
+            ops = [pymongo.UpdateOne({'hash': h}, {'$setOnInsert': new_fields}, upsert=True) for h in missing]
+            try:
+                upserted = self._query_collection.bulk_write(ops, ordered=False).upserted_ids.keys()
+            except pymongo.errors.BulkWriteError as e:
+                # Some upserts raced with another claim (and the unique index turned them away). The ones that
+                # made it in are still ours. Anything else went wrong.
+                if e.details.get('writeConcernErrors') or any(w.get('code') != 11000 for w in e.details.get('writeErrors', [])):
+                    raise
+                upserted = [u['index'] for u in e.details.get('upserted', [])]
+            created = {missing[i] for i in upserted}
+
+            # Anything someone else created between our lookup and our write
+            lost = [h for h in missing if h not in created]
+            if len(lost) > 0:
+                found.update({r['hash']: r for r in self._query_collection.find({'hash': {'$in': lost}}, {'file_index': 0})})
+
+        self._touch(found.keys())
+        return [(obj_from_dict(dict_from_obj(h, results)), True) if h in created else (obj_from_dict(found[h]), False)
+                for h in hashes]
+
+    def add_files(self, files:Dict[str, List[Tuple[str,str]]]) -> int:
+        r'''
+        Add files to many requests in two round trips to the db server: one to add the files and one to mark
+        the requests that are now complete as done. Each request is updated just like add_file would.
+        Every step is atomic on the db server, so any number of updaters can add files to the same request at once.
+
+        Arguments:
+            files           Dictionary of request hash to the list of (file, treename) to add to it. The
+                            list should not have duplicates in it.
+
+        Returns:
+            The number of requests that were found.
+
+        Notes:
+            Adding a file doesn't cost more as the list grows: the file is looked up in the request's file_index
+            and pushed onto the end of the list, and the list is never read back or rewritten.
+        '''
+        if len(files) == 0:
+            return 0
+        # Ordered, so each request's files go on the end of its list in the order they are given here.
+        self._query_collection.bulk_write([_add_file_op(h, e) for h, entries in files.items() for e in entries])
+        r = self._query_collection.update_many({'hash': {'$in': list(files.keys())}}, [_update_done_stage])
+        return r.matched_count
+
+    def set_phase(self, arg:Union[str,ast.AST], phase:str) -> bool:
+        r'''
+        Set the phase of a request.
+
+        Arguments:
+            arg             The hash of the AST (or the AST itself)
+            phase           The new phase
+
+        Returns:
+            True if the request was found, False otherwise.
+        '''
+        r = self._query_collection.update_one({'hash': hash_from_arg(arg)}, {'$set': {'phase': phase}})
+        return r.matched_count > 0
+
+    def set_jobs(self, arg:Union[str,ast.AST], njobs:int) -> bool:
+        r'''
+        Set the number of jobs a request is split into. If that many files are already in, the request is
+        marked as done.
+
+        Arguments:
+            arg             The hash of the AST (or the AST itself)
+            njobs           The number of jobs
+
+        Returns:
+            True if the request was found, False otherwise.
+        '''
+        r = self._query_collection.update_one({'hash': hash_from_arg(arg)}, [
+            {'$set': {'jobs': {'$literal': njobs}}},
+            _update_done_stage])
+        return r.matched_count > 0
+
+    def update_status(self, arg:Union[str,ast.AST], phase:Optional[str] = None, njobs:Optional[int] = None) -> bool:
+        r'''
+        Set the phase and/or number of jobs of a request in a single write (see set_phase and set_jobs).
+
+        Arguments:
+            arg             The hash of the AST (or the AST itself)
+            phase           The new phase, or None to leave it as it is
+            njobs           The number of jobs, or None to leave it as it is
+
+        Returns:
+            True if the request was found, False otherwise.
+        '''
+        changes = {}
+        if phase is not None:
+            changes['phase'] = {'$literal': phase}
+        if njobs is not None:
+            changes['jobs'] = {'$literal': njobs}
+        if len(changes) == 0:
+            return self._query_collection.count_documents({'hash': hash_from_arg(arg)}, limit=1) > 0
+        update = [{'$set': changes}] + ([_update_done_stage] if njobs is not None else [])
+        r = self._query_collection.update_one({'hash': hash_from_arg(arg)}, update)
+        return r.matched_count > 0
+
+    def mark_crashed(self, arg:Union[str,ast.AST], message:str, log, phase:Optional[str] = None, njobs:Optional[int] = None) -> bool:
+        r'''
+        Mark a request as done because it crashed.
+
+        Arguments:
+            arg             The hash of the AST (or the AST itself)
+            message         Message describing the crash
+            log             The log from the crash (a string or list of lines)
+            phase           If given, set the phase in the same write (see update_status)
+            njobs           If given, set the number of jobs in the same write
+
+        Returns:
+            True if the request was found, False otherwise.
+
+        Notes:
+            The full log is stored on the side (see open_log). The request only gets the last few lines of it,
+            and a reference to the full log in log_ref. The full log is only written once the request has
+            been found, so a crash reported before its request is saved (and retried) costs no upload.
+        '''
+        hash = hash_from_arg(arg)
+        text = log_text(log)
+        changes = {'done': True, 'message': message, 'log': log_excerpt(text), 'log_ref': hash, 'crashed': True, 'crashed_at': _utcnow()}
+        if phase is not None:
+            changes['phase'] = phase
+        if njobs is not None:
+            changes['jobs'] = njobs
+        r = self._query_collection.update_one({'hash': hash}, {'$set': changes})
+        if r.matched_count == 0:
+            return False
+        self._logs.put(text.encode('utf-8'), filename=hash)
+        return True
+
+    def open_log(self, arg:Union[str,ast.AST]):
+        r'''
+        Open the full crash log of a request.
+
+        Arguments:
+            arg             The hash of the AST (or the AST itself)
+
+        Returns:
+            None if there is no log. Otherwise a binary file-like object with the utf-8 text of the log
+            that can be read in pieces.
+        '''
+        try:
+            return self._logs.get_last_version(filename=hash_from_arg(arg))
+        except gridfs.errors.NoFile:
+            return None
+
+    def list_requests(self, phase:Optional[str] = None, min_age:Optional[float] = None, max_age:Optional[float] = None,
+                      cursor:Optional[str] = None, limit:int = 50) -> Tuple[List[dict], Optional[str]]:
+        r'''
+        List requests, newest first, a page at a time.
+
+        Arguments:
+            phase           Only requests in this phase
+            min_age         Only requests created at least this many seconds ago
+            max_age         Only requests created at most this many seconds ago
+            cursor          Where the page starts - the next_cursor of the last page, or None for the first
+            limit           Most requests to return (at most MAX_LIST_PAGE)
+
+        Returns:
+            (requests, next_cursor) Each request is a dict of its hash, phase, done, jobs, message and the time
+                                    it was created (an ISO 8601 string). next_cursor is None on the last page.
+
+        Notes:
+            Requests are listed in order of their _id, which MongoDB makes from the time they were created, so
+            the ages and the cursor are all ranges of _id: the listing walks the _id index (or the phase,
+            _id one), however large the collection, rather than sorting it.
+        '''
+        id_range = {}
+        if min_age is not None:
+            id_range['$lte'] = bson.ObjectId.from_datetime(_age_cutoff(min_age))
+        if max_age is not None:
+            id_range['$gte'] = bson.ObjectId.from_datetime(_age_cutoff(max_age))
+        if cursor is not None:
+            if not bson.ObjectId.is_valid(cursor):
+                raise ValueError(f'Bad cursor {cursor}')
+            id_range['$lt'] = bson.ObjectId(cursor)
+        query = {} if phase is None else {'phase': phase}
+        if len(id_range) > 0:
+            query['_id'] = id_range
+
+        limit = max(1, min(limit, MAX_LIST_PAGE))
+        fields = {'hash': 1, 'phase': 1, 'done': 1, 'jobs': 1, 'message': 1}
+        docs = list(self._query_collection.find(query, fields).sort('_id', pymongo.DESCENDING).limit(limit + 1))
+        page = [dict({k: d.get(k) for k in fields}, created=d['_id'].generation_time.isoformat()) for d in docs[:limit]]
+        return page, (str(docs[limit - 1]['_id']) if len(docs) > limit else None)
+
+def open_db(url:str) -> DBAccess:
+    r'''
+    Open the request store at a URL. The scheme picks the backend:
+
+        mongodb://host:port/        MongoDB (FuncADLDBAccess). mongodb+srv:// works too, as does a plain host
+                                    or host:port, as pymongo takes it.
+        memory://name               Held in this process (MemoryDBAccess). Everyone in the process that
+                                    opens the same name shares it.
+        sqlite:///path/to/file.db   A SQLite file (SQLiteDBAccess). Several processes on one node can share it.
+
+    Exceptions:
+        ValueError          The scheme isn't one of those
+    '''
+    scheme = url.split('://', 1)[0].lower() if '://' in url else ''
+    if scheme in ('', 'mongodb', 'mongodb+srv'):
+        return FuncADLDBAccess(url)
+    if scheme == 'memory':
+        from func_adl_request_broker.memory_db_access import memory_db
+        return memory_db(url[len('memory://'):])
+    if scheme == 'sqlite':
+        from func_adl_request_broker.sqlite_db_access import SQLiteDBAccess
+        return SQLiteDBAccess(url[len('sqlite://'):])
+    raise ValueError(f'Unknown request store {url} - it must be a MongoDB host, or start with mongodb://, memory:// or sqlite://')
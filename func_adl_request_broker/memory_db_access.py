@@ -0,0 +1,159 @@
+# Request store held in the memory of this process - for single process deployments, tests and benchmarks.
+import ast
+import io
+import itertools
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Dict, Iterable, List, Optional, Tuple, Union
+from func_adl_request_broker.db_access import ADLRequestInfo, DBAccess, MAX_LIST_PAGE, dict_from_obj, file_key, hash_from_arg, log_excerpt, log_text
+
+# The stores opened with open_db('memory://name'), by name
+_stores: Dict[str, 'MemoryDBAccess'] = {}
+_stores_lock = threading.Lock()
+
+
+def memory_db(name:str = '') -> 'MemoryDBAccess':
+    'The in-memory store with this name, created the first time it is asked for'
+    with _stores_lock:
+        if name not in _stores:
+            _stores[name] = MemoryDBAccess()
+        return _stores[name]
+
+
+class MemoryDBAccess(DBAccess):
+    r'''
+    Keeps the requests in a dictionary. A lock makes each update atomic, so it can be shared by threads,
+    but not by processes. Everything is lost when the process exits.
+    '''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._requests: Dict[str, dict] = {}
+        self._logs: Dict[str, bytes] = {}
+        # hash -> (order it was created in, when)
+        self._created: Dict[str, Tuple[int, float]] = {}
+        self._sequence = itertools.count()
+
+    def _info(self, r:dict, fields:Optional[Iterable[str]] = None, files_from:int = 0, max_files:Optional[int] = None) -> ADLRequestInfo:
+        'Copy a request out, with just the fields asked for'
+        end = None if max_files is None else files_from + max_files
+        d = dict(r, files=[list(f) if isinstance(f, (list, tuple)) else f for f in r['files'][files_from:end]])
+        del d['file_index']
+        if fields is not None:
+            d = {k: v for k, v in d.items() if k in fields or k == 'hash'}
+        return ADLRequestInfo(**d)
+
+    def _mark_done(self, r:dict):
+        r['done'] = r['done'] or (r['jobs'] is not None and r['jobs'] >= 0 and len(r['files']) >= r['jobs'])
+
+    def _new(self, hash:str, results:ADLRequestInfo) -> dict:
+        d = dict(done=None, files=[], jobs=None, phase=None, message=None, log=None, log_ref=None)
+        d.update(dict_from_obj(hash, results))
+        d['files'] = list(d['files'] or [])
+        d['file_index'] = set(d['file_index'].keys())
+        self._requests[hash] = d
+        self._created[hash] = (next(self._sequence), time.time())
+        return d
+
+    def lookup_results(self, arg:Union[str,ast.AST], fields:Optional[Iterable[str]] = None,
+                       files_from:int = 0, max_files:Optional[int] = None) -> Optional[ADLRequestInfo]:
+        with self._lock:
+            r = self._requests.get(hash_from_arg(arg))
+            return None if r is None else self._info(r, fields, files_from, max_files)
+
+    def save_results(self, arg:str, results:ADLRequestInfo) -> ADLRequestInfo:
+        with self._lock:
+            return self._info(self._new(hash_from_arg(arg), results))
+
+    def claim_request(self, arg:Union[str,ast.AST], results:ADLRequestInfo,
+                      files_from:int = 0, max_files:Optional[int] = None) -> Tuple[ADLRequestInfo, bool]:
+        hash = hash_from_arg(arg)
+        with self._lock:
+            r = self._requests.get(hash)
+            return (self._info(r, None, files_from, max_files), False) if r is not None else (self._info(self._new(hash, results)), True)
+
+    def claim_requests(self, args:List[Union[str,ast.AST]], results:ADLRequestInfo) -> List[Tuple[ADLRequestInfo, bool]]:
+        claims = []
+        with self._lock:
+            for hash in (hash_from_arg(a) for a in args):
+                r = self._requests.get(hash)
+                claims.append((self._info(r), False) if r is not None else (self._info(self._new(hash, results)), True))
+        return claims
+
+    def add_files(self, files:Dict[str, List[Tuple[str,str]]]) -> int:
+        n_found = 0
+        with self._lock:
+            for hash, entries in files.items():
+                r = self._requests.get(hash)
+                if r is None:
+                    continue
+                n_found += 1
+                for e in entries:
+                    key = file_key(list(e))
+                    if key not in r['file_index']:
+                        r['file_index'].add(key)
+                        r['files'].append(list(e))
+                self._mark_done(r)
+        return n_found
+
+    def set_phase(self, arg:Union[str,ast.AST], phase:str) -> bool:
+        with self._lock:
+            r = self._requests.get(hash_from_arg(arg))
+            if r is not None:
+                r['phase'] = phase
+            return r is not None
+
+    def set_jobs(self, arg:Union[str,ast.AST], njobs:int) -> bool:
+        with self._lock:
+            r = self._requests.get(hash_from_arg(arg))
+            if r is not None:
+                r['jobs'] = njobs
+                self._mark_done(r)
+            return r is not None
+
+    def update_status(self, arg:Union[str,ast.AST], phase:Optional[str] = None, njobs:Optional[int] = None) -> bool:
+        with self._lock:
+            r = self._requests.get(hash_from_arg(arg))
+            if r is not None:
+                if phase is not None:
+                    r['phase'] = phase
+                if njobs is not None:
+                    r['jobs'] = njobs
+                    self._mark_done(r)
+            return r is not None
+
+    def list_requests(self, phase:Optional[str] = None, min_age:Optional[float] = None, max_age:Optional[float] = None,
+                      cursor:Optional[str] = None, limit:int = 50) -> Tuple[List[dict], Optional[str]]:
+        now = time.time()
+        with self._lock:
+            matches = sorted(((seq, created, r) for (seq, created), r in
+                              ((self._created[h], r) for h, r in self._requests.items())
+                              if (phase is None or r['phase'] == phase)
+                              and (min_age is None or created <= now - min_age)
+                              and (max_age is None or created >= now - max_age)
+                              and (cursor is None or seq < int(cursor))),
+                             key=lambda m: m[0], reverse=True)
+            limit = max(1, min(limit, MAX_LIST_PAGE))
+            page = [{'hash': r['hash'], 'phase': r['phase'], 'done': r['done'], 'jobs': r['jobs'], 'message': r['message'],
+                     'created': datetime.fromtimestamp(created, timezone.utc).isoformat()} for _, created, r in matches[:limit]]
+        return page, (str(matches[limit - 1][0]) if len(matches) > limit else None)
+
+    def mark_crashed(self, arg:Union[str,ast.AST], message:str, log, phase:Optional[str] = None, njobs:Optional[int] = None) -> bool:
+        hash = hash_from_arg(arg)
+        text = log_text(log)
+        with self._lock:
+            r = self._requests.get(hash)
+            if r is None:
+                return False
+            r.update(done=True, message=message, log=log_excerpt(text), log_ref=hash)
+            if phase is not None:
+                r['phase'] = phase
+            if njobs is not None:
+                r['jobs'] = njobs
+            self._logs[hash] = text.encode('utf-8')
+            return True
+
+    def open_log(self, arg:Union[str,ast.AST]):
+        with self._lock:
+            log = self._logs.get(hash_from_arg(arg))
+        return None if log is None else io.BytesIO(log)
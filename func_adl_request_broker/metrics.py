@@ -0,0 +1,261 @@
+# Counters and timing histograms for the broker's tools, in the Prometheus text format. Each process keeps
+# its own. The web front ends serve them on /metrics; the ingester and state updater can write them to a
+# file (for the node exporter's textfile collector, or just to look at) and log them on SIGUSR1.
+import logging
+import os
+import signal
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, List, Tuple
+
+# Upper bounds (seconds) of the histogram buckets - from half a millisecond to the reply timeout
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _escape(value:str) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _label_text(names:Iterable[str], values:Iterable[str]) -> str:
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    return '{' + ','.join(pairs) + '}' if len(pairs) > 0 else ''
+
+
+class _Metric:
+    'A metric with a value for each combination of its label values'
+    type = 'untyped'
+
+    def __init__(self, name:str, help:str, labels:Tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+        self._values: Dict[Tuple[str, ...], object] = {}
+
+    def _key(self, labels:dict) -> Tuple[str, ...]:
+        return tuple(str(labels.get(l, '')) for l in self.labels)
+
+    def render(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.type}']
+        with self._lock:
+            values = sorted(self._values.items())
+        for key, value in values:
+            lines.extend(self._render_value(key, value))
+        return lines
+
+    def _render_value(self, key, value) -> List[str]:
+        return [f'{self.name}{_label_text(self.labels, key)} {value}']
+
+
+class Counter(_Metric):
+    'A count that only goes up'
+    type = 'counter'
+
+    def inc(self, amount:float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+
+class Histogram(_Metric):
+    'How long something took, counted into buckets'
+    type = 'histogram'
+
+    def __init__(self, name:str, help:str, labels:Tuple[str, ...] = (), buckets:Tuple[float, ...] = DEFAULT_BUCKETS):
+        _Metric.__init__(self, name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value:float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                # One count per bucket, then +Inf, then the sum
+                counts = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[bisect_left(self.buckets, value)] += 1
+            counts[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        'Time the block'
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def count(self, **labels) -> int:
+        'How many times something was timed'
+        with self._lock:
+            counts = self._values.get(self._key(labels))
+            return 0 if counts is None else sum(counts[:-1])
+
+    def _render_value(self, key, counts) -> List[str]:
+        lines = []
+        total = 0
+        for bound, n in zip(list(self.buckets) + ['+Inf'], counts[:-1]):
+            total += n
+            lines.append(f'{self.name}_bucket{_label_text(self.labels + ("le",), key + (str(bound),))} {total}')
+        lines.append(f'{self.name}_sum{_label_text(self.labels, key)} {counts[-1]}')
+        lines.append(f'{self.name}_count{_label_text(self.labels, key)} {total}')
+        return lines
+
+
+class Gauge(_Metric):
+    'A value that goes up and down'
+    type = 'gauge'
+
+    def set(self, value:float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def value(self, **labels) -> float:
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+
+class CallbackGauge(_Metric):
+    'A value that is read from somewhere else each time the metrics are rendered'
+    def __init__(self, name:str, help:str, fn:Callable[[], float], type:str = 'gauge'):
+        _Metric.__init__(self, name, help)
+        self.type = type
+        self._fn = fn
+
+    def render(self) -> List[str]:
+        return [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.type}', f'{self.name} {self._fn()}']
+
+
+class Registry:
+    'All the metrics of a process. Asking for a metric that already exists returns it.'
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics: Dict[str, _Metric] = {}
+
+    def _get(self, name:str, make:Callable[[], _Metric]) -> _Metric:
+        with self._lock:
+            if name not in self._metrics:
+                self._metrics[name] = make()
+            return self._metrics[name]
+
+    def counter(self, name:str, help:str, labels:Tuple[str, ...] = ()) -> Counter:
+        return self._get(name, lambda: Counter(name, help, labels))
+
+    def gauge(self, name:str, help:str, labels:Tuple[str, ...] = ()) -> Gauge:
+        return self._get(name, lambda: Gauge(name, help, labels))
+
+    def histogram(self, name:str, help:str, labels:Tuple[str, ...] = (), buckets:Tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+        return self._get(name, lambda: Histogram(name, help, labels, buckets))
+
+    def callback(self, name:str, help:str, fn:Callable[[], float], type:str = 'gauge') -> CallbackGauge:
+        'A metric read from fn. Registering the name again replaces fn.'
+        with self._lock:
+            self._metrics[name] = CallbackGauge(name, help, fn, type)
+            return self._metrics[name]
+
+    def render(self) -> str:
+        'Everything, in the Prometheus text exposition format'
+        with self._lock:
+            metrics = sorted(self._metrics.items())
+        lines = []
+        for _, m in metrics:
+            lines.extend(m.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+# Content type of the Prometheus text format
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# The metrics shared by the tools. Stages are named for the step in the tool doing the work.
+QUERY_STAGE_SECONDS = REGISTRY.histogram('query_web_stage_seconds', 'Time spent in each stage of a /query request', ('stage',))
+RPC_CALL_SECONDS = REGISTRY.histogram('rpc_call_seconds', 'Round trip of a request to the ingester', ('outcome',))
+RPC_CONNECT_SECONDS = REGISTRY.histogram('rpc_connect_seconds', 'Time to open the RPC connection and reply queue')
+INGESTER_STAGE_SECONDS = REGISTRY.histogram('ingester_stage_seconds', 'Time spent in each stage of handling a request', ('stage',))
+HANDLER_SECONDS = REGISTRY.histogram('state_updater_handler_seconds', 'Time to handle a status message', ('queue',))
+QUEUE_WAIT_SECONDS = REGISTRY.histogram('amqp_queue_wait_seconds', 'Time a message waited in the broker (between hosts this includes clock skew)', ('queue',))
+MESSAGES_CONSUMED = REGISTRY.counter('amqp_messages_consumed_total', 'Messages taken off each queue', ('queue',))
+MESSAGES_PUBLISHED = REGISTRY.counter('amqp_messages_published_total', 'Messages sent to each queue or exchange', ('queue',))
+DB_SECONDS = REGISTRY.histogram('db_seconds', 'Time of each call to the request store', ('op',))
+# The fair share metrics are labelled by bucket, not client id - the client picks its id, and could make any
+# number of series. Queued minus dispatched is only what this ingester put in and took out: with several
+# ingesters sharing the buckets it is not the depth (FAIR_SHARE_DEPTH is, as RabbitMQ reports it).
+FAIR_SHARE_QUEUED = REGISTRY.counter('find_did_fair_share_queued_total', 'New requests queued for find_did by this process, by fair share bucket', ('bucket',))
+FAIR_SHARE_DISPATCHED = REGISTRY.counter('find_did_fair_share_dispatched_total', 'Queued requests passed on to find_did by this process, by fair share bucket', ('bucket',))
+FAIR_SHARE_WAIT_SECONDS = REGISTRY.histogram('find_did_fair_share_wait_seconds', 'Time a request waited for its turn at find_did, by fair share bucket', ('bucket',))
+FAIR_SHARE_DEPTH = REGISTRY.gauge('find_did_fair_share_depth', 'Requests waiting in each fair share queue, when last looked at', ('bucket',))
+FIND_DID_DEPTH = REGISTRY.gauge('find_did_queue_depth', 'Requests waiting in find_did itself, when last looked at')
+UPDATES_COALESCED = REGISTRY.counter('state_updater_updates_coalesced_total', 'Status messages merged into the write of another for the same request', ('queue',))
+EVENTS_HELD = REGISTRY.counter('state_updater_events_held_total', 'Status messages held because their request was not in the db yet', ('queue',))
+EVENTS_REPLAYED = REGISTRY.counter('state_updater_events_replayed_total', 'Held status messages applied once their request turned up', ('queue',))
+EVENTS_EXPIRED = REGISTRY.counter('state_updater_events_expired_total', 'Status messages dropped because their request never turned up (or there was no room to hold them)', ('queue', 'reason'))
+
+# The header requests carry the time they were sent in (seconds since the epoch), so the receiver can tell
+# how long they waited in the queue.
+SENT_AT_HEADER = 'sent_at'
+
+
+def observe_queue_wait(queue:str, properties):
+    'Count a message taken off a queue, and how long it waited there if the sender said when it sent it'
+    MESSAGES_CONSUMED.inc(queue=queue)
+    headers = getattr(properties, 'headers', None)
+    if headers is not None and SENT_AT_HEADER in headers:
+        QUEUE_WAIT_SECONDS.observe(max(0.0, time.time() - float(headers[SENT_AT_HEADER])), queue=queue)
+
+
+class TimedDBAccess:
+    r'''
+    Wraps a request store (see db_access.open_db) and times every call made to it, in db_seconds, by
+    method name.
+    '''
+    def __init__(self, db):
+        self._db = db
+
+    def __getattr__(self, name:str):
+        attr = getattr(self._db, name)
+        if name.startswith('_') or not callable(attr):
+            return attr
+
+        def timed(*args, **kwargs):
+            with DB_SECONDS.time(op=name):
+                return attr(*args, **kwargs)
+        return timed
+
+
+def dump_metrics(path:str):
+    'Write all the metrics to a file. It is replaced in one go, so a reader never sees half of it.'
+    tmp = f'{path}.tmp'
+    with open(tmp, 'w') as f:
+        f.write(REGISTRY.render())
+    os.replace(tmp, path)
+
+
+def start_metrics_dump(path:str, interval:float = 15.0) -> threading.Thread:
+    'Write the metrics to a file every interval seconds, on a background thread'
+    def run():
+        while True:
+            try:
+                dump_metrics(path)
+            except OSError as e:
+                logging.warning(f'Unable to write the metrics to {path} ({e}).')
+            time.sleep(interval)
+    t = threading.Thread(target=run, name='metrics-dump', daemon=True)
+    t.start()
+    return t
+
+
+def metrics_dump_from_env():
+    r'''
+    For the tools that don't have a web server: log the metrics on SIGUSR1, and, if METRICS_FILE is set,
+    write them to that file every METRICS_DUMP_INTERVAL seconds.
+    '''
+    signal.signal(signal.SIGUSR1, lambda signum, frame: logging.info('Metrics:\n' + REGISTRY.render()))
+    if 'METRICS_FILE' in os.environ:
+        start_metrics_dump(os.environ['METRICS_FILE'], float(os.environ.get('METRICS_DUMP_INTERVAL', '15')))
@@ -0,0 +1,278 @@
+# Helpers shared by the web front ends (the hug one in query_web and the asyncio one in query_web_async)
+# and the ingester.
+import ast
+import json
+import math
+import os
+import pickle
+from collections import deque
+from typing import Callable, List, Optional
+from func_adl import ResultTTree
+from func_adl_request_broker.db_access import ADLRequestInfo
+from func_adl_request_broker.upload import CopyingReader, ServerBusy, UploadTooLarge
+
+# Largest AST (in bytes) we are willing to accept
+MAX_AST_SIZE = 1024*1000*100
+
+# Headers the web front ends pass on to the ingester to say who a request is for and how big its
+# dataset is (see request_metadata) - the ingester uses them to share find_did out fairly.
+CLIENT_ID_HEADER = 'client_id'
+SIZE_HINT_HEADER = 'size_hint'
+
+# Highest AMQP priority a request to find_did gets
+MAX_PRIORITY = 9
+
+
+class BadASTException(BaseException):
+    def __init__(self, message):
+        BaseException.__init__(self, message)
+
+
+def ast_from_pickle(raw_data:bytes) -> ast.AST:
+    r'''
+    Unpickle an incoming query and make sure it is something we can process.
+    WARNING: Python AST's are a known security issue and should not be used.
+
+    Arguments:
+        raw_data            The pickled python AST representing the request
+
+    Returns:
+        The AST
+
+    Exceptions:
+        BadASTException     If this isn't an AST that ends with a ResultTTree
+    '''
+    return check_ast(pickle.loads(raw_data))
+
+
+def ast_from_stream(reader:CopyingReader) -> ast.AST:
+    r'''
+    Unpickle an incoming query as it is read, rather than reading it all in first.
+    WARNING: Python AST's are a known security issue and should not be used.
+
+    Arguments:
+        reader              The (decompressed) upload. Once this returns, reader.data is the pickle as
+                            it was sent, to forward on.
+
+    Returns:
+        The AST
+
+    Exceptions:
+        BadASTException     If this isn't an AST that ends with a ResultTTree
+        UploadTooLarge      If the pickle is bigger than the reader allows
+        ServerBusy          If the reader's reservation can't be grown to hold it
+    '''
+    return check_ast(_load_stream(reader))
+
+
+def asts_from_stream(reader:CopyingReader) -> List[ast.AST]:
+    'asts_from_pickle, unpickling the batch as it is read (see ast_from_stream)'
+    return check_asts(_load_stream(reader))
+
+
+def _load_stream(reader:CopyingReader):
+    'Unpickle an upload as it is read'
+    try:
+        a = pickle.load(reader)
+    except (UploadTooLarge, ServerBusy, BadASTException):
+        raise
+    except Exception as e:
+        raise BadASTException(f'Unable to unpickle the query: {e}')
+    # Anything after the pickle is a malformed request - and still counts towards the size
+    if len(reader.read(1)) > 0:
+        raise BadASTException('There is data after the pickled query.')
+    return a
+
+
+def check_ast(a) -> ast.AST:
+    'Make sure an unpickled query is something we can process, and return it'
+    if a is None or not isinstance(a, ast.AST):
+        raise BadASTException(f'Incoming AST is not the proper type: {type(a)}.')
+    if not isinstance(a, ResultTTree):
+        raise BadASTException(f'The AST must end with a ResultTTree - that is all this server can resolve, not {a}')
+    return a
+
+
+def asts_from_pickle(raw_data:bytes) -> List[ast.AST]:
+    r'''
+    Unpickle a batch of queries and make sure every one of them is something we can process.
+    WARNING: Python AST's are a known security issue and should not be used.
+
+    Arguments:
+        raw_data            A pickled list of python ASTs
+
+    Returns:
+        The ASTs, in the order they were sent
+
+    Exceptions:
+        BadASTException     If this isn't a list, or one of the ASTs doesn't end with a ResultTTree
+    '''
+    return check_asts(pickle.loads(raw_data))
+
+
+def check_asts(asts) -> List[ast.AST]:
+    'Make sure an unpickled batch of queries is a list of queries we can process, and return it'
+    if not isinstance(asts, (list, tuple)):
+        raise BadASTException(f'A batch of queries must be a list of ASTs, not {type(asts)}.')
+    return [check_ast(a) for a in asts]
+
+
+def request_metadata(get_header:Callable[[str], Optional[str]]) -> dict:
+    r'''
+    The headers to send to the ingester along with a request, from the HTTP request's X-Client-ID (who
+    is asking) and X-Dataset-Size-Hint (roughly how many bytes the query will run over).
+
+    Arguments:
+        get_header          Looks up an HTTP header, returning None if it isn't there
+    '''
+    metadata = {}
+    client_id = get_header('X-Client-ID')
+    if client_id:
+        metadata[CLIENT_ID_HEADER] = client_id[:64]
+    size_hint = get_header('X-Dataset-Size-Hint')
+    if size_hint:
+        try:
+            metadata[SIZE_HINT_HEADER] = max(0, int(float(size_hint)))
+        except ValueError:
+            pass
+    return metadata
+
+
+def priority_from_size_hint(size_hint:Optional[int]) -> int:
+    r'''
+    The AMQP priority of a request to find_did: the smaller the dataset, the higher, so quick queries
+    don't wait behind big ones. Under 1 GB gets MAX_PRIORITY, and each factor of 10 beyond that two
+    less, down to 1. A request with no hint is in the middle.
+    '''
+    if size_hint is None:
+        return MAX_PRIORITY // 2 + 1
+    decades = 0 if size_hint < 1e9 else math.floor(math.log10(size_hint / 1e9)) + 1
+    return max(1, MAX_PRIORITY - 2*decades)
+
+
+def reply_timeout() -> float:
+    'How long (seconds) to wait for the ingester to answer before telling the client to poll again'
+    return float(os.environ.get('QUERY_REPLY_TIMEOUT', '30'))
+
+
+def pending_response() -> dict:
+    'The status we send back when the ingester has not answered in time'
+    return {'files': [], 'phase': 'pending', 'done': False, 'jobs': -1, 'log': None, 'log_ref': None,
+            'message': 'The request is still being processed - please poll again.'}
+
+
+def result_from_info(info:ADLRequestInfo) -> dict:
+    'The status of a request, as it is sent back to the client'
+    return {'files': info.files, 'phase': info.phase, 'done': info.done, 'jobs': info.jobs, 'log': info.log,
+            'log_ref': info.log_ref, 'message': info.message}
+
+
+# Headers asking the ingester to send back only a page of a request's file list
+FILES_FROM_HEADER = 'files_from'
+MAX_FILES_HEADER = 'max_files'
+
+
+def paging_headers(cursor:int = 0, limit:int = 0) -> dict:
+    'The headers that ask the ingester for the files from cursor on, at most limit of them (0 for all)'
+    headers = {}
+    if cursor > 0:
+        headers[FILES_FROM_HEADER] = cursor
+    if limit > 0:
+        headers[MAX_FILES_HEADER] = limit
+    return headers
+
+
+def page_files(result:dict, cursor:int = 0, limit:int = 0) -> dict:
+    r'''
+    Cut the file list of a result down to the files from cursor on, and add next_cursor, where the
+    client should pick up from next time.
+
+    Arguments:
+        result              The result. The file list is the whole list, unless the ingester already
+                            cut it down (it has a next_cursor then), when it is left as it is.
+        cursor              How many files the client already has
+        limit               The most files to send back. 0 means all of them.
+    '''
+    if 'next_cursor' in result:
+        return result
+    result['files'] = result['files'][cursor:cursor+limit] if limit > 0 else result['files'][cursor:]
+    result['next_cursor'] = cursor + len(result['files'])
+    return result
+
+
+def rewrite_file_urls(result:dict) -> dict:
+    r'''
+    Add the local and http file lists to the result, and rewrite the file list, using the
+    prefixes in the environment (LOCAL_FILE_URL, HTTP_PREFIX, FILE_URL).
+    '''
+    if 'LOCAL_FILE_URL' in os.environ:
+        prefix = os.environ['LOCAL_FILE_URL']
+        result['localfiles'] = [[f'{prefix}{u}', tn] for u,tn in result['files']]
+
+    if 'HTTP_PREFIX' in os.environ:
+        prefix = os.environ['HTTP_PREFIX']
+        result['httpfiles'] = [[f'{prefix}{u}', tn] for u,tn in result['files']]
+
+    if 'FILE_URL' in os.environ:
+        # Do this last b.c. it rewrites the files guy.
+        prefix = os.environ['FILE_URL']
+        result['files'] = [[f'{prefix}{u}', tn] for u,tn in result['files']]
+
+    return result
+
+
+# An SSE comment - sent when there is nothing else to, so proxies don't drop the connection
+SSE_KEEPALIVE = b': keepalive\n\n'
+
+
+class ProgressEvents:
+    r'''
+    The Server-Sent Events that report a query's progress: a 'file' event for every file (those already
+    there first), 'status' events for phase and job count changes, and a final 'done' or 'crashed' event.
+    Pass it the status events for the query (see status_notifier) with on_event, and send on what turns up
+    in chunks, until it is finished.
+    '''
+    def __init__(self, info:ADLRequestInfo):
+        self.chunks = deque()
+        self.finished = False
+        self._jobs = info.jobs
+        self._seen = set()
+
+        for f, tn in info.files:
+            self._add_file(f, tn)
+        self._send('status', {'phase': info.phase, 'jobs': info.jobs})
+        if info.done:
+            self._finish('crashed' if info.message else 'done', {'message': info.message} if info.message else {})
+        else:
+            self._check_done()
+
+    def _send(self, event:str, data:dict):
+        self.chunks.append(f'event: {event}\ndata: {json.dumps(data)}\n\n'.encode('utf-8'))
+
+    def _finish(self, event:str, data:dict):
+        self._send(event, data)
+        self.finished = True
+
+    def _add_file(self, file_ref:str, treename:str):
+        if (file_ref, treename) not in self._seen:
+            self._seen.add((file_ref, treename))
+            self._send('file', rewrite_file_urls({'files': [[file_ref, treename]]}))
+
+    def _check_done(self):
+        'Same rule the db uses: done once there is a file for every job'
+        if self._jobs is not None and self._jobs >= 0 and len(self._seen) >= self._jobs:
+            self._finish('done', {})
+
+    def on_event(self, e:dict):
+        'A status event for the query'
+        if e['event'] == 'file':
+            self._add_file(e['file'], e['treename'])
+            self._check_done()
+        elif e['event'] == 'phase':
+            self._send('status', {'phase': e['phase']})
+        elif e['event'] == 'njobs':
+            self._jobs = e['njobs']
+            self._send('status', {'jobs': e['njobs']})
+            self._check_done()
+        elif e['event'] == 'crashed':
+            self._finish('crashed', {'message': e['message']})
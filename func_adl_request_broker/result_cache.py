@@ -0,0 +1,73 @@
+# In-process cache of the results of completed queries, for the web front ends.
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+from func_adl_request_broker.metrics import REGISTRY
+
+
+class ResultCache:
+    r'''
+    LRU cache, with a time-to-live, of query results keyed by the AST hash. Once a query is done its
+    file list never changes, so we can answer repeats without going through the broker. Only results
+    that are done and did not crash are stored.
+    '''
+    def __init__(self, max_entries:int = 1000, ttl:float = 3600.0):
+        r'''
+        Arguments:
+            max_entries         The most results to hold. The least recently used are dropped first.
+            ttl                 Seconds a result is held before we go back to the broker for it
+        '''
+        self._max_entries = max_entries
+        self._ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, hash:str) -> Optional[dict]:
+        'Return a copy of the cached result for this hash, or None if we do not have it'
+        with self._lock:
+            entry = self._entries.get(hash)
+            if entry is not None and entry[0] < time.monotonic():
+                del self._entries[hash]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(hash)
+            self.hits += 1
+            return dict(entry[1])
+
+    def put(self, hash:str, result:dict):
+        'Cache the result if it is for a query that finished cleanly, with all its files. Anything else is ignored.'
+        if self._max_entries <= 0 or not result.get('done', False) or result.get('message') or result.get('log') or 'next_cursor' in result:
+            return
+        with self._lock:
+            self._entries[hash] = (time.monotonic() + self._ttl, dict(result))
+            self._entries.move_to_end(hash)
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        'Drop everything (the counters are left alone)'
+        with self._lock:
+            self._entries.clear()
+
+    def register_metrics(self):
+        'Report the hit/miss counters and size of this cache with the other metrics'
+        REGISTRY.callback('result_cache_hits_total', 'Queries answered from the completed query cache', lambda: self.hits, type='counter')
+        REGISTRY.callback('result_cache_misses_total', 'Queries not found in the completed query cache', lambda: self.misses, type='counter')
+        REGISTRY.callback('result_cache_entries', 'Results held in the completed query cache', lambda: len(self._entries))
+
+    def stats(self) -> dict:
+        'Hit/miss counters and current size'
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'entries': len(self._entries)}
+
+
+def result_cache_from_env() -> ResultCache:
+    'Build the cache from QUERY_CACHE_SIZE (entries, 0 turns it off) and QUERY_CACHE_TTL (seconds)'
+    return ResultCache(max_entries=int(os.environ.get('QUERY_CACHE_SIZE', '1000')),
+                       ttl=float(os.environ.get('QUERY_CACHE_TTL', '3600')))
@@ -0,0 +1,161 @@
+# A long lived RPC client for talking to the request ingester over RabbitMQ.
+import threading
+import time
+import uuid
+import logging
+from typing import Callable, Dict, Optional
+import pika
+from func_adl_request_broker.metrics import MESSAGES_PUBLISHED, RPC_CONNECT_SECONDS, SENT_AT_HEADER
+
+
+class RPCTimeout(Exception):
+    'No reply came back in the time we were willing to wait'
+    pass
+
+
+class RabbitRPCClient:
+    r'''
+    Keeps a single connection, channel, and reply queue open to RabbitMQ and uses them for every
+    request made from this process. Replies are matched back to the caller that is waiting for them
+    by their correlation id.
+
+    pika is not thread safe, so all access to the connection is serialized by a lock. A caller waiting
+    for its reply pumps the connection in short slices, handing off any replies for other callers as
+    they arrive.
+    '''
+    def __init__(self, host:str, user:str, password:str, request_queue:str = 'as_request',
+                 connection_factory:Optional[Callable] = None, poll_interval:float = 0.05):
+        r'''
+        Create the client. The connection is not opened until the first call.
+
+        Arguments:
+            host                The RabbitMQ node address
+            user                Username for the RabbitMQ node
+            password            Password for the RabbitMQ node
+            request_queue       The queue that requests are sent to
+            connection_factory  Called with the connection parameters to create the connection. Defaults
+                                to pika.BlockingConnection.
+            poll_interval       How long (seconds) to block waiting for data on each pump of the connection
+        '''
+        self._parameters = pika.ConnectionParameters(host=host, credentials=pika.PlainCredentials(user, password))
+        self._request_queue = request_queue
+        self._connection_factory = connection_factory if connection_factory is not None else pika.BlockingConnection
+        self._poll_interval = poll_interval
+        self._lock = threading.RLock()
+        self._connection = None
+        self._channel = None
+        self._callback_queue = None
+        self._pending: Dict[str, Optional[bytes]] = {}
+
+    def _connect(self):
+        'Open the connection, declare the request queue and our reply queue'
+        logging.info("Opening connection to RabbitMQ")
+        with RPC_CONNECT_SECONDS.time():
+            self._connection = self._connection_factory(self._parameters)
+            self._channel = self._connection.channel()
+            self._channel.queue_declare(queue=self._request_queue)
+
+            # The reply queue is anonymous and exclusive - it goes away when the connection does.
+            result = self._channel.queue_declare(queue='', exclusive=True)
+            self._callback_queue = result.method.queue
+            self._channel.basic_consume(queue=self._callback_queue, on_message_callback=self._on_response, auto_ack=True)
+
+    def _reset(self):
+        'Drop the connection - the next call will reconnect'
+        try:
+            if self._connection is not None and self._connection.is_open:
+                self._connection.close()
+        except pika.exceptions.AMQPError:
+            pass
+        self._connection = None
+        self._channel = None
+        self._callback_queue = None
+
+    def _on_response(self, ch, method, props, body):
+        'A reply has come back. Hand it to whoever is waiting for it. Replies nobody is waiting for are dropped.'
+        if props.correlation_id in self._pending:
+            self._pending[props.correlation_id] = body
+
+    def close(self):
+        'Close down the connection'
+        with self._lock:
+            self._reset()
+
+    def call(self, body:bytes, timeout:Optional[float] = None, headers:Optional[dict] = None,
+             correlation_id:Optional[str] = None) -> bytes:
+        r'''
+        Send a request and wait for the reply.
+
+        Arguments:
+            body                The body of the request message
+            timeout             Seconds to wait for the reply. None means wait forever.
+            headers             AMQP headers to send along with the request. The time it was sent is added.
+            correlation_id      The correlation id of the request, which must be unique. Pass one in to trace the
+                                request through the other services. A new one is made if it isn't.
+
+        Returns:
+            The body of the reply message
+
+        Exceptions:
+            RPCTimeout          The reply did not arrive within the timeout
+
+        Notes:
+            If the connection is lost the request is re-sent once on a fresh connection (the reply
+            queue does not survive the connection).
+        '''
+        corr_id = correlation_id if correlation_id is not None else str(uuid.uuid4())
+        deadline = None if timeout is None else time.monotonic() + timeout
+        self._pending[corr_id] = None
+        try:
+            for attempt in range(2):
+                connection = None
+                try:
+                    connection = self._publish(corr_id, body, headers)
+                    return self._wait_for(corr_id, connection, deadline)
+                except pika.exceptions.AMQPError as e:
+                    if attempt > 0:
+                        raise
+                    logging.warning(f'Lost connection to RabbitMQ ({e}), reconnecting.')
+                    with self._lock:
+                        # Only drop the connection if it is the one that failed us - another caller may
+                        # already have reconnected.
+                        if connection is None or self._connection is connection:
+                            self._reset()
+        finally:
+            del self._pending[corr_id]
+
+    def _publish(self, corr_id:str, body:bytes, headers:Optional[dict]):
+        'Send the request message off, and return the connection it went out on'
+        with self._lock:
+            if self._connection is None or not self._connection.is_open:
+                self._reset()
+                self._connect()
+            self._channel.basic_publish(exchange='',
+                routing_key=self._request_queue,
+                properties=pika.BasicProperties(
+                    reply_to=self._callback_queue,
+                    correlation_id=corr_id,
+                    headers=dict(headers or {}, **{SENT_AT_HEADER: time.time()})
+                ),
+                body=body
+            )
+            MESSAGES_PUBLISHED.inc(queue=self._request_queue)
+            return self._connection
+
+    def _wait_for(self, corr_id:str, connection, deadline:Optional[float]) -> bytes:
+        'Pump the connection until our reply shows up. process_data_events blocks on the socket, so this does not spin.'
+        while True:
+            with self._lock:
+                reply = self._pending[corr_id]
+                if reply is not None:
+                    return reply
+                if self._connection is not connection:
+                    # Someone else reconnected - our reply queue is gone with the old connection.
+                    raise pika.exceptions.AMQPConnectionError('Connection was reset while waiting for a reply')
+                time_limit = self._poll_interval
+                if deadline is not None:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise RPCTimeout(f'No reply after waiting for the request {corr_id}')
+                    time_limit = min(time_limit, remaining)
+                self._connection.process_data_events(time_limit=time_limit)
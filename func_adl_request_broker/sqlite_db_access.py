@@ -0,0 +1,225 @@
+# Request store in a local SQLite file - for single node deployments that don't want to run MongoDB.
+import ast
+import io
+import json
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterable, List, Optional, Tuple, Union
+from datetime import datetime, timezone
+from func_adl_request_broker.db_access import ADLRequestInfo, DBAccess, MAX_LIST_PAGE, hash_from_arg, log_excerpt, log_text
+
+# Each file of a request gets its position in the list (seq), and is stored as its JSON, so the same
+# file can't be added twice.
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS requests (
+    hash TEXT PRIMARY KEY,
+    done INTEGER,
+    jobs INTEGER,
+    phase TEXT,
+    message TEXT,
+    log TEXT,
+    log_ref TEXT,
+    nfiles INTEGER NOT NULL DEFAULT 0,
+    created REAL
+);
+CREATE INDEX IF NOT EXISTS requests_phase ON requests (phase);
+CREATE INDEX IF NOT EXISTS requests_done ON requests (done);
+CREATE TABLE IF NOT EXISTS files (
+    hash TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    entry TEXT NOT NULL,
+    PRIMARY KEY (hash, seq),
+    UNIQUE (hash, entry)
+);
+CREATE TABLE IF NOT EXISTS crash_logs (
+    hash TEXT PRIMARY KEY,
+    log BLOB NOT NULL
+);
+'''
+
+# Columns of the requests table, in ADLRequestInfo order (less the file list)
+_COLUMNS = ('done', 'jobs', 'phase', 'hash', 'message', 'log', 'log_ref')
+
+
+class SQLiteDBAccess(DBAccess):
+    r'''
+    Keeps the requests in a SQLite file, in WAL mode so readers are never held up by a writer. Every update
+    is a single IMMEDIATE transaction, so the ingester, state updater and web front ends can all run on the
+    one node against the same file.
+    '''
+    def __init__(self, path:str):
+        r'''
+        Arguments:
+            path            The SQLite file. It is created if it isn't there.
+        '''
+        # One connection for the whole process, used by one thread at a time.
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, timeout=30.0, isolation_level=None, check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+        self._connection.executescript(_SCHEMA)
+        # Files made before requests had a created time
+        if 'created' not in [c[1] for c in self._connection.execute('PRAGMA table_info(requests)')]:
+            self._connection.execute('ALTER TABLE requests ADD COLUMN created REAL')
+
+    @contextmanager
+    def _transaction(self):
+        'Run the block as one transaction, taking the write lock at the start so it can not deadlock'
+        with self._lock:
+            self._connection.execute('BEGIN IMMEDIATE')
+            try:
+                yield self._connection
+            except BaseException:
+                self._connection.execute('ROLLBACK')
+                raise
+            self._connection.execute('COMMIT')
+
+    def _read(self, c:sqlite3.Connection, hash:str, fields:Optional[Iterable[str]] = None,
+              files_from:int = 0, max_files:Optional[int] = None) -> Optional[ADLRequestInfo]:
+        row = c.execute(f'SELECT {", ".join(_COLUMNS)} FROM requests WHERE hash = ?', (hash,)).fetchone()
+        if row is None:
+            return None
+        d = dict(zip(_COLUMNS, row))
+        d['done'] = None if d['done'] is None else bool(d['done'])
+        if fields is None or 'files' in fields:
+            d['files'] = [json.loads(e) for e, in c.execute('SELECT entry FROM files WHERE hash = ? ORDER BY seq LIMIT ? OFFSET ?',
+                                                            (hash, -1 if max_files is None else max_files, files_from))]
+        if fields is not None:
+            d = {k: v for k, v in d.items() if k in fields or k == 'hash'}
+        return ADLRequestInfo(**d)
+
+    def _insert(self, c:sqlite3.Connection, hash:str, results:ADLRequestInfo):
+        c.execute('INSERT INTO requests (hash, done, jobs, phase, message, log, log_ref, created) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                  (hash, results.done, results.jobs, results.phase, results.message or None, results.log or None, results.log_ref or None,
+                   time.time()))
+        self._add(c, hash, results.files or [])
+
+    def _add(self, c:sqlite3.Connection, hash:str, entries) -> int:
+        'Append the files not already there, and return how many that was'
+        n_added = 0
+        for e in entries:
+            r = c.execute('INSERT OR IGNORE INTO files (hash, seq, entry) VALUES (?, (SELECT nfiles FROM requests WHERE hash = ?), ?)',
+                          (hash, hash, json.dumps(list(e) if isinstance(e, tuple) else e)))
+            if r.rowcount > 0:
+                c.execute('UPDATE requests SET nfiles = nfiles + 1 WHERE hash = ?', (hash,))
+                n_added += 1
+        return n_added
+
+    def _mark_done(self, c:sqlite3.Connection, hash:str):
+        c.execute('UPDATE requests SET done = 1 WHERE hash = ? AND jobs >= 0 AND nfiles >= jobs', (hash,))
+
+    def lookup_results(self, arg:Union[str,ast.AST], fields:Optional[Iterable[str]] = None,
+                       files_from:int = 0, max_files:Optional[int] = None) -> Optional[ADLRequestInfo]:
+        # Readers don't need a transaction - WAL gives each statement a consistent view. The two selects
+        # can see different versions, but files are only ever added.
+        with self._lock:
+            return self._read(self._connection, hash_from_arg(arg), fields, files_from, max_files)
+
+    def save_results(self, arg:str, results:ADLRequestInfo) -> ADLRequestInfo:
+        hash = hash_from_arg(arg)
+        with self._transaction() as c:
+            c.execute('DELETE FROM requests WHERE hash = ?', (hash,))
+            c.execute('DELETE FROM files WHERE hash = ?', (hash,))
+            self._insert(c, hash, results)
+            return self._read(c, hash)
+
+    def claim_request(self, arg:Union[str,ast.AST], results:ADLRequestInfo,
+                      files_from:int = 0, max_files:Optional[int] = None) -> Tuple[ADLRequestInfo, bool]:
+        hash = hash_from_arg(arg)
+        with self._transaction() as c:
+            info = self._read(c, hash, files_from=files_from, max_files=max_files)
+            if info is not None:
+                return info, False
+            self._insert(c, hash, results)
+            return self._read(c, hash), True
+
+    def claim_requests(self, args:List[Union[str,ast.AST]], results:ADLRequestInfo) -> List[Tuple[ADLRequestInfo, bool]]:
+        claims = []
+        with self._transaction() as c:
+            for hash in (hash_from_arg(a) for a in args):
+                info = self._read(c, hash)
+                if info is None:
+                    self._insert(c, hash, results)
+                    claims.append((self._read(c, hash), True))
+                else:
+                    claims.append((info, False))
+        return claims
+
+    def add_files(self, files:Dict[str, List[Tuple[str,str]]]) -> int:
+        n_found = 0
+        with self._transaction() as c:
+            for hash, entries in files.items():
+                if c.execute('SELECT 1 FROM requests WHERE hash = ?', (hash,)).fetchone() is None:
+                    continue
+                n_found += 1
+                self._add(c, hash, entries)
+                self._mark_done(c, hash)
+        return n_found
+
+    def set_phase(self, arg:Union[str,ast.AST], phase:str) -> bool:
+        with self._transaction() as c:
+            return c.execute('UPDATE requests SET phase = ? WHERE hash = ?', (phase, hash_from_arg(arg))).rowcount > 0
+
+    def set_jobs(self, arg:Union[str,ast.AST], njobs:int) -> bool:
+        hash = hash_from_arg(arg)
+        with self._transaction() as c:
+            found = c.execute('UPDATE requests SET jobs = ? WHERE hash = ?', (njobs, hash)).rowcount > 0
+            self._mark_done(c, hash)
+            return found
+
+    def update_status(self, arg:Union[str,ast.AST], phase:Optional[str] = None, njobs:Optional[int] = None) -> bool:
+        hash = hash_from_arg(arg)
+        with self._transaction() as c:
+            found = c.execute('UPDATE requests SET phase = COALESCE(?, phase), jobs = COALESCE(?, jobs) WHERE hash = ?',
+                              (phase, njobs, hash)).rowcount > 0
+            if njobs is not None:
+                self._mark_done(c, hash)
+            return found
+
+    def list_requests(self, phase:Optional[str] = None, min_age:Optional[float] = None, max_age:Optional[float] = None,
+                      cursor:Optional[str] = None, limit:int = 50) -> Tuple[List[dict], Optional[str]]:
+        # Newest first by rowid, so with a phase this walks the requests_phase index (which ends in rowid)
+        where, args = [], []
+        if phase is not None:
+            where.append('phase = ?')
+            args.append(phase)
+        if min_age is not None:
+            where.append('created <= ?')
+            args.append(time.time() - min_age)
+        if max_age is not None:
+            where.append('created >= ?')
+            args.append(time.time() - max_age)
+        if cursor is not None:
+            where.append('rowid < ?')
+            args.append(int(cursor))
+        limit = max(1, min(limit, MAX_LIST_PAGE))
+        sql = f'SELECT rowid, hash, phase, done, jobs, message, created FROM requests {"WHERE " + " AND ".join(where) if where else ""} ORDER BY rowid DESC LIMIT ?'
+        with self._lock:
+            rows = self._connection.execute(sql, args + [limit + 1]).fetchall()
+        page = [{'hash': h, 'phase': p, 'done': None if done is None else bool(done), 'jobs': jobs, 'message': message,
+                 'created': None if created is None else datetime.fromtimestamp(created, timezone.utc).isoformat()}
+                for _, h, p, done, jobs, message, created in rows[:limit]]
+        return page, (str(rows[limit - 1][0]) if len(rows) > limit else None)
+
+    def mark_crashed(self, arg:Union[str,ast.AST], message:str, log, phase:Optional[str] = None, njobs:Optional[int] = None) -> bool:
+        hash = hash_from_arg(arg)
+        text = log_text(log)
+        with self._transaction() as c:
+            r = c.execute('UPDATE requests SET done = 1, message = ?, log = ?, log_ref = ?, phase = COALESCE(?, phase), jobs = COALESCE(?, jobs) '
+                          'WHERE hash = ?', (message, log_excerpt(text), hash, phase, njobs, hash))
+            if r.rowcount == 0:
+                return False
+            c.execute('INSERT OR REPLACE INTO crash_logs (hash, log) VALUES (?, ?)', (hash, text.encode('utf-8')))
+            return True
+
+    def open_log(self, arg:Union[str,ast.AST]):
+        with self._lock:
+            row = self._connection.execute('SELECT log FROM crash_logs WHERE hash = ?', (hash_from_arg(arg),)).fetchone()
+        return None if row is None else io.BytesIO(row[0])
+
+    def close(self):
+        'Close the file'
+        with self._lock:
+            self._connection.close()
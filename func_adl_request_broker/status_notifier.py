@@ -0,0 +1,101 @@
+# Fan out of request status changes. The state updater publishes an event on a RabbitMQ fanout exchange
+# each time it changes a request, and every web worker listens on that exchange and hands the events
+# to whichever of its clients are waiting on that request.
+import json
+import logging
+import queue
+import threading
+import time
+from typing import Callable, Dict, List, Optional
+import pika
+from func_adl_request_broker.metrics import MESSAGES_PUBLISHED
+
+# The fanout exchange status events are published on
+STATUS_EXCHANGE = 'status_updates'
+
+
+def declare_status_exchange(channel):
+    'Declare the exchange status events go out on'
+    channel.exchange_declare(exchange=STATUS_EXCHANGE, exchange_type='fanout')
+
+
+def publish_status_event(channel, hash:str, event:str, correlation_id:Optional[str] = None, **info):
+    r'''
+    Tell anyone who is listening that a request has changed.
+
+    Arguments:
+        channel             The channel to publish on
+        hash                The request's hash
+        event               What happened: 'file', 'phase', 'njobs', or 'crashed'
+        correlation_id      The correlation id of the message that caused the change, if it had one
+        info                The details (file and treename, phase, njobs, message)
+    '''
+    channel.basic_publish(exchange=STATUS_EXCHANGE, routing_key='', body=json.dumps(dict(info, hash=hash, event=event)),
+                          properties=pika.BasicProperties(correlation_id=correlation_id) if correlation_id is not None else None)
+    MESSAGES_PUBLISHED.inc(queue=STATUS_EXCHANGE)
+
+
+class StatusNotifier:
+    r'''
+    Hands status events out to the threads waiting on them. Each waiter subscribes to a request hash and
+    gets a queue the events for that hash are put on.
+    '''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscribers: Dict[str, List[queue.Queue]] = {}
+
+    def subscribe(self, hash:str) -> queue.Queue:
+        'Start collecting the events for a request'
+        q = queue.Queue()
+        with self._lock:
+            self._subscribers.setdefault(hash, []).append(q)
+        return q
+
+    def unsubscribe(self, hash:str, q:queue.Queue):
+        'Stop collecting events'
+        with self._lock:
+            subs = self._subscribers.get(hash, [])
+            if q in subs:
+                subs.remove(q)
+            if len(subs) == 0:
+                self._subscribers.pop(hash, None)
+
+    def notify(self, event:dict):
+        'Pass an event to everyone waiting on its request'
+        with self._lock:
+            subs = list(self._subscribers.get(event['hash'], []))
+        for q in subs:
+            q.put(event)
+
+
+class RabbitStatusListener(threading.Thread):
+    r'''
+    Background thread that listens to the status exchange and passes every event to a StatusNotifier. It has
+    its own connection (pika connections can't be shared between threads) and reconnects if it loses it.
+    '''
+    def __init__(self, notifier:StatusNotifier, host:str, user:str, password:str, connection_factory:Optional[Callable] = None):
+        threading.Thread.__init__(self, name='status-listener', daemon=True)
+        self._notifier = notifier
+        self._parameters = pika.ConnectionParameters(host=host, credentials=pika.PlainCredentials(user, password))
+        self._connection_factory = connection_factory if connection_factory is not None else pika.BlockingConnection
+
+    def _on_event(self, ch, method, properties, body):
+        # A bad message must not end the thread - no one would hear about any changes after it.
+        try:
+            self._notifier.notify(json.loads(body))
+        except (ValueError, KeyError, TypeError) as e:
+            logging.warning(f'Ignoring a malformed status event ({e}): {body[:200]!r}')
+
+    def run(self):
+        while True:
+            try:
+                connection = self._connection_factory(self._parameters)
+                channel = connection.channel()
+                declare_status_exchange(channel)
+                result = channel.queue_declare(queue='', exclusive=True)
+                channel.queue_bind(exchange=STATUS_EXCHANGE, queue=result.method.queue)
+                channel.basic_consume(queue=result.method.queue, on_message_callback=self._on_event, auto_ack=True)
+                channel.start_consuming()
+            except pika.exceptions.AMQPError as e:
+                logging.warning(f'Lost connection to the status exchange ({e}), reconnecting.')
+                time.sleep(1.0)
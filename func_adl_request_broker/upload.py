@@ -0,0 +1,154 @@
+# Reading query uploads without holding more of them in memory than we have to: compressed bodies are
+# decompressed as they are read, and a per-worker budget caps the bytes all the uploads in flight can use.
+import gzip
+import io
+import threading
+import time
+from contextlib import contextmanager
+from typing import Optional
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+class UploadTooLarge(Exception):
+    'The upload is bigger than we accept at all (HTTP 413)'
+    pass
+
+
+class ServerBusy(Exception):
+    'Taking on this upload would go over the in-flight byte budget - try again later (HTTP 503)'
+    pass
+
+
+class UnsupportedEncoding(Exception):
+    'The upload is compressed in a way we can not read (HTTP 415)'
+    pass
+
+
+def content_encodings() -> list:
+    'The Content-Encodings we can read'
+    return ['identity', 'gzip'] + (['zstd'] if zstandard is not None else [])
+
+
+def decompressing_reader(stream, encoding:Optional[str]):
+    r'''
+    Wrap a stream so that reading it returns the decompressed data, a piece at a time.
+
+    Arguments:
+        stream              The body, as sent
+        encoding            The Content-Encoding of the body: None, identity, gzip or zstd
+
+    Exceptions:
+        UnsupportedEncoding If we don't know how to decompress it
+    '''
+    encoding = (encoding or 'identity').strip().lower()
+    if encoding == 'identity':
+        return stream
+    if encoding in ('gzip', 'x-gzip'):
+        return gzip.GzipFile(fileobj=stream, mode='rb')
+    if encoding == 'zstd' and zstandard is not None:
+        return zstandard.ZstdDecompressor().stream_reader(stream)
+    raise UnsupportedEncoding(f'Unable to read a body with Content-Encoding {encoding} - use one of {", ".join(content_encodings())}')
+
+
+class ByteBudget:
+    r'''
+    The number of bytes the uploads being read by this worker may hold in memory between them. An upload
+    takes what it needs as it reads, and gives it all back when it is done.
+    '''
+    def __init__(self, max_bytes:int):
+        self.max_bytes = max_bytes
+        self._used = 0
+        self._lock = threading.Lock()
+
+    @property
+    def used(self) -> int:
+        return self._used
+
+    def acquire(self, n:int):
+        'Take n bytes of the budget, or raise ServerBusy if they are not there'
+        with self._lock:
+            if self._used + n > self.max_bytes:
+                raise ServerBusy(f'Too many uploads in progress ({self._used} bytes in flight) - try again later')
+            self._used += n
+
+    def release(self, n:int):
+        with self._lock:
+            self._used -= n
+
+    @contextmanager
+    def reserve(self, n:int = 0):
+        'Take n bytes now, and give back those and any more taken through the reservation at the end of the block'
+        r = Reservation(self)
+        r.add(n)
+        try:
+            yield r
+        finally:
+            self.release(r.bytes)
+
+
+class Reservation:
+    'The part of a ByteBudget one upload holds'
+    def __init__(self, budget:ByteBudget):
+        self._budget = budget
+        self.bytes = 0
+
+    def add(self, n:int):
+        self._budget.acquire(n)
+        self.bytes += n
+
+
+class CopyingReader:
+    r'''
+    Reads a stream for pickle.load, keeping a copy of everything read (the query is forwarded as it was
+    sent). Stops with UploadTooLarge once more than max_size bytes have been read, and charges anything
+    beyond what was reserved up front to the reservation. read_seconds is the time spent waiting on the
+    stream (and decompressing it), as opposed to unpickling. Pieces read some other way (off an asyncio
+    stream, say) can be passed to keep.
+    '''
+    def __init__(self, stream, max_size:int, reservation:Optional[Reservation] = None):
+        self._stream = stream
+        self._max_size = max_size
+        self._reservation = reservation
+        self._kept = io.BytesIO()
+        self.size = 0
+        self.read_seconds = 0.0
+
+    @property
+    def data(self) -> bytes:
+        'Everything read so far. This is the buffer itself, not a copy of it, so it can be sent on as it is.'
+        return self._kept.getvalue()
+
+    def keep(self, b:bytes) -> bytes:
+        'Check a piece of the upload against the limits, and add it to data'
+        if self.size + len(b) > self._max_size:
+            raise UploadTooLarge(f'The query is larger than the {self._max_size} bytes we accept')
+        if self._reservation is not None and self.size + len(b) > self._reservation.bytes:
+            self._reservation.add(self.size + len(b) - self._reservation.bytes)
+        self._kept.write(b)
+        self.size += len(b)
+        return b
+
+    def read(self, n:int = -1) -> bytes:
+        if n is None or n < 0:
+            # Everything that is left, a piece at a time so the size limit is checked as we go
+            while len(self.read(65536)) > 0:
+                pass
+            return b''
+        start = time.perf_counter()
+        b = self._stream.read(n)
+        self.read_seconds += time.perf_counter() - start
+        return self.keep(b)
+
+    def readline(self) -> bytes:
+        # pickle only asks for lines in the old text protocols
+        line = bytearray()
+        while not line.endswith(b'\n'):
+            c = self.read(1)
+            if len(c) == 0:
+                break
+            line += c
+        return bytes(line)
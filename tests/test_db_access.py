@@ -2,10 +2,11 @@
 # WARNING: Make sure this is running first:
 #  docker run --rm -it -v mongodata_test:/data/db -p:27000:27017  mongo:latest
 
-from func_adl_request_broker.db_access import FuncADLDBAccess, ADLRequestInfo
+from func_adl_request_broker.db_access import FuncADLDBAccess, ADLRequestInfo, KEEP_FOREVER, Retention, retention_from_env
 import pytest
 import ast
 import pymongo
+import threading
 
 
 @pytest.fixture
@@ -14,6 +15,8 @@ def empty_db():
     client = pymongo.MongoClient(db_server)
     db = client.adl_queries
     db.drop_collection('query_collection')
+    db.drop_collection('crash_logs.files')
+    db.drop_collection('crash_logs.chunks')
     yield db_server
 
 def test_hash_not_there(empty_db):
@@ -32,6 +35,14 @@ def test_hash_save (empty_db):
     assert r.jobs == 5
     assert r.phase == 'downloading'
 
+def test_duplicate_hashes_removed(empty_db):
+    collection = pymongo.MongoClient(empty_db).adl_queries.query_collection
+    collection.insert_many([{'hash': 'bogus', 'jobs': 1}, {'hash': 'bogus', 'jobs': 2}, {'hash': 'bogus2', 'jobs': 3}])
+    db = FuncADLDBAccess(empty_db)
+    assert collection.count_documents({}) == 2
+    assert db.lookup_results('bogus').jobs == 1
+    assert collection.index_information()['hash_1']['unique']
+
 def test_hash_update(empty_db):
     db = FuncADLDBAccess(empty_db)
     db.save_results('bogus1', ADLRequestInfo(done=False, files=['file://root1.root'], jobs=5, phase='running', hash=''))
@@ -60,3 +71,289 @@ def test_ast_is_there(empty_db):
     assert r.files[0] == 'file://root1.root'
     assert r.jobs == 5
     assert r.phase == 'downloading'
+
+def new_request(db, hash, jobs=-1):
+    db.save_results(hash, ADLRequestInfo(done=False, files=[], jobs=jobs, phase='waiting_for_data', hash='', log=None, message=None))
+
+def test_add_file(empty_db):
+    db = FuncADLDBAccess(empty_db)
+    new_request(db, 'bogus', jobs=2)
+    assert db.add_file('bogus', 'file://root1.root', 'tree')
+    r = db.lookup_results('bogus')
+    assert r.files == [['file://root1.root', 'tree']]
+    assert r.done == False
+
+def test_add_file_twice(empty_db):
+    db = FuncADLDBAccess(empty_db)
+    new_request(db, 'bogus', jobs=2)
+    db.add_file('bogus', 'file://root1.root', 'tree')
+    db.add_file('bogus', 'file://root1.root', 'tree')
+    r = db.lookup_results('bogus')
+    assert len(r.files) == 1
+
+def test_add_file_keeps_order(empty_db):
+    db = FuncADLDBAccess(empty_db)
+    new_request(db, 'bogus', jobs=3)
+    for f in ['c', 'a', 'b']:
+        db.add_file('bogus', f, 'tree')
+    r = db.lookup_results('bogus')
+    assert [f for f, _ in r.files] == ['c', 'a', 'b']
+
+def test_add_file_last_one_done(empty_db):
+    db = FuncADLDBAccess(empty_db)
+    new_request(db, 'bogus', jobs=2)
+    db.add_file('bogus', 'file://root1.root', 'tree')
+    db.add_file('bogus', 'file://root2.root', 'tree')
+    assert db.lookup_results('bogus').done == True
+
+def test_add_file_jobs_unknown_not_done(empty_db):
+    db = FuncADLDBAccess(empty_db)
+    new_request(db, 'bogus')
+    db.add_file('bogus', 'file://root1.root', 'tree')
+    assert db.lookup_results('bogus').done == False
+
+def test_add_file_not_there(empty_db):
+    db = FuncADLDBAccess(empty_db)
+    assert not db.add_file('bogus', 'file://root1.root', 'tree')
+    assert db.lookup_results('bogus') is None
+
+def test_set_jobs_after_files_done(empty_db):
+    db = FuncADLDBAccess(empty_db)
+    new_request(db, 'bogus')
+    db.add_file('bogus', 'file://root1.root', 'tree')
+    assert db.set_jobs('bogus', 1)
+    r = db.lookup_results('bogus')
+    assert r.jobs == 1
+    assert r.done == True
+
+def test_set_jobs_no_file_list(empty_db):
+    db = FuncADLDBAccess(empty_db)
+    db.save_results('bogus', ADLRequestInfo(done=False, files=None, jobs=-1, phase='waiting_for_data', hash=''))
+    db._query_collection.update_one({'hash': 'bogus'}, {'$unset': {'files': ''}})
+    assert db.update_status('bogus', phase='running', njobs=1)
+    assert db.lookup_results('bogus').done == False
+    assert db.add_file('bogus', 'file://root1.root', 'tree')
+    assert db.lookup_results('bogus').done == True
+
+def test_set_phase(empty_db):
+    db = FuncADLDBAccess(empty_db)
+    new_request(db, 'bogus')
+    assert db.set_phase('bogus', 'running')
+    assert db.lookup_results('bogus').phase == 'running'
+
+def test_update_status_one_write(empty_db):
+    db = FuncADLDBAccess(empty_db)
+    new_request(db, 'bogus')
+    db.add_file('bogus', 'file://root1.root', 'tree')
+    assert db.update_status('bogus', phase='running', njobs=1)
+    r = db.lookup_results('bogus')
+    assert (r.phase, r.jobs, r.done) == ('running', 1, True)
+    assert not db.update_status('bogus2', phase='running')
+
+def test_mark_crashed(empty_db):
+    db = FuncADLDBAccess(empty_db)
+    new_request(db, 'bogus')
+    assert db.mark_crashed('bogus', 'it broke', 'log line')
+    r = db.lookup_results('bogus')
+    assert r.done == True
+    assert r.message == 'it broke'
+    assert r.log == 'log line'
+
+def test_mark_crashed_with_status(empty_db):
+    db = FuncADLDBAccess(empty_db)
+    new_request(db, 'bogus')
+    assert db.mark_crashed('bogus', 'it broke', 'log line', phase='running', njobs=3)
+    r = db.lookup_results('bogus')
+    assert (r.done, r.phase, r.jobs) == (True, 'running', 3)
+
+def test_claim_new(empty_db):
+    db = FuncADLDBAccess(empty_db)
+    r, created = db.claim_request('bogus', ADLRequestInfo(done=False, files=[], jobs=-1, phase='waiting_for_data', hash='', log=None, message=None))
+    assert created
+    assert r.hash == 'bogus'
+    assert r.phase == 'waiting_for_data'
+    assert db.lookup_results('bogus') is not None
+
+def test_claim_existing(empty_db):
+    db = FuncADLDBAccess(empty_db)
+    new_request(db, 'bogus', jobs=5)
+    r, created = db.claim_request('bogus', ADLRequestInfo(done=False, files=[], jobs=-1, phase='waiting_for_data', hash='', log=None, message=None))
+    assert not created
+    assert r.jobs == 5
+
+def test_claim_existing_files_page(empty_db):
+    db = FuncADLDBAccess(empty_db)
+    new_request(db, 'bogus', jobs=3)
+    db.add_files({'bogus': [(f, 'tree') for f in 'abc']})
+    r, created = db.claim_request('bogus', ADLRequestInfo(done=False, files=[], jobs=-1, phase='waiting_for_data'), files_from=1, max_files=1)
+    assert not created
+    assert r.files == [['b', 'tree']]
+
+def test_claim_twice_only_one_created(empty_db):
+    db = FuncADLDBAccess(empty_db)
+    info = ADLRequestInfo(done=False, files=[], jobs=-1, phase='waiting_for_data', hash='', log=None, message=None)
+    start = threading.Barrier(8)
+    created = []
+    def claim():
+        start.wait()
+        created.append(db.claim_request('bogus', info)[1])
+    threads = [threading.Thread(target=claim) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert sorted(created) == [False]*7 + [True]
+
+def test_claim_many_write_error(empty_db, monkeypatch):
+    db = FuncADLDBAccess(empty_db)
+    info = ADLRequestInfo(done=False, files=[], jobs=-1, phase='waiting_for_data', hash='', log=None, message=None)
+    def bulk_write(ops, ordered=True):
+        raise pymongo.errors.BulkWriteError({'writeErrors': [{'index': 0, 'code': 121, 'errmsg': 'validation failed'}], 'upserted': []})
+    monkeypatch.setattr(db._query_collection, 'bulk_write', bulk_write)
+    with pytest.raises(pymongo.errors.BulkWriteError):
+        db.claim_requests(['bogus1', 'bogus2'], info)
+
+def test_claim_many_lost_race(empty_db, monkeypatch):
+    db = FuncADLDBAccess(empty_db)
+    info = ADLRequestInfo(done=False, files=[], jobs=-1, phase='waiting_for_data', hash='', log=None, message=None)
+    def bulk_write(ops, ordered=True):
+        # Someone else got bogus1 in first
+        db.save_results('bogus1', info)
+        db._query_collection.insert_one({'hash': 'bogus2'})
+        raise pymongo.errors.BulkWriteError({'writeErrors': [{'index': 0, 'code': 11000, 'errmsg': 'duplicate key'}],
+                                             'upserted': [{'index': 1, '_id': None}]})
+    monkeypatch.setattr(db._query_collection, 'bulk_write', bulk_write)
+    assert [created for _, created in db.claim_requests(['bogus1', 'bogus2'], info)] == [False, True]
+
+def test_lookup_status_no_files_or_log(empty_db):
+    db = FuncADLDBAccess(empty_db)
+    db.save_results('bogus', ADLRequestInfo(done=True, files=['file://root1.root'], jobs=1, phase='done', hash='', log='a long log', message='crashed'))
+    r = db.lookup_status('bogus')
+    assert r.done == True
+    assert r.phase == 'done'
+    assert r.message == 'crashed'
+    assert r.files is None
+    assert r.log is None
+
+def test_lookup_fields(empty_db):
+    db = FuncADLDBAccess(empty_db)
+    db.save_results('bogus', ADLRequestInfo(done=False, files=['file://root1.root'], jobs=5, phase='downloading', hash=''))
+    r = db.lookup_results('bogus', fields=['jobs'])
+    assert r.jobs == 5
+    assert r.hash == 'bogus'
+    assert r.phase is None
+
+def test_indexes_created(empty_db):
+    FuncADLDBAccess(empty_db)
+    keys = [list(i['key'].keys()) for i in pymongo.MongoClient(empty_db).adl_queries.query_collection.list_indexes()]
+    assert ['hash'] in keys
+    assert ['phase', '_id'] in keys
+    assert ['done'] in keys
+    # The compound index covers lookups by phase alone
+    assert ['phase'] not in keys
+
+def test_crash_log_stored_on_side(empty_db):
+    db = FuncADLDBAccess(empty_db)
+    new_request(db, 'bogus')
+    log = [f'line {i}' for i in range(100)]
+    db.mark_crashed('bogus', 'it broke', log)
+    r = db.lookup_results('bogus')
+    assert r.log_ref == 'bogus'
+    assert r.log.endswith('line 99')
+    assert 'line 10\n' not in r.log
+    assert db.open_log(r.log_ref).read().decode('utf-8') == '\n'.join(log)
+
+def test_crash_log_not_there(empty_db):
+    db = FuncADLDBAccess(empty_db)
+    assert db.open_log('bogus') is None
+    assert not db.mark_crashed('bogus', 'it broke', 'log line')
+    assert db.open_log('bogus') is None
+    # Not even uploaded and then deleted
+    assert pymongo.MongoClient(empty_db).adl_queries['crash_logs.files'].count_documents({}) == 0
+
+def test_claim_many(empty_db):
+    db = FuncADLDBAccess(empty_db)
+    new_request(db, 'bogus2', jobs=5)
+    r = db.claim_requests(['bogus1', 'bogus2', 'bogus3'], ADLRequestInfo(done=False, files=[], jobs=-1, phase='waiting_for_data', hash='', log=None, message=None))
+    assert [info.hash for info, _ in r] == ['bogus1', 'bogus2', 'bogus3']
+    assert [created for _, created in r] == [True, False, True]
+    assert r[1][0].jobs == 5
+    assert db.lookup_results('bogus3') is not None
+
+def test_add_files_from_saved_list_not_duplicated(empty_db):
+    db = FuncADLDBAccess(empty_db)
+    db.save_results('bogus', ADLRequestInfo(done=False, files=[['a', 'tree']], jobs=3, phase='running', hash=''))
+    db.add_files({'bogus': [('a', 'tree'), ('b', 'tree')]})
+    assert db.lookup_results('bogus').files == [['a', 'tree'], ['b', 'tree']]
+
+def test_lookup_files_page(empty_db):
+    db = FuncADLDBAccess(empty_db)
+    new_request(db, 'bogus', jobs=5)
+    for f in ['a', 'b', 'c', 'd', 'e']:
+        db.add_file('bogus', f, 'tree')
+    r = db.lookup_results('bogus', files_from=1, max_files=2)
+    assert [f for f, _ in r.files] == ['b', 'c']
+    assert r.done == True
+    assert [f for f, _ in db.lookup_results('bogus', files_from=3).files] == ['d', 'e']
+    assert db.lookup_results('bogus', files_from=5).files == []
+
+def test_retention_indexes(empty_db):
+    db = FuncADLDBAccess(empty_db, Retention(done=3600, crashed=600, unfinished=None, touch_interval=3600))
+    indexes = pymongo.MongoClient(empty_db).adl_queries.query_collection.index_information()
+    assert indexes['expire_done']['expireAfterSeconds'] == 3600
+    assert indexes['expire_crashed']['expireAfterSeconds'] == 600
+    assert 'expire_unfinished' not in indexes
+
+def test_retention_left_when_not_configured(empty_db):
+    FuncADLDBAccess(empty_db, Retention(done=3600, touch_interval=3600))
+    db = FuncADLDBAccess(empty_db, Retention(touch_interval=3600))
+    assert pymongo.MongoClient(empty_db).adl_queries.query_collection.index_information()['expire_done']['expireAfterSeconds'] == 3600
+    # ... and it still keeps the last access times up to date for it
+    new_request(db, 'bogus')
+    db.lookup_results('bogus')
+    assert db.flush_touches() == 1
+
+def test_retention_from_env(monkeypatch):
+    monkeypatch.setenv('RETAIN_DONE_SECONDS', '3600')
+    monkeypatch.setenv('RETAIN_CRASHED_SECONDS', 'forever')
+    monkeypatch.delenv('RETAIN_UNFINISHED_SECONDS', raising=False)
+    assert retention_from_env()[:3] == (3600, KEEP_FOREVER, None)
+
+def test_retention_index_dropped(empty_db):
+    FuncADLDBAccess(empty_db, Retention(done=3600, touch_interval=3600))
+    FuncADLDBAccess(empty_db, Retention(done=KEEP_FOREVER))
+    assert 'expire_done' not in pymongo.MongoClient(empty_db).adl_queries.query_collection.index_information()
+
+def test_lookup_touches_later(empty_db):
+    db = FuncADLDBAccess(empty_db, Retention(done=3600, touch_interval=3600))
+    new_request(db, 'bogus')
+    collection = pymongo.MongoClient(empty_db).adl_queries.query_collection
+    created = collection.find_one({'hash': 'bogus'})['last_access']
+    db.lookup_results('bogus')
+    db.lookup_results('bogus2')
+    assert collection.find_one({'hash': 'bogus'})['last_access'] == created
+    assert db.flush_touches() == 1
+    assert collection.find_one({'hash': 'bogus'})['last_access'] >= created
+    assert db.flush_touches() == 0
+
+def test_crash_time_recorded(empty_db):
+    db = FuncADLDBAccess(empty_db)
+    new_request(db, 'bogus')
+    db.mark_crashed('bogus', 'it broke', 'log line')
+    d = pymongo.MongoClient(empty_db).adl_queries.query_collection.find_one({'hash': 'bogus'})
+    assert d['crashed'] == True
+    assert d['crashed_at'] is not None
+
+def test_list_requests_paged(empty_db):
+    db = FuncADLDBAccess(empty_db)
+    for i in range(5):
+        db.save_results(f'bogus{i}', ADLRequestInfo(done=False, files=[], jobs=1, phase='running' if i % 2 else 'waiting_for_data', hash=''))
+    page, cursor = db.list_requests(limit=2)
+    assert [r['hash'] for r in page] == ['bogus4', 'bogus3']
+    page, cursor = db.list_requests(cursor=cursor, limit=2)
+    assert [r['hash'] for r in page] == ['bogus2', 'bogus1']
+    page, cursor = db.list_requests(cursor=cursor, limit=2)
+    assert [r['hash'] for r in page] == ['bogus0']
+    assert cursor is None
+    assert [r['hash'] for r in db.list_requests(phase='running')[0]] == ['bogus3', 'bogus1']
+    assert db.list_requests(min_age=3600)[0] == []
@@ -0,0 +1,180 @@
+# Test the request stores that don't need a db server running: in memory and SQLite.
+from func_adl_request_broker.db_access import ADLRequestInfo, DBAccess, open_db
+from func_adl_request_broker.memory_db_access import MemoryDBAccess
+from func_adl_request_broker.sqlite_db_access import SQLiteDBAccess
+import threading
+import uuid
+import pytest
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def db(request, tmp_path):
+    if request.param == 'memory':
+        return open_db(f'memory://{uuid.uuid4()}')
+    return open_db(f'sqlite://{tmp_path}/requests.db')
+
+def new_request(db, hash, jobs=-1):
+    db.save_results(hash, ADLRequestInfo(done=False, files=[], jobs=jobs, phase='waiting_for_data', hash='', log=None, message=None))
+
+def test_scheme_picks_backend(tmp_path, monkeypatch):
+    assert isinstance(open_db('memory://'), MemoryDBAccess)
+    assert isinstance(open_db(f'sqlite://{tmp_path}/r.db'), SQLiteDBAccess)
+    # Don't actually go looking for a MongoDB server
+    monkeypatch.setattr('func_adl_request_broker.db_access.FuncADLDBAccess', lambda url: ('mongo', url))
+    assert open_db('mongodb://localhost:27000/') == ('mongo', 'mongodb://localhost:27000/')
+    assert open_db('mongo-svc:27017') == ('mongo', 'mongo-svc:27017')
+    assert open_db('localhost') == ('mongo', 'localhost')
+    with pytest.raises(ValueError):
+        open_db('postgres://localhost/')
+
+def test_store_is_abstract():
+    with pytest.raises(TypeError):
+        DBAccess()
+    class NoLogs(MemoryDBAccess):
+        open_log = DBAccess.open_log
+    with pytest.raises(TypeError):
+        NoLogs()
+
+def test_memory_shared_by_name():
+    assert open_db('memory://shared') is open_db('memory://shared')
+
+def test_sqlite_shared_between_opens(tmp_path):
+    new_request(open_db(f'sqlite://{tmp_path}/r.db'), 'bogus', jobs=3)
+    assert open_db(f'sqlite://{tmp_path}/r.db').lookup_results('bogus').jobs == 3
+
+def test_not_there(db):
+    assert db.lookup_results('bogus') is None
+
+def test_save(db):
+    db.save_results('bogus', ADLRequestInfo(done=False, files=['file://root1.root'], jobs=5, phase='downloading', hash=''))
+    r = db.lookup_results('bogus')
+    assert r.done == False
+    assert r.files == ['file://root1.root']
+    assert r.jobs == 5
+    assert r.phase == 'downloading'
+    assert r.hash == 'bogus'
+
+def test_add_files_in_order_once(db):
+    new_request(db, 'bogus', jobs=3)
+    for f in ['c', 'a', 'c', 'b']:
+        assert db.add_file('bogus', f, 'tree')
+    r = db.lookup_results('bogus')
+    assert r.files == [['c', 'tree'], ['a', 'tree'], ['b', 'tree']]
+    assert r.done == True
+
+def test_add_files_many(db):
+    new_request(db, 'bogus1', jobs=2)
+    new_request(db, 'bogus2')
+    assert db.add_files({'bogus1': [('a', 'tree'), ('b', 'tree')], 'bogus2': [('c', 'tree')], 'bogus3': [('d', 'tree')]}) == 2
+    assert db.lookup_results('bogus1').done == True
+    assert db.lookup_results('bogus2').done == False
+
+def test_add_file_not_there(db):
+    assert not db.add_file('bogus', 'a', 'tree')
+    assert db.lookup_results('bogus') is None
+
+def test_set_jobs_after_files_done(db):
+    new_request(db, 'bogus')
+    db.add_file('bogus', 'a', 'tree')
+    assert db.set_jobs('bogus', 1)
+    assert db.lookup_results('bogus').done == True
+    assert not db.set_jobs('bogus2', 1)
+
+def test_set_phase(db):
+    new_request(db, 'bogus')
+    assert db.set_phase('bogus', 'running')
+    assert db.lookup_results('bogus').phase == 'running'
+    assert not db.set_phase('bogus2', 'running')
+
+def test_update_status(db):
+    new_request(db, 'bogus')
+    db.add_file('bogus', 'a', 'tree')
+    assert db.update_status('bogus', phase='running', njobs=1)
+    r = db.lookup_results('bogus')
+    assert (r.phase, r.jobs, r.done) == ('running', 1, True)
+    assert db.update_status('bogus', phase='done')
+    assert db.lookup_results('bogus').jobs == 1
+    assert not db.update_status('bogus2', njobs=1)
+
+def test_files_page(db):
+    new_request(db, 'bogus', jobs=5)
+    db.add_files({'bogus': [(f, 'tree') for f in 'abcde']})
+    assert [f for f, _ in db.lookup_results('bogus', files_from=1, max_files=2).files] == ['b', 'c']
+    assert [f for f, _ in db.lookup_results('bogus', files_from=3).files] == ['d', 'e']
+
+def test_lookup_status(db):
+    db.save_results('bogus', ADLRequestInfo(done=True, files=['a'], jobs=1, phase='done', hash='', log='a long log', message='crashed'))
+    r = db.lookup_status('bogus')
+    assert r.done == True
+    assert r.message == 'crashed'
+    assert r.files is None
+    assert r.log is None
+
+def test_sqlite_status_skips_files(tmp_path):
+    db = open_db(f'sqlite://{tmp_path}/r.db')
+    new_request(db, 'bogus', jobs=3)
+    db.add_files({'bogus': [('a', 'tree')]})
+    statements = []
+    db._connection.set_trace_callback(statements.append)
+    assert db.lookup_status('bogus').jobs == 3
+    db._connection.set_trace_callback(None)
+    assert not any('FROM files' in s for s in statements)
+
+def test_claim(db):
+    info = ADLRequestInfo(done=False, files=[], jobs=-1, phase='waiting_for_data', hash='', log=None, message=None)
+    new_request(db, 'bogus2', jobs=5)
+    r = db.claim_requests(['bogus1', 'bogus2'], info)
+    assert [created for _, created in r] == [True, False]
+    assert r[1][0].jobs == 5
+    assert db.claim_request('bogus1', info)[1] == False
+
+def test_claim_files_page(db):
+    new_request(db, 'bogus', jobs=3)
+    db.add_files({'bogus': [(f, 'tree') for f in 'abc']})
+    info, created = db.claim_request('bogus', ADLRequestInfo(done=False, files=[], jobs=-1, phase='waiting_for_data'), files_from=1, max_files=1)
+    assert not created
+    assert info.files == [['b', 'tree']]
+
+def test_claim_from_many_threads(db):
+    info = ADLRequestInfo(done=False, files=[], jobs=-1, phase='waiting_for_data', hash='', log=None, message=None)
+    created = []
+    threads = [threading.Thread(target=lambda: created.append(db.claim_request('bogus', info)[1])) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert sorted(created) == [False]*7 + [True]
+
+def test_list_requests_paged(db):
+    for i in range(5):
+        db.save_results(f'bogus{i}', ADLRequestInfo(done=False, files=[], jobs=1, phase='running' if i % 2 else 'waiting_for_data', hash=''))
+    page, cursor = db.list_requests(limit=3)
+    assert [r['hash'] for r in page] == ['bogus4', 'bogus3', 'bogus2']
+    page, cursor = db.list_requests(cursor=cursor, limit=3)
+    assert [r['hash'] for r in page] == ['bogus1', 'bogus0']
+    assert cursor is None
+    assert [r['hash'] for r in db.list_requests(phase='running')[0]] == ['bogus3', 'bogus1']
+    assert db.list_requests(min_age=3600)[0] == []
+    assert len(db.list_requests(max_age=3600)[0]) == 5
+
+def test_crash_log(db):
+    new_request(db, 'bogus')
+    log = [f'line {i}' for i in range(100)]
+    assert db.mark_crashed('bogus', 'it broke', log)
+    r = db.lookup_results('bogus')
+    assert r.done == True
+    assert r.message == 'it broke'
+    assert r.log.endswith('line 99')
+    assert db.open_log(r.log_ref).read().decode('utf-8') == '\n'.join(log)
+
+def test_crash_with_status(db):
+    new_request(db, 'bogus')
+    assert db.mark_crashed('bogus', 'it broke', 'log line', phase='running', njobs=3)
+    r = db.lookup_results('bogus')
+    assert (r.done, r.phase, r.jobs, r.message) == (True, 'running', 3, 'it broke')
+    assert db.mark_crashed('bogus', 'again', 'log line')
+    assert db.lookup_results('bogus').phase == 'running'
+
+def test_crash_log_not_there(db):
+    assert not db.mark_crashed('bogus', 'it broke', 'log line')
+    assert db.open_log('bogus') is None
@@ -0,0 +1,73 @@
+# Test the metrics registry and its text output
+from func_adl_request_broker.metrics import Registry, TimedDBAccess, DB_SECONDS, dump_metrics, REGISTRY
+from unittest.mock import Mock
+import pytest
+
+
+def test_counter_by_label():
+    r = Registry()
+    c = r.counter('msgs_total', 'Messages', ('queue',))
+    c.inc(queue='a')
+    c.inc(2, queue='a')
+    c.inc(queue='b')
+    assert c.value(queue='a') == 3
+    text = r.render()
+    assert '# TYPE msgs_total counter' in text
+    assert 'msgs_total{queue="a"} 3' in text
+    assert 'msgs_total{queue="b"} 1' in text
+
+def test_same_metric_returned():
+    r = Registry()
+    assert r.counter('c', 'help') is r.counter('c', 'help')
+
+def test_histogram_buckets():
+    r = Registry()
+    h = r.histogram('t_seconds', 'Time', ('stage',), buckets=(0.1, 1.0))
+    h.observe(0.05, stage='x')
+    h.observe(0.5, stage='x')
+    h.observe(5, stage='x')
+    text = r.render()
+    assert 't_seconds_bucket{stage="x",le="0.1"} 1' in text
+    assert 't_seconds_bucket{stage="x",le="1.0"} 2' in text
+    assert 't_seconds_bucket{stage="x",le="+Inf"} 3' in text
+    assert 't_seconds_sum{stage="x"} 5.55' in text
+    assert 't_seconds_count{stage="x"} 3' in text
+
+def test_histogram_time():
+    r = Registry()
+    h = r.histogram('t_seconds', 'Time')
+    with h.time():
+        pass
+    assert h.count() == 1
+
+def test_label_escaped():
+    r = Registry()
+    r.counter('c', 'help', ('l',)).inc(l='a"b')
+    assert 'c{l="a\\"b"} 1' in r.render()
+
+def test_gauge():
+    r = Registry()
+    g = r.gauge('depth', 'Depth', ('q',))
+    g.set(3, q='a')
+    g.set(1, q='a')
+    assert g.value(q='a') == 1
+    assert 'depth{q="a"} 1' in r.render()
+
+def test_callback():
+    r = Registry()
+    value = [1]
+    r.callback('size', 'Size', lambda: value[0])
+    value[0] = 5
+    assert 'size 5' in r.render()
+
+def test_db_calls_timed():
+    db = Mock()
+    db.set_phase.return_value = True
+    n = DB_SECONDS.count(op='set_phase')
+    assert TimedDBAccess(db).set_phase('1234', 'running')
+    assert DB_SECONDS.count(op='set_phase') == n + 1
+
+def test_dump(tmp_path):
+    REGISTRY.counter('dump_test_total', 'A test counter').inc()
+    dump_metrics(str(tmp_path / 'metrics.prom'))
+    assert 'dump_test_total 1' in (tmp_path / 'metrics.prom').read_text()
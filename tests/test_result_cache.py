@@ -0,0 +1,61 @@
+# Test the completed query result cache
+from func_adl_request_broker.result_cache import ResultCache
+import time
+
+
+def done_result():
+    return {'files': [['file.root', 'tree']], 'phase': 'done', 'done': True, 'jobs': 1, 'log': None, 'message': None}
+
+def test_miss():
+    c = ResultCache()
+    assert c.get('bogus') is None
+    assert c.stats() == {'hits': 0, 'misses': 1, 'entries': 0}
+
+def test_hit():
+    c = ResultCache()
+    c.put('hash1', done_result())
+    r = c.get('hash1')
+    assert r is not None
+    assert r['files'] == [['file.root', 'tree']]
+    assert c.hits == 1
+
+def test_not_done_not_cached():
+    c = ResultCache()
+    r = done_result()
+    r['done'] = False
+    c.put('hash1', r)
+    assert c.get('hash1') is None
+
+def test_crashed_not_cached():
+    c = ResultCache()
+    r = done_result()
+    r['message'] = 'it went boom'
+    c.put('hash1', r)
+    assert c.get('hash1') is None
+
+def test_page_not_cached():
+    c = ResultCache()
+    c.put('hash1', dict(done_result(), next_cursor=1))
+    assert c.get('hash1') is None
+
+def test_returned_copy():
+    c = ResultCache()
+    c.put('hash1', done_result())
+    c.get('hash1')['files'] = []
+    assert len(c.get('hash1')['files']) == 1
+
+def test_lru_eviction():
+    c = ResultCache(max_entries=2)
+    c.put('hash1', done_result())
+    c.put('hash2', done_result())
+    c.get('hash1')
+    c.put('hash3', done_result())
+    assert c.get('hash2') is None
+    assert c.get('hash1') is not None
+    assert c.get('hash3') is not None
+
+def test_ttl_expiry():
+    c = ResultCache(ttl=0.01)
+    c.put('hash1', done_result())
+    time.sleep(0.02)
+    assert c.get('hash1') is None
@@ -0,0 +1,60 @@
+# Test the long lived RPC client against the in-process broker stand-in.
+from func_adl_request_broker.rpc_client import RabbitRPCClient, RPCTimeout
+from benchmarks.fake_broker import FakeBroker
+import pika
+import pytest
+
+
+@pytest.fixture
+def echo_broker():
+    'A broker with something listening on as_request that echos back the body'
+    broker = FakeBroker()
+    server = broker.connection_factory().channel()
+
+    def respond(ch, method, properties, body):
+        ch.basic_publish(exchange='', routing_key=properties.reply_to,
+                         properties=pika.BasicProperties(correlation_id=properties.correlation_id),
+                         body=b'reply-' + body)
+        ch.basic_ack(delivery_tag=method.delivery_tag)
+
+    server.basic_consume(queue='as_request', on_message_callback=respond)
+    yield broker
+
+def test_simple_call(echo_broker):
+    c = RabbitRPCClient('localhost', 'user', 'pass', connection_factory=echo_broker.connection_factory)
+    assert c.call(b'hi') == b'reply-hi'
+
+def test_connection_reused(echo_broker):
+    connections = []
+    def factory(params):
+        connections.append(echo_broker.connection_factory(params))
+        return connections[-1]
+
+    c = RabbitRPCClient('localhost', 'user', 'pass', connection_factory=factory)
+    assert c.call(b'1') == b'reply-1'
+    assert c.call(b'2') == b'reply-2'
+    assert len(connections) == 1
+
+def test_reconnect_after_close(echo_broker):
+    connections = []
+    def factory(params):
+        connections.append(echo_broker.connection_factory(params))
+        return connections[-1]
+
+    c = RabbitRPCClient('localhost', 'user', 'pass', connection_factory=factory)
+    c.call(b'1')
+    connections[0].close()
+    assert c.call(b'2') == b'reply-2'
+    assert len(connections) == 2
+
+def test_stray_reply_dropped(echo_broker):
+    c = RabbitRPCClient('localhost', 'user', 'pass', connection_factory=echo_broker.connection_factory)
+    c.call(b'1')
+    echo_broker.publish(c._callback_queue, b'junk', pika.BasicProperties(correlation_id='not-mine'))
+    assert c.call(b'2') == b'reply-2'
+
+def test_timeout_no_reply():
+    broker = FakeBroker()
+    c = RabbitRPCClient('localhost', 'user', 'pass', connection_factory=broker.connection_factory)
+    with pytest.raises(RPCTimeout):
+        c.call(b'hi', timeout=0.05)
@@ -0,0 +1,72 @@
+# Test the status change fan out
+from func_adl_request_broker.status_notifier import StatusNotifier, RabbitStatusListener, publish_status_event, declare_status_exchange
+from func_adl_request_broker.async_status_notifier import AsyncRabbitStatusListener, AsyncStatusNotifier
+from benchmarks.fake_broker import FakeBroker
+from types import SimpleNamespace
+import asyncio
+import queue
+import time
+import pytest
+
+
+def test_event_to_subscriber():
+    n = StatusNotifier()
+    q = n.subscribe('hash1')
+    n.notify({'hash': 'hash1', 'event': 'phase', 'phase': 'running'})
+    assert q.get_nowait()['phase'] == 'running'
+
+def test_event_other_hash_ignored():
+    n = StatusNotifier()
+    q = n.subscribe('hash1')
+    n.notify({'hash': 'hash2', 'event': 'phase', 'phase': 'running'})
+    with pytest.raises(queue.Empty):
+        q.get_nowait()
+
+def test_unsubscribe():
+    n = StatusNotifier()
+    q = n.subscribe('hash1')
+    n.unsubscribe('hash1', q)
+    n.notify({'hash': 'hash1', 'event': 'phase', 'phase': 'running'})
+    with pytest.raises(queue.Empty):
+        q.get_nowait()
+
+def test_listener_passes_on_events():
+    broker = FakeBroker()
+    n = StatusNotifier()
+    q = n.subscribe('hash1')
+    RabbitStatusListener(n, 'localhost', 'user', 'pass', connection_factory=broker.connection_factory).start()
+
+    # Wait for the listener to bind its queue before publishing
+    sender = broker.connection_factory().channel()
+    declare_status_exchange(sender)
+    for _ in range(500):
+        if len(broker.exchanges['status_updates']) > 0:
+            break
+        time.sleep(0.01)
+    # A bad message is skipped, and the listener carries on
+    sender.basic_publish(exchange='status_updates', routing_key='', body=b'not json')
+    sender.basic_publish(exchange='status_updates', routing_key='', body=b'{"no": "hash"}')
+    publish_status_event(sender, 'hash1', 'file', file='f.root', treename='tree')
+    e = q.get(timeout=5)
+    assert e == {'hash': 'hash1', 'event': 'file', 'file': 'f.root', 'treename': 'tree'}
+
+def test_async_listener_skips_bad_events():
+    async def main():
+        n = AsyncStatusNotifier()
+        q = n.subscribe('hash1')
+        listener = AsyncRabbitStatusListener(n)
+        for body in (b'not json', b'[1]', b'{"hash": "hash1", "event": "phase", "phase": "running"}'):
+            await listener._on_event(SimpleNamespace(body=body))
+        return [q.get_nowait() for _ in range(q.qsize())]
+    assert [e['phase'] for e in asyncio.run(main())] == ['running']
+
+def test_async_event_to_subscriber():
+    async def main():
+        n = AsyncStatusNotifier()
+        q = n.subscribe('hash1')
+        n.notify({'hash': 'hash1', 'event': 'phase', 'phase': 'running'})
+        n.notify({'hash': 'hash2', 'event': 'phase', 'phase': 'done'})
+        n.unsubscribe('hash1', q)
+        n.notify({'hash': 'hash1', 'event': 'phase', 'phase': 'done'})
+        return [q.get_nowait() for _ in range(q.qsize())]
+    assert [e['phase'] for e in asyncio.run(main())] == ['running']
@@ -0,0 +1,57 @@
+# Test reading (possibly compressed) uploads against a byte budget
+from func_adl_request_broker.upload import ByteBudget, CopyingReader, ServerBusy, UnsupportedEncoding, UploadTooLarge, decompressing_reader
+import gzip
+import io
+import pickle
+import pytest
+
+
+def test_identity():
+    assert decompressing_reader(io.BytesIO(b'hi'), None).read() == b'hi'
+    assert decompressing_reader(io.BytesIO(b'hi'), 'identity').read() == b'hi'
+
+def test_gzip():
+    assert decompressing_reader(io.BytesIO(gzip.compress(b'hi' * 1000)), 'gzip').read() == b'hi' * 1000
+
+def test_unknown_encoding():
+    with pytest.raises(UnsupportedEncoding):
+        decompressing_reader(io.BytesIO(b'hi'), 'br')
+
+def test_budget():
+    b = ByteBudget(10)
+    with b.reserve(6) as r:
+        with pytest.raises(ServerBusy):
+            b.acquire(5)
+        r.add(4)
+        assert b.used == 10
+    assert b.used == 0
+
+def test_copying_reader_keeps_data():
+    data = pickle.dumps(list(range(1000)))
+    r = CopyingReader(io.BytesIO(data), len(data))
+    assert pickle.load(r) == list(range(1000))
+    assert r.data == data
+
+def test_copying_reader_limit():
+    r = CopyingReader(io.BytesIO(b'x' * 100), 50)
+    with pytest.raises(UploadTooLarge):
+        r.read()
+
+def test_data_not_copied():
+    b = ByteBudget(100)
+    with b.reserve() as reservation:
+        r = CopyingReader(io.BytesIO(b'x' * 100), 1000, reservation)
+        r.read()
+        assert r.data is r.data
+        assert r.data == b'x' * 100
+        assert b.used == 100
+
+def test_copying_reader_grows_reservation():
+    b = ByteBudget(60)
+    with b.reserve(10) as reservation:
+        r = CopyingReader(io.BytesIO(b'x' * 100), 1000, reservation)
+        r.read(50)
+        assert b.used == 50
+        with pytest.raises(ServerBusy):
+            r.read(50)
+    assert b.used == 0
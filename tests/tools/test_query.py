@@ -1,12 +1,20 @@
 # Test the query app
 
-from tools.query_web import query, BadASTException
+from tools.query_web import query, queries, query_status, list_queries, metrics, compress_response, BadASTException, FileEventStream, result_cache
+from func_adl_request_broker.upload import ByteBudget
+from func_adl_request_broker.db_access import ADLRequestInfo
+from func_adl_request_broker.status_notifier import StatusNotifier
+from func_adl_request_broker.rpc_client import RPCTimeout
+import falcon
+import gzip
 import pytest
 from unittest.mock import Mock
 import pickle
 import io
 import ast
 import os
+import threading
+import time
 from func_adl import EventDataset
 
 @pytest.fixture
@@ -35,8 +43,15 @@ def bad_query_ast_pickle_data_pandas():
 def bad_query_random():
     return pickle.dumps({'hi': 'dude', 'there': 'fork', 'omg': 'shirtballs'})
 
-class Holder:
+@pytest.fixture(autouse=True)
+def empty_result_cache():
+    'Make sure no test sees results cached by another'
+    result_cache.clear()
+
+class Holder(io.BytesIO):
+    'What hug hands us as the body: a stream that stops at the end of the body'
     def __init__ (self, b):
+        io.BytesIO.__init__(self, b)
         self.stream = io.BytesIO(b)
         self.stream_len = len(b)
 
@@ -57,6 +72,27 @@ def mock_good_rabbit_call(monkeypatch):
     do_rpc_call_mock = Mock()
     do_rpc_call_mock.return_value = {'files': [['file.root', 'dudetree3']], 'phase': 'done', 'done': True, 'jobs': 1}
     monkeypatch.setattr('tools.query_web.do_rpc_call', do_rpc_call_mock)
+    return do_rpc_call_mock
+
+@pytest.fixture
+def mock_rabbit_call_not_done(monkeypatch):
+    do_rpc_call_mock = Mock()
+    do_rpc_call_mock.return_value = {'files': [['file.root', 'dudetree3']], 'phase': 'running', 'done': False, 'jobs': 2}
+    monkeypatch.setattr('tools.query_web.do_rpc_call', do_rpc_call_mock)
+    return do_rpc_call_mock
+
+@pytest.fixture
+def mock_timeout_rabbit_call(monkeypatch):
+    rpc_client_mock = Mock()
+    rpc_client_mock.call.side_effect = RPCTimeout('too slow')
+    monkeypatch.setattr('tools.query_web.get_rpc_client', lambda: rpc_client_mock)
+
+@pytest.fixture
+def mock_db(monkeypatch):
+    db = Mock()
+    db.lookup_results.side_effect = lambda h, **kwargs: ADLRequestInfo(done=False, files=[['file.root', 'dudetree3']], jobs=2, phase='running', hash=h) if h == '1234' else None
+    monkeypatch.setattr('tools.query_web.get_db', lambda: db)
+    return db
 
 @pytest.fixture
 def no_prefix_env():
@@ -132,3 +168,233 @@ def test_local_files_with_prefix(good_query_ast_body, mock_good_rabbit_call, wit
     fspec, tname = fd[0]
     assert fspec == 'G:\\file.root'
     assert tname == 'dudetree3'
+
+def test_timeout_returns_pending(good_query_ast_body, mock_timeout_rabbit_call, no_prefix_env):
+    a = query(good_query_ast_body)
+    assert a['done'] == False
+    assert a['phase'] == 'pending'
+    assert len(a['files']) == 0
+
+def test_done_query_cached(good_query_ast_pickle_data, mock_good_rabbit_call, no_prefix_env):
+    query(Holder(good_query_ast_pickle_data))
+    a = query(Holder(good_query_ast_pickle_data))
+    assert mock_good_rabbit_call.call_count == 1
+    assert a['files'] == [['file.root', 'dudetree3']]
+
+def test_running_query_not_cached(good_query_ast_pickle_data, mock_rabbit_call_not_done, no_prefix_env):
+    query(Holder(good_query_ast_pickle_data))
+    query(Holder(good_query_ast_pickle_data))
+    assert mock_rabbit_call_not_done.call_count == 2
+
+def test_query_returns_hash(good_query_ast_body, mock_good_rabbit_call, no_prefix_env):
+    a = query(good_query_ast_body)
+    assert isinstance(a['hash'], str)
+    assert len(a['hash']) > 0
+
+def test_batch_in_input_order(good_query_ast_pickle_data, no_prefix_env, monkeypatch):
+    a1 = pickle.loads(good_query_ast_pickle_data)
+    a2 = EventDataset('localds://dataset2') \
+        .Select('lambda e: e.EventNumber()') \
+        .AsROOTTTree('output.root', 'evttree', 'n') \
+        .value(executor=lambda a: a)
+    batch_mock = Mock()
+    batch_mock.side_effect = lambda bodies, hashes, metadata=None: [{'files': [[f'{h}.root', 't']], 'phase': 'done', 'done': True, 'jobs': 1} for h in hashes]
+    monkeypatch.setattr('tools.query_web.do_rpc_batch_call', batch_mock)
+
+    r = queries(Holder(pickle.dumps([a2, a1, a2])))
+    assert batch_mock.call_count == 1
+    assert len(batch_mock.call_args[0][1]) == 2
+    assert [x['hash'] for x in r] == [r[0]['hash'], r[1]['hash'], r[0]['hash']]
+    assert r[0]['hash'] != r[1]['hash']
+    assert r[1]['files'] == [[f'{r[1]["hash"]}.root', 't']]
+
+    # All done, so they come from the cache the second time
+    queries(Holder(pickle.dumps([a1, a2])))
+    assert batch_mock.call_count == 1
+
+def test_batch_bad_ast(good_query_ast_pickle_data, bad_query_ast_pickle_data_pandas):
+    with pytest.raises(BadASTException):
+        queries(Holder(pickle.dumps([pickle.loads(good_query_ast_pickle_data), pickle.loads(bad_query_ast_pickle_data_pandas)])))
+
+def test_query_stages_timed(good_query_ast_body, mock_good_rabbit_call, no_prefix_env):
+    response = Mock()
+    query(good_query_ast_body, response=response)
+    text = metrics()
+    for stage in ['read', 'unpickle', 'hash', 'cache', 'rpc', 'rewrite']:
+        assert f'query_web_stage_seconds_count{{stage="{stage}"}}' in text
+    assert 'result_cache_misses_total' in text
+    correlation_id = response.set_header.call_args[0][1]
+    assert mock_good_rabbit_call.call_args[0][2] == correlation_id
+
+def test_gzipped_query(good_query_ast_pickle_data, mock_good_rabbit_call, no_prefix_env):
+    request = Mock()
+    request.get_header.return_value = 'gzip'
+    a = query(Holder(gzip.compress(good_query_ast_pickle_data)), request=request)
+    assert a['files'] == [['file.root', 'dudetree3']]
+    # The ingester gets the pickle, not what was sent over the wire
+    assert mock_good_rabbit_call.call_args[0][0] == good_query_ast_pickle_data
+
+def test_client_metadata_sent(good_query_ast_pickle_data, mock_good_rabbit_call, no_prefix_env):
+    request = Mock()
+    request.get_header.side_effect = {'X-Client-ID': 'alice', 'X-Dataset-Size-Hint': '2e12'}.get
+    query(Holder(good_query_ast_pickle_data), request=request)
+    assert mock_good_rabbit_call.call_args[0][3] == {'client_id': 'alice', 'size_hint': 2000000000000}
+
+def test_unknown_encoding(good_query_ast_body):
+    request = Mock()
+    request.get_header.return_value = 'br'
+    with pytest.raises(falcon.HTTPUnsupportedMediaType):
+        query(good_query_ast_body, request=request)
+
+def test_query_too_big(good_query_ast_pickle_data, monkeypatch):
+    monkeypatch.setattr('tools.query_web.MAX_AST_SIZE', len(good_query_ast_pickle_data) - 1)
+    with pytest.raises(falcon.HTTPPayloadTooLarge):
+        query(Holder(good_query_ast_pickle_data))
+
+def test_query_too_big_once_decompressed(good_query_ast_pickle_data, monkeypatch):
+    monkeypatch.setattr('tools.query_web.MAX_AST_SIZE', len(good_query_ast_pickle_data) - 1)
+    request = Mock()
+    request.get_header.return_value = 'gzip'
+    with pytest.raises(falcon.HTTPPayloadTooLarge):
+        query(Holder(gzip.compress(good_query_ast_pickle_data)), request=request)
+
+def test_batch_gzipped(good_query_ast_pickle_data, no_prefix_env, monkeypatch):
+    batch_mock = Mock()
+    batch_mock.side_effect = lambda bodies, hashes, metadata=None: [{'files': [], 'phase': 'running', 'done': False, 'jobs': 1} for h in hashes]
+    monkeypatch.setattr('tools.query_web.do_rpc_batch_call', batch_mock)
+    request = Mock()
+    request.get_header.side_effect = {'Content-Encoding': 'gzip'}.get
+    r = queries(Holder(gzip.compress(pickle.dumps([pickle.loads(good_query_ast_pickle_data)]))), request=request)
+    assert len(r) == 1
+
+def test_batch_too_big(good_query_ast_pickle_data, monkeypatch):
+    monkeypatch.setattr('tools.query_web.MAX_AST_SIZE', 10)
+    with pytest.raises(falcon.HTTPPayloadTooLarge):
+        queries(Holder(pickle.dumps([pickle.loads(good_query_ast_pickle_data)])))
+
+def test_batch_over_budget(good_query_ast_pickle_data, monkeypatch):
+    monkeypatch.setattr('tools.query_web.upload_budget', ByteBudget(10))
+    with pytest.raises(falcon.HTTPServiceUnavailable):
+        queries(Holder(pickle.dumps([pickle.loads(good_query_ast_pickle_data)])))
+
+def test_query_over_budget(good_query_ast_pickle_data, monkeypatch):
+    monkeypatch.setattr('tools.query_web.upload_budget', ByteBudget(len(good_query_ast_pickle_data) - 1))
+    with pytest.raises(falcon.HTTPServiceUnavailable):
+        query(Holder(good_query_ast_pickle_data))
+
+def test_budget_returned(good_query_ast_body, mock_good_rabbit_call, no_prefix_env, monkeypatch):
+    budget = ByteBudget(10*1024*1024)
+    monkeypatch.setattr('tools.query_web.upload_budget', budget)
+    query(good_query_ast_body)
+    assert budget.used == 0
+
+def test_big_response_compressed():
+    request, response = Mock(), Mock()
+    request.get_header.return_value = 'gzip, deflate'
+    response.get_header.return_value = None
+    response.data = b'x' * 10000
+    compress_response(request, response, None)
+    assert gzip.decompress(response.data) == b'x' * 10000
+    response.set_header.assert_called_with('Content-Encoding', 'gzip')
+
+def test_response_not_compressed_unless_asked():
+    request, response = Mock(), Mock()
+    request.get_header.return_value = None
+    response.get_header.return_value = None
+    response.data = b'x' * 10000
+    compress_response(request, response, None)
+    assert response.data == b'x' * 10000
+
+def test_status_by_hash(mock_db, with_prefix_env):
+    a = query_status('1234', Mock())
+    assert a['hash'] == '1234'
+    assert a['phase'] == 'running'
+    assert a['files'] == [['file://file.root', 'dudetree3']]
+
+def test_status_files_page(mock_db, no_prefix_env):
+    a = query_status('1234', Mock(), cursor=1, limit=10)
+    assert mock_db.lookup_results.call_args.kwargs == {'files_from': 1, 'max_files': 10}
+    assert a['next_cursor'] == 1 + len(a['files'])
+
+def test_status_negative_page(mock_db):
+    response = Mock()
+    query_status('1234', response, cursor=-1)
+    assert response.status == '400 Bad Request'
+    query_status('1234', response, limit=-1)
+    assert response.status == '400 Bad Request'
+    mock_db.lookup_results.assert_not_called()
+
+def test_query_negative_page(good_query_ast_pickle_data, monkeypatch):
+    rpc_mock = Mock()
+    monkeypatch.setattr('tools.query_web.do_rpc_call', rpc_mock)
+    with pytest.raises(falcon.HTTPBadRequest):
+        query(Holder(good_query_ast_pickle_data), cursor=-1)
+    with pytest.raises(falcon.HTTPBadRequest):
+        query(Holder(good_query_ast_pickle_data), limit=-1)
+    rpc_mock.assert_not_called()
+
+def test_query_files_page(good_query_ast_pickle_data, no_prefix_env, monkeypatch):
+    rpc_mock = Mock()
+    rpc_mock.return_value = {'files': [['a.root', 't'], ['b.root', 't'], ['c.root', 't']], 'phase': 'done', 'done': True, 'jobs': 3}
+    monkeypatch.setattr('tools.query_web.do_rpc_call', rpc_mock)
+    a = query(Holder(good_query_ast_pickle_data), cursor=1, limit=1)
+    assert a['files'] == [['b.root', 't']]
+    assert a['next_cursor'] == 2
+
+    # The cache keeps the whole list
+    a = query(Holder(good_query_ast_pickle_data), cursor=2)
+    assert a['files'] == [['c.root', 't']]
+    assert a['next_cursor'] == 3
+
+def test_query_paged_by_ingester(good_query_ast_pickle_data, no_prefix_env, monkeypatch):
+    rpc_mock = Mock()
+    rpc_mock.return_value = {'files': [['b.root', 't']], 'phase': 'done', 'done': True, 'jobs': 3, 'next_cursor': 2}
+    monkeypatch.setattr('tools.query_web.do_rpc_call', rpc_mock)
+    a = query(Holder(good_query_ast_pickle_data), cursor=1, limit=1)
+    assert rpc_mock.call_args[0][3] == {'files_from': 1, 'max_files': 1}
+    assert a['files'] == [['b.root', 't']]
+    assert a['next_cursor'] == 2
+    # Only a page - it can't be used for anyone else
+    query(Holder(good_query_ast_pickle_data))
+    assert rpc_mock.call_count == 2
+
+def test_list_queries(mock_db):
+    mock_db.list_requests.return_value = ([{'hash': '1234', 'phase': 'running'}], 'abc')
+    r = list_queries(Mock(), phase='running', min_age=60, limit=10)
+    assert r == {'queries': [{'hash': '1234', 'phase': 'running'}], 'next_cursor': 'abc'}
+    mock_db.list_requests.assert_called_once_with(phase='running', min_age=60, max_age=None, cursor=None, limit=10)
+
+def test_list_queries_bad_cursor(mock_db):
+    mock_db.list_requests.side_effect = ValueError('Bad cursor')
+    response = Mock()
+    list_queries(response, cursor='junk')
+    assert response.status == '400 Bad Request'
+
+def test_status_by_hash_unknown(mock_db):
+    response = Mock()
+    query_status('bogus', response)
+    assert response.status == '404 Not Found'
+
+def test_long_poll_times_out(mock_db, no_prefix_env, monkeypatch):
+    monkeypatch.setattr('tools.query_web.get_notifier', lambda: StatusNotifier())
+    a = query_status('1234', Mock(), wait=0.1)
+    assert a['phase'] == 'running'
+
+def test_long_poll_returns_on_change(mock_db, no_prefix_env, monkeypatch):
+    notifier = StatusNotifier()
+    monkeypatch.setattr('tools.query_web.get_notifier', lambda: notifier)
+    threading.Timer(0.1, lambda: notifier.notify({'hash': '1234', 'event': 'phase', 'phase': 'running'})).start()
+    start = time.time()
+    query_status('1234', Mock(), wait=30)
+    assert time.time() - start < 10
+    assert mock_db.lookup_results.call_count == 2
+
+def test_event_stream_done():
+    notifier = StatusNotifier()
+    events = notifier.subscribe('1234')
+    s = FileEventStream('1234', ADLRequestInfo(done=False, files=[['file.root', 'dudetree3']], jobs=2, phase='running', hash='1234'), events, notifier)
+    notifier.notify({'hash': '1234', 'event': 'file', 'file': 'file2.root', 'treename': 'dudetree3'})
+    text = b''.join(iter(s.read, b'')).decode('utf-8')
+    assert text.count('event: file') == 2
+    assert 'file2.root' in text
+    assert text.endswith('event: done\ndata: {}\n\n')
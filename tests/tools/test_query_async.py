@@ -0,0 +1,108 @@
+# Test the asyncio front end's status endpoints
+from tools.query_web_async import routes, result_cache
+from func_adl_request_broker.upload import ByteBudget
+from func_adl_request_broker.async_status_notifier import AsyncStatusNotifier
+from func_adl_request_broker.db_access import ADLRequestInfo
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+from unittest.mock import Mock
+import asyncio
+import io
+import threading
+import time
+
+
+def running(h):
+    return ADLRequestInfo(done=False, files=[['file.root', 'tree']], jobs=2, phase='running', hash=h) if h == '1234' else None
+
+def make_app():
+    db = Mock()
+    db.lookup_results.side_effect = lambda h, **kwargs: running(h)
+    app = web.Application()
+    app.add_routes(routes)
+    app['db'] = db
+    app['notifier'] = AsyncStatusNotifier()
+    return app
+
+def run(test):
+    'Run test(client, app) against the app'
+    async def main():
+        result_cache.clear()
+        app = make_app()
+        async with TestClient(TestServer(app)) as client:
+            return await test(client, app)
+    return asyncio.run(main())
+
+def test_status_unknown():
+    async def test(client, app):
+        return (await client.get('/query/bogus')).status
+    assert run(test) == 404
+
+def test_status_negative_page():
+    async def test(client, app):
+        return [(await client.get('/query/1234', params=p)).status for p in ({'cursor': '-1'}, {'limit': '-1'})]
+    assert run(test) == [400, 400]
+
+def test_long_poll_times_out():
+    async def test(client, app):
+        return await (await client.get('/query/1234', params={'wait': '0.1'})).json()
+    assert run(test)['phase'] == 'running'
+
+def test_long_poll_returns_on_change():
+    async def test(client, app):
+        asyncio.get_running_loop().call_later(0.1, app['notifier'].notify, {'hash': '1234', 'event': 'phase', 'phase': 'running'})
+        start = time.time()
+        await client.get('/query/1234', params={'wait': '30'})
+        return time.time() - start, app['db'].lookup_results.call_count
+    elapsed, lookups = run(test)
+    assert elapsed < 10
+    assert lookups == 2
+
+def test_event_stream_done():
+    async def test(client, app):
+        response = await client.get('/query/1234/events')
+        app['notifier'].notify({'hash': '1234', 'event': 'file', 'file': 'file2.root', 'treename': 'tree'})
+        return response.headers['Content-Type'], await response.text()
+    content_type, text = run(test)
+    assert content_type == 'text/event-stream'
+    assert text.count('event: file') == 2
+    assert text.endswith('event: done\ndata: {}\n\n')
+
+def test_log():
+    async def test(client, app):
+        app['db'].open_log.return_value = io.BytesIO(b'line 1\nline 2')
+        return await (await client.get('/query/1234/log')).text()
+    assert run(test) == 'line 1\nline 2'
+
+def test_list_queries():
+    async def test(client, app):
+        app['db'].list_requests.return_value = ([{'hash': '1234', 'phase': 'running'}], 'abc')
+        r = await (await client.get('/admin/queries', params={'phase': 'running', 'limit': '10'})).json()
+        return r, app['db'].list_requests.call_args
+    r, call = run(test)
+    assert r == {'queries': [{'hash': '1234', 'phase': 'running'}], 'next_cursor': 'abc'}
+    assert call.kwargs == {'phase': 'running', 'min_age': None, 'max_age': None, 'cursor': None, 'limit': 10}
+
+def test_batch_over_budget(monkeypatch):
+    monkeypatch.setattr('tools.query_web_async.upload_budget', ByteBudget(10))
+    async def test(client, app):
+        return (await client.post('/queries', data=b'x' * 100)).status
+    assert run(test) == 503
+
+def test_hashed_off_event_loop(monkeypatch):
+    hashed_on = []
+    def calc_ast_hash(a):
+        hashed_on.append(threading.current_thread())
+        return '1234'
+    monkeypatch.setattr('tools.query_web_async.ast_from_pickle', lambda data: 'query')
+    monkeypatch.setattr('tools.query_web_async.asts_from_pickle', lambda data: ['query', 'query'])
+    monkeypatch.setattr('tools.query_web_async.calc_ast_hash', calc_ast_hash)
+    async def test(client, app):
+        result_cache.put('1234', {'files': [], 'phase': 'done', 'done': True, 'jobs': 0})
+        single = await client.post('/query', data=b'x')
+        batch = await client.post('/queries', data=b'x')
+        return single.status, batch.status, threading.current_thread()
+    single, batch, loop_thread = run(test)
+    assert (single, batch) == (200, 200)
+    assert len(hashed_on) == 3
+    assert loop_thread not in hashed_on
@@ -0,0 +1,202 @@
+# Test the request ingester message handling
+from tools.request_ingester_rabbit import FairDispatcher, fair_share_queue, process_message, setup_consumers, tenant_weights
+from func_adl_request_broker.query_utils import priority_from_size_hint, request_metadata
+from func_adl_request_broker.db_access import ADLRequestInfo
+from unittest.mock import Mock
+from types import SimpleNamespace
+from collections import defaultdict
+import pika
+import pickle
+import base64
+import json
+import ast
+import pytest
+
+
+@pytest.fixture
+def new_request_db():
+    db = Mock()
+    db.claim_request.return_value = (ADLRequestInfo(done=False, files=[], jobs=-1, phase='waiting_for_data', hash='1234'), True)
+    return db
+
+@pytest.fixture
+def old_request_db():
+    db = Mock()
+    db.claim_request.return_value = (ADLRequestInfo(done=True, files=[['f.root', 'tree']], jobs=1, phase='done', hash='1234'), False)
+    return db
+
+def send(db, body, headers, legacy_find_did=False, dispatcher=None, ch=None):
+    ch = ch or Mock()
+    props = pika.BasicProperties(reply_to='reply_queue', correlation_id='abc', headers=headers)
+    process_message(db, ch, SimpleNamespace(delivery_tag=1), props, body, legacy_find_did, dispatcher)
+    return ch
+
+def published(ch, routing_key):
+    return [c.kwargs for c in ch.basic_publish.call_args_list if c.kwargs['routing_key'] == routing_key]
+
+def test_hash_from_header(new_request_db):
+    send(new_request_db, b'not a pickle', {'hash': '1234'})
+    assert new_request_db.claim_request.call_args[0][0] == '1234'
+
+def test_find_did_gets_body_untouched(new_request_db):
+    body = pickle.dumps(ast.Name(id='jets'))
+    ch = send(new_request_db, body, {'hash': '1234'})
+    m = published(ch, 'find_did')
+    assert len(m) == 1
+    assert m[0]['body'] is body
+    assert m[0]['properties'].headers['hash'] == '1234'
+    assert m[0]['properties'].correlation_id == 'abc'
+    ch.basic_ack.assert_called_once()
+
+def test_find_did_legacy_json(new_request_db):
+    body = pickle.dumps(ast.Name(id='jets'))
+    ch = send(new_request_db, body, {'hash': '1234'}, legacy_find_did=True)
+    m = json.loads(published(ch, 'find_did')[0]['body'])
+    assert m['hash'] == '1234'
+    assert base64.b64decode(m['ast']) == body
+
+def test_known_request_not_started(old_request_db):
+    ch = send(old_request_db, b'not a pickle', {'hash': '1234'})
+    assert len(published(ch, 'find_did')) == 0
+    reply = json.loads(published(ch, 'reply_queue')[0]['body'])
+    assert reply['done'] == True
+    assert reply['files'] == [['f.root', 'tree']]
+
+def test_files_page(old_request_db):
+    old_request_db.claim_request.return_value = (ADLRequestInfo(done=True, files=[['b.root', 'tree']], jobs=3, phase='done', hash='1234'), False)
+    ch = send(old_request_db, b'not a pickle', {'hash': '1234', 'files_from': 1, 'max_files': 1})
+    assert old_request_db.claim_request.call_args[0][2:] == (1, 1)
+    reply = json.loads(published(ch, 'reply_queue')[0]['body'])
+    assert reply['next_cursor'] == 2
+
+def test_no_header_not_ast(new_request_db):
+    ch = send(new_request_db, pickle.dumps({'hi': 'there'}), None)
+    new_request_db.claim_request.assert_not_called()
+    ch.basic_ack.assert_called_once()
+
+def test_batch(new_request_db):
+    new_request_db.claim_requests.return_value = [
+        (ADLRequestInfo(done=False, files=[], jobs=-1, phase='waiting_for_data', hash='1'), True),
+        (ADLRequestInfo(done=True, files=[['f.root', 'tree']], jobs=1, phase='done', hash='2'), False),
+    ]
+    bodies = [pickle.dumps(ast.Name(id='jets')), pickle.dumps(ast.Name(id='muons'))]
+    ch = send(new_request_db, pickle.dumps(bodies), {'hashes': ['1', '2']})
+
+    assert new_request_db.claim_requests.call_args[0][0] == ['1', '2']
+    new_request_db.claim_request.assert_not_called()
+    m = published(ch, 'find_did')
+    assert len(m) == 1
+    assert m[0]['body'] == bodies[0]
+    assert m[0]['properties'].headers['hash'] == '1'
+    reply = json.loads(published(ch, 'reply_queue')[0]['body'])
+    assert [r['done'] for r in reply] == [False, True]
+    ch.basic_ack.assert_called_once()
+
+def test_priority_from_size_hint():
+    assert priority_from_size_hint(None) == 5
+    assert priority_from_size_hint(10**6) == 9
+    assert priority_from_size_hint(5 * 10**9) == 7
+    assert priority_from_size_hint(5 * 10**11) == 3
+    assert priority_from_size_hint(10**20) == 1
+
+def test_request_metadata():
+    headers = {'X-Client-ID': 'x' * 100, 'X-Dataset-Size-Hint': 'lots'}
+    assert request_metadata(headers.get) == {'client_id': 'x' * 64}
+    assert request_metadata({}.get) == {}
+
+def test_tenant_weights():
+    assert tenant_weights('alice=3, bob=1') == {'alice': 3, 'bob': 1}
+    assert tenant_weights('') == {}
+
+def test_find_did_priority_and_client(new_request_db):
+    ch = send(new_request_db, b'query', {'hash': '1234', 'client_id': 'alice', 'size_hint': 10**6})
+    m = published(ch, 'find_did')[0]['properties']
+    assert m.priority == 9
+    assert m.headers['client_id'] == 'alice'
+
+def test_find_did_priority_queue():
+    ch = Mock()
+    setup_consumers(ch, Mock(), find_did_max_priority=9)
+    assert ch.queue_declare.call_args_list[1].kwargs == {'queue': 'find_did', 'arguments': {'x-max-priority': 9}}
+    ch = Mock()
+    setup_consumers(ch, Mock())
+    assert ch.queue_declare.call_args_list[1].kwargs == {'queue': 'find_did', 'arguments': None}
+
+class FakeQueues:
+    'Just enough of a channel for the fair share dispatcher: queues are lists, and find_did is never drained'
+    def __init__(self):
+        self.queues = defaultdict(list)
+        self.connection = Mock()
+        self.gets = 0
+
+    def queue_declare(self, queue, passive=False, arguments=None):
+        return SimpleNamespace(method=SimpleNamespace(message_count=len(self.queues[queue])))
+
+    def basic_publish(self, exchange, routing_key, properties, body):
+        self.queues[routing_key].append((properties, body))
+
+    def basic_get(self, queue):
+        self.gets += 1
+        if len(self.queues[queue]) == 0:
+            return None, None, None
+        properties, body = self.queues[queue].pop(0)
+        return SimpleNamespace(delivery_tag=1, message_count=len(self.queues[queue])), properties, body
+
+    def basic_ack(self, delivery_tag):
+        pass
+
+def test_fair_share_queues_by_client(new_request_db):
+    ch = FakeQueues()
+    d = FairDispatcher(ch, 4, target_depth=0)
+    send(new_request_db, b'query', {'hash': '1234', 'client_id': 'alice'}, dispatcher=d, ch=ch)
+    assert ch.queues['find_did'] == []
+    waiting = ch.queues[fair_share_queue(d.bucket_of('alice'))]
+    assert len(waiting) == 1
+    assert waiting[0][1] == b'query'
+    ch.connection.call_later.assert_called_once()
+
+def test_fair_share_round_robin():
+    ch = FakeQueues()
+    d = FairDispatcher(ch, 2, target_depth=0, weights={'alice': 2})
+    assert d.bucket_of('alice') != d.bucket_of('bob')
+    for i in range(4):
+        for tenant in ('alice', 'bob'):
+            d.submit(tenant, pika.BasicProperties(headers={'client_id': tenant}), f'{tenant}{i}'.encode())
+
+    d._target_depth = 6
+    d.pump()
+    sent = [body for _, body in ch.queues['find_did']]
+    assert sorted(sent[0:3]) == [b'alice0', b'alice1', b'bob0']
+    assert sorted(sent[3:6]) == [b'alice2', b'alice3', b'bob1']
+
+    # Room in find_did again: the rest go, whoever they are from
+    ch.queues['find_did'].clear()
+    d._on_timer()
+    assert [body for _, body in ch.queues['find_did']] == [b'bob2', b'bob3']
+
+def test_fair_share_submit_only_looks_in_its_bucket():
+    ch = FakeQueues()
+    d = FairDispatcher(ch, 16, target_depth=5)
+    d.pump()
+    ch.gets = 0
+    d.submit('alice', pika.BasicProperties(headers={'client_id': 'alice'}), b'query')
+    assert ch.gets == 1
+    assert [body for _, body in ch.queues['find_did']] == [b'query']
+
+    # Nothing waiting anywhere we know of - the timer doesn't go looking until the next rescan
+    d._on_timer()
+    assert ch.gets == 1
+    d._last_scan -= 10
+    d._on_timer()
+    assert ch.gets == 17
+
+def test_fair_share_metrics_by_bucket():
+    from func_adl_request_broker.metrics import FAIR_SHARE_DISPATCHED, FAIR_SHARE_QUEUED
+    ch = FakeQueues()
+    d = FairDispatcher(ch, 4, target_depth=5)
+    bucket = d.bucket_of('x' * 64)
+    queued, dispatched = FAIR_SHARE_QUEUED.value(bucket=bucket), FAIR_SHARE_DISPATCHED.value(bucket=bucket)
+    d.submit('x' * 64, pika.BasicProperties(headers={'client_id': 'x' * 64}), b'query')
+    assert FAIR_SHARE_QUEUED.value(bucket=bucket) == queued + 1
+    assert FAIR_SHARE_DISPATCHED.value(bucket=bucket) == dispatched + 1
+    assert not any('x' * 64 in line for line in FAIR_SHARE_QUEUED.render())
@@ -0,0 +1,270 @@
+# Test the state updater message handling
+from tools.state_updater import AddFileBatcher, EarlyEvents, ShardRouter, ShardWorker, StatusCoalescer, drain_shards, process_number_jobs, process_update_state, \
+    shard_of, shard_queue
+from func_adl_request_broker.metrics import EVENTS_EXPIRED, EVENTS_REPLAYED
+from unittest.mock import Mock
+from types import SimpleNamespace
+from collections import defaultdict
+import pika
+import pymongo
+import json
+import pytest
+
+
+@pytest.fixture
+def channel():
+    return Mock()
+
+@pytest.fixture
+def connection():
+    return Mock()
+
+def send_file(batcher, channel, tag, hash, file_ref):
+    batcher.on_message(channel, SimpleNamespace(delivery_tag=tag), None, json.dumps({'hash': hash, 'file': file_ref, 'treename': 'tree'}))
+
+def test_batch_held_until_full(channel, connection):
+    db = Mock()
+    batcher = AddFileBatcher(db, connection, 3, 0.05)
+    send_file(batcher, channel, 1, 'hash1', 'f1')
+    send_file(batcher, channel, 2, 'hash1', 'f2')
+    db.add_files.assert_not_called()
+    channel.basic_ack.assert_not_called()
+    connection.call_later.assert_called_once()
+
+def test_batch_written_when_full(channel, connection):
+    db = Mock()
+    db.add_files.return_value = 2
+    batcher = AddFileBatcher(db, connection, 3, 0.05)
+    send_file(batcher, channel, 1, 'hash1', 'f1')
+    send_file(batcher, channel, 2, 'hash2', 'f2')
+    send_file(batcher, channel, 3, 'hash1', 'f3')
+    db.add_files.assert_called_once_with({'hash1': [('f1', 'tree'), ('f3', 'tree')], 'hash2': [('f2', 'tree')]})
+    assert channel.basic_ack.call_count == 3
+
+def test_batch_duplicates_merged(channel, connection):
+    db = Mock()
+    db.add_files.return_value = 1
+    batcher = AddFileBatcher(db, connection, 2, 0.05)
+    send_file(batcher, channel, 1, 'hash1', 'f1')
+    send_file(batcher, channel, 2, 'hash1', 'f1')
+    db.add_files.assert_called_once_with({'hash1': [('f1', 'tree')]})
+    assert channel.basic_ack.call_count == 2
+
+def test_batch_requeued_on_db_error(channel, connection):
+    db = Mock()
+    db.add_files.side_effect = pymongo.errors.AutoReconnect('db went away')
+    batcher = AddFileBatcher(db, connection, 2, 0.05)
+    send_file(batcher, channel, 1, 'hash1', 'f1')
+    send_file(batcher, channel, 2, 'hash1', 'f2')
+    channel.basic_ack.assert_not_called()
+    assert channel.basic_nack.call_count == 2
+
+def test_router_same_hash_same_worker(channel):
+    router = ShardRouter(4)
+    for tag, hash in enumerate(['hash1', 'hash2', 'hash1', 'hash3']):
+        router.on_message('status_change_state', channel, SimpleNamespace(delivery_tag=tag), None, json.dumps({'hash': hash, 'phase': f'p{tag}'}))
+    routed = [(c.kwargs['routing_key'], json.loads(c.kwargs['body'])) for c in channel.basic_publish.call_args_list]
+    assert routed[0][0] == routed[2][0] == f'status_change_state.{shard_of("hash1", 4)}'
+    assert [m['phase'] for q, m in routed if m['hash'] == 'hash1'] == ['p0', 'p2']
+    assert channel.basic_ack.call_count == 4
+
+def test_router_spreads_requests():
+    assert len({shard_of(f'hash{i}', 4) for i in range(100)}) == 4
+
+class LeftQueues:
+    'Just enough of a connection for drain_shards: queues are lists, and looking for one that is not there fails'
+    def __init__(self, queues):
+        self.queues = defaultdict(list, queues)
+
+    def channel(self):
+        return self
+
+    def queue_declare(self, queue, passive=False):
+        if queue not in self.queues:
+            raise pika.exceptions.ChannelClosedByBroker(404, 'NOT_FOUND')
+
+    def basic_get(self, queue):
+        if len(self.queues[queue]) == 0:
+            return None, None, None
+        return SimpleNamespace(delivery_tag=1), None, self.queues[queue].pop(0)
+
+    def basic_publish(self, exchange, routing_key, properties, body):
+        self.queues[routing_key].append(body)
+
+    def basic_ack(self, delivery_tag):
+        pass
+
+    def queue_delete(self, queue, if_empty=False):
+        del self.queues[queue]
+
+    def close(self):
+        pass
+
+def test_drain_shards_fewer_workers():
+    body = json.dumps({'hash': 'hash1', 'phase': 'running'})
+    left = LeftQueues({'status_change_state.2': [body], 'status_add_file.3': [], 'status_change_state.0': []})
+    assert drain_shards(left, 2) == 1
+    assert left.queues[shard_queue('status_change_state', shard_of('hash1', 2))] == [body]
+    assert 'status_change_state.2' not in left.queues
+    assert 'status_add_file.3' not in left.queues
+
+def test_drain_shards_one_worker():
+    left = LeftQueues({'status_number_jobs.0': ['m1', 'm2'], 'crashed_request.1': ['m3']})
+    assert drain_shards(left, 1) == 3
+    assert left.queues['status_number_jobs'] == ['m1', 'm2']
+    assert left.queues['crashed_request'] == ['m3']
+    assert sorted(left.queues.keys()) == ['crashed_request', 'status_number_jobs']
+
+def test_worker_failure_reported():
+    failed = Mock()
+    worker = ShardWorker(0, Mock(side_effect=pika.exceptions.AMQPConnectionError('no broker')), Mock(), on_failure=failed)
+    worker.run()
+    failed.assert_called_once_with()
+
+def fire_timer(connection):
+    'Run the last callback the code under test asked the connection to call later'
+    connection.call_later.call_args[0][1]()
+
+def send_njobs(db, channel, tag, hash, early):
+    process_number_jobs(db, channel, SimpleNamespace(delivery_tag=tag), SimpleNamespace(correlation_id=None), json.dumps({'hash': hash, 'njobs': 2}), early)
+
+def test_early_event_held_and_replayed(channel, connection):
+    db = Mock()
+    db.set_jobs.side_effect = [False, True]
+    early = EarlyEvents(connection)
+    replayed = EVENTS_REPLAYED.value(queue='status_number_jobs')
+    send_njobs(db, channel, 1, 'hash1', early)
+    channel.basic_ack.assert_not_called()
+    assert len(early) == 1
+    fire_timer(connection)
+    channel.basic_ack.assert_called_once_with(delivery_tag=1)
+    assert len(early) == 0
+    assert EVENTS_REPLAYED.value(queue='status_number_jobs') == replayed + 1
+
+def test_early_event_retry_fails(channel, connection):
+    db = Mock()
+    db.set_jobs.side_effect = [False, pymongo.errors.AutoReconnect('db went away'), True]
+    early = EarlyEvents(connection)
+    send_njobs(db, channel, 1, 'hash1', early)
+    fire_timer(connection)
+    channel.basic_ack.assert_not_called()
+    assert len(early) == 1
+    fire_timer(connection)
+    channel.basic_ack.assert_called_once_with(delivery_tag=1)
+    assert len(early) == 0
+
+def test_early_events_kept_in_order(channel, connection):
+    db = Mock()
+    db.set_jobs.side_effect = [False, True]
+    db.set_phase.return_value = True
+    early = EarlyEvents(connection)
+    send_njobs(db, channel, 1, 'hash1', early)
+    # The request is there now, but this has to wait for the njobs to go first
+    process_update_state(db, channel, SimpleNamespace(delivery_tag=2), SimpleNamespace(correlation_id=None), json.dumps({'hash': 'hash1', 'phase': 'running'}), early)
+    assert [c.kwargs['delivery_tag'] for c in channel.basic_ack.call_args_list] == [1, 2]
+    assert db.method_calls[-2:] == [(('set_jobs', ('hash1', 2), {})), (('set_phase', ('hash1', 'running'), {}))]
+    connection.remove_timeout.assert_called_once()
+
+def test_early_event_expires(channel, connection):
+    db = Mock()
+    db.set_jobs.return_value = False
+    early = EarlyEvents(connection, max_age=0)
+    expired = EVENTS_EXPIRED.value(queue='status_number_jobs', reason='timeout')
+    send_njobs(db, channel, 1, 'hash1', early)
+    fire_timer(connection)
+    channel.basic_ack.assert_called_once_with(delivery_tag=1)
+    assert EVENTS_EXPIRED.value(queue='status_number_jobs', reason='timeout') == expired + 1
+    assert not early.holding('hash1')
+
+def test_early_events_backoff(channel, connection):
+    db = Mock()
+    db.set_jobs.return_value = False
+    early = EarlyEvents(connection, first_retry=0.1, max_retry=0.3)
+    send_njobs(db, channel, 1, 'hash1', early)
+    for _ in range(3):
+        fire_timer(connection)
+    assert [c[0][0] for c in connection.call_later.call_args_list] == [0.1, 0.2, 0.3, 0.3]
+
+def test_early_events_full(channel, connection):
+    db = Mock()
+    db.set_jobs.return_value = False
+    early = EarlyEvents(connection, max_events=1)
+    send_njobs(db, channel, 1, 'hash1', early)
+    send_njobs(db, channel, 2, 'hash2', early)
+    channel.basic_ack.assert_called_once_with(delivery_tag=2)
+    assert early.holding('hash1') and not early.holding('hash2')
+
+def test_no_early_events_drops(channel):
+    db = Mock()
+    db.set_jobs.return_value = False
+    send_njobs(db, channel, 1, 'hash1', None)
+    channel.basic_ack.assert_called_once_with(delivery_tag=1)
+
+def test_batch_holds_missing_requests(channel, connection):
+    db = Mock()
+    db.add_files.side_effect = lambda files: sum(1 for h in files if h == 'hash1')
+    db.add_file.return_value = True
+    early = EarlyEvents(connection)
+    batcher = AddFileBatcher(db, connection, 2, 0.05, early=early)
+    send_file(batcher, channel, 1, 'hash1', 'f1')
+    send_file(batcher, channel, 2, 'hash2', 'f2')
+    channel.basic_ack.assert_called_once_with(delivery_tag=1)
+    assert early.holding('hash2')
+    # Anything else for hash2 goes in behind it - and the request is there now
+    send_file(batcher, channel, 3, 'hash2', 'f3')
+    assert [c.kwargs['delivery_tag'] for c in channel.basic_ack.call_args_list] == [1, 2, 3]
+    assert [c[0] for c in db.add_file.call_args_list] == [('hash2', 'f2', 'tree'), ('hash2', 'f3', 'tree')]
+
+def send_status(coalescer, channel, tag, queue, info):
+    coalescer.on_message(queue, channel, SimpleNamespace(delivery_tag=tag), SimpleNamespace(correlation_id=f'c{tag}'), json.dumps(info))
+
+def test_coalesce_last_wins(channel, connection):
+    db = Mock()
+    db.update_status.return_value = True
+    coalescer = StatusCoalescer(db, connection, 0.05)
+    send_status(coalescer, channel, 1, 'status_number_jobs', {'hash': 'hash1', 'njobs': 1})
+    send_status(coalescer, channel, 2, 'status_change_state', {'hash': 'hash1', 'phase': 'running'})
+    send_status(coalescer, channel, 3, 'status_number_jobs', {'hash': 'hash1', 'njobs': 5})
+    send_status(coalescer, channel, 4, 'status_change_state', {'hash': 'hash2', 'phase': 'running'})
+    send_status(coalescer, channel, 5, 'status_change_state', {'hash': 'hash1', 'phase': 'done'})
+    db.update_status.assert_not_called()
+    connection.call_later.assert_called_once()
+    fire_timer(connection)
+    assert [c for c in db.update_status.call_args_list] == [
+        (('hash1',), {'phase': 'done', 'njobs': 5}),
+        (('hash2',), {'phase': 'running', 'njobs': None})]
+    assert sorted(c.kwargs['delivery_tag'] for c in channel.basic_ack.call_args_list) == [1, 2, 3, 4, 5]
+
+def test_coalesce_crash_kept(channel, connection):
+    db = Mock()
+    db.update_status.return_value = True
+    db.mark_crashed.return_value = True
+    coalescer = StatusCoalescer(db, connection, 0.05, max_items=3)
+    send_status(coalescer, channel, 1, 'status_number_jobs', {'hash': 'hash1', 'njobs': 2})
+    send_status(coalescer, channel, 2, 'crashed_request', {'hash': 'hash1', 'message': 'boom', 'log': ['l1']})
+    send_status(coalescer, channel, 3, 'status_change_state', {'hash': 'hash1', 'phase': 'running'})
+    # Full, so written without waiting for the timer
+    db.update_status.assert_not_called()
+    db.mark_crashed.assert_called_once_with('hash1', 'boom', ['l1'], phase='running', njobs=2)
+    assert channel.basic_ack.call_count == 3
+
+def test_coalesce_requeued_on_db_error(channel, connection):
+    db = Mock()
+    db.update_status.side_effect = pymongo.errors.AutoReconnect('db went away')
+    coalescer = StatusCoalescer(db, connection, 0.05, max_items=2)
+    send_status(coalescer, channel, 1, 'status_number_jobs', {'hash': 'hash1', 'njobs': 2})
+    send_status(coalescer, channel, 2, 'status_change_state', {'hash': 'hash1', 'phase': 'running'})
+    channel.basic_ack.assert_not_called()
+    assert channel.basic_nack.call_count == 2
+
+def test_coalesce_holds_early(channel, connection):
+    db = Mock()
+    db.update_status.side_effect = [False, True]
+    early = EarlyEvents(connection)
+    coalescer = StatusCoalescer(db, connection, 0.05, max_items=2, early=early)
+    send_status(coalescer, channel, 1, 'status_number_jobs', {'hash': 'hash1', 'njobs': 2})
+    send_status(coalescer, channel, 2, 'status_change_state', {'hash': 'hash1', 'phase': 'running'})
+    channel.basic_ack.assert_not_called()
+    assert len(early) == 1
+    fire_timer(connection)
+    assert sorted(c.kwargs['delivery_tag'] for c in channel.basic_ack.call_args_list) == [1, 2]
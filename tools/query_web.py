@@ -3,111 +3,426 @@
 #
 # To test, run with hug -f query_web.py. By default this starts on port 8000.
 #
+import falcon
+import gzip
 import hug
-import pickle
-import ast
-import pika
 import os
 import json
+import pickle
+import queue
+import time
 import uuid
-from func_adl import ResultTTree
+from contextlib import contextmanager
+from func_adl_request_broker.rpc_client import RabbitRPCClient, RPCTimeout
+from func_adl_request_broker.query_utils import BadASTException, MAX_AST_SIZE, ast_from_stream, asts_from_stream, page_files, paging_headers, pending_response, \
+    reply_timeout, request_metadata, result_from_info, rewrite_file_urls, ProgressEvents, SSE_KEEPALIVE
+from func_adl_request_broker.result_cache import result_cache_from_env
+from func_adl_request_broker.db_access import DBAccess, ADLRequestInfo, open_db
+from func_adl_request_broker.metrics import CONTENT_TYPE, QUERY_STAGE_SECONDS, REGISTRY, RPC_CALL_SECONDS, TimedDBAccess
+from func_adl_request_broker.upload import ByteBudget, CopyingReader, ServerBusy, UnsupportedEncoding, UploadTooLarge, decompressing_reader
+from func_adl_request_broker.status_notifier import StatusNotifier, RabbitStatusListener
+from func_adl.xAOD.backend.ast.ast_hash import calc_ast_hash
+from typing import Callable, List, Optional
 import signal
 import logging
 logging.basicConfig(level=logging.INFO)
 
 
-class BadASTException(BaseException):
-    def __init__(self, message):
-        BaseException.__init__(self, message)
-
-def on_response (status, corr_id, ch, method, props, body):
-    'We get the info back - print it out'
-    if corr_id == props.correlation_id:
-        status.append(body)
-
-def do_rpc_call(a: ast.AST):
-    'Make the RPC call and return the value'
-    # Open connection to Rabbit, and declare the main queue we will be sending to.
-    rabbit_user = os.environ['RABBIT_USER']
-    rabbit_pass = os.environ['RABBIT_PASS']
-    rabbit_address = os.environ['RABBIT_NODE']
-    credentials = pika.PlainCredentials(rabbit_user, rabbit_pass)
-    connection = pika.BlockingConnection(pika.ConnectionParameters(host=rabbit_address, credentials=credentials))
-    channel = connection.channel()
-    channel.queue_declare(queue='as_request')
-
-    # Declare the call-back queue (an anonymous queue)
-    result = channel.queue_declare(queue='', exclusive=True)
-    callback_queue = result.method.queue
-
-    status = []
-    corr_id = str(uuid.uuid4())
-    channel.basic_consume(queue=callback_queue, on_message_callback=lambda ch, method, props, body: on_response(status, corr_id, ch, method, props, body), auto_ack=True)
-
-    # Now, send the message
-    logging.info("Sending a request")
-    channel.basic_publish(exchange='',
-        routing_key='as_request',
-        properties=pika.BasicProperties(
-            reply_to=callback_queue,
-            correlation_id=corr_id
-        ),
-        body=pickle.dumps(a)
-    )
-
-    # Wait for a response
-    logging.info("Waiting for reply back from ingester")
-    while len(status) == 0:
-        channel.connection.process_data_events()
+# Results of queries that are done - they never change, so we need not ask the ingester again.
+result_cache = result_cache_from_env()
+result_cache.register_metrics()
+
+# The longest (seconds) a client can ask us to hold a status request open waiting for a change.
+MAX_STATUS_WAIT = float(os.environ.get('QUERY_MAX_WAIT', '60'))
+
+# The most bytes of queries this worker will hold in memory at once, while reading them and sending them
+# on. Past that, new ones are turned away with a 503 until some finish.
+upload_budget = ByteBudget(int(os.environ.get('QUERY_INFLIGHT_BYTES', str(4*MAX_AST_SIZE))))
+
+# Responses at least this big are gzipped for clients that accept it
+MIN_COMPRESS_SIZE = int(os.environ.get('QUERY_COMPRESS_MIN_BYTES', '1024'))
+
+_rpc_client = None
+_db = None
+_notifier = None
+
+def get_rpc_client() -> RabbitRPCClient:
+    r'''
+    Return the RPC client for this worker. It is created on first use (so after gunicorn has forked us)
+    and then kept open for the life of the worker.
+    '''
+    global _rpc_client
+    if _rpc_client is None:
+        _rpc_client = RabbitRPCClient(os.environ['RABBIT_NODE'], os.environ['RABBIT_USER'], os.environ['RABBIT_PASS'])
+    return _rpc_client
+
+def get_db() -> DBAccess:
+    'Return the db access for this worker, opening it (at MONGO_DB_SERVER) on first use'
+    global _db
+    if _db is None:
+        _db = TimedDBAccess(open_db(os.environ['MONGO_DB_SERVER']))
+    return _db
+
+def get_notifier() -> StatusNotifier:
+    r'''
+    Return the status change notifier for this worker. On first use this starts the thread that listens
+    for changes from the state updater.
+    '''
+    global _notifier
+    if _notifier is None:
+        _notifier = StatusNotifier()
+        RabbitStatusListener(_notifier, os.environ['RABBIT_NODE'], os.environ['RABBIT_USER'], os.environ['RABBIT_PASS']).start()
+    return _notifier
+
+def do_rpc_call(raw_data: bytes, hash: str, correlation_id: Optional[str] = None, metadata: Optional[dict] = None):
+    r'''
+    Make the RPC call and return the value. If the ingester does not answer in time, return a pending status.
+
+    Arguments:
+        raw_data            The pickled AST, exactly as the client sent it. It is forwarded untouched.
+        hash                The hash of the AST, sent along in the message headers
+        correlation_id      The id to trace the request by, through the ingester and on to find_did
+        metadata            Who is asking, and how big the query is (see request_metadata), and the page of
+                            the file list wanted (see paging_headers). Sent along in the headers.
+    '''
+    logging.info(f"Sending a request ({correlation_id})")
+    start = time.perf_counter()
+    try:
+        reply = get_rpc_client().call(raw_data, timeout=reply_timeout(), headers=dict(metadata or {}, hash=hash), correlation_id=correlation_id)
+    except RPCTimeout:
+        RPC_CALL_SECONDS.observe(time.perf_counter() - start, outcome='timeout')
+        logging.warning(f"Timed out waiting for a reply from the ingester ({correlation_id})")
+        return pending_response()
+    RPC_CALL_SECONDS.observe(time.perf_counter() - start, outcome='ok')
+    logging.info(f"Got response! ({correlation_id})")
+
+    return json.loads(reply)
+
+def do_rpc_batch_call(bodies: List[bytes], hashes: List[str], metadata: Optional[dict] = None) -> List[dict]:
+    r'''
+    Send a batch of requests to the ingester as one message, and return their status, in the same order.
+    If the ingester does not answer in time, they are all pending.
+
+    Arguments:
+        bodies              The pickled AST of each request
+        hashes              The hash of each AST, sent along in the message headers
+        metadata            Who is asking (see do_rpc_call)
+    '''
+    logging.info(f"Sending a batch of {len(hashes)} requests")
+    try:
+        reply = get_rpc_client().call(pickle.dumps(bodies), timeout=reply_timeout(), headers=dict(metadata or {}, hashes=hashes))
+    except RPCTimeout:
+        logging.warning("Timed out waiting for a reply from the ingester")
+        return [pending_response() for _ in hashes]
     logging.info("Got response!")
 
-    channel.close()
+    return json.loads(reply)
+
+@contextmanager
+def received_upload(body, encoding:Optional[str], load:Callable = ast_from_stream):
+    r'''
+    Read and unpickle a query (or a batch of them) from the body of the POST as it arrives, decompressing it
+    if the client compressed it. The memory it takes is held against upload_budget until the block ends.
+
+    Arguments:
+        body                The body of the POST (a stream, with its stream_len)
+        encoding            The Content-Encoding it was sent with
+        load                Unpickles and checks the upload as it is read: ast_from_stream or asts_from_stream
+
+    Returns:
+        What load returned, and the reader - its data is the (uncompressed) pickle
+
+    Exceptions:
+        HTTPPayloadTooLarge     It is bigger than MAX_AST_SIZE, compressed or not (413)
+        HTTPServiceUnavailable  Too many queries are being read at once (503)
+        HTTPUnsupportedMediaType    It was compressed with something we can not read (415)
+        BadASTException         It isn't a query we can run
+    '''
+    # If they are sending something too big, then we are just going to bail out of this now.
+    if body.stream_len > MAX_AST_SIZE:
+        raise falcon.HTTPPayloadTooLarge(description=f'Too big an AST to process (limit is {MAX_AST_SIZE} bytes)')
+    try:
+        with upload_budget.reserve(body.stream_len) as reservation:
+            reader = CopyingReader(decompressing_reader(body, encoding), MAX_AST_SIZE, reservation)
+            start = time.perf_counter()
+            loaded = load(reader)
+            QUERY_STAGE_SECONDS.observe(reader.read_seconds, stage='read')
+            QUERY_STAGE_SECONDS.observe(time.perf_counter() - start - reader.read_seconds, stage='unpickle')
+            yield loaded, reader
+    except UploadTooLarge as e:
+        raise falcon.HTTPPayloadTooLarge(description=str(e))
+    except ServerBusy as e:
+        raise falcon.HTTPServiceUnavailable(description=str(e), retry_after=1)
+    except UnsupportedEncoding as e:
+        raise falcon.HTTPUnsupportedMediaType(description=str(e))
 
-    return json.loads(status[0])
+@contextmanager
+def received_query(body, encoding:Optional[str]):
+    'received_upload of a single query, yielding the AST and its pickle to send on'
+    with received_upload(body, encoding) as (a, reader):
+        yield a, reader.data
 
 @hug.post('/query')
-def query(body):
+def query(body, request=None, cursor:hug.types.number = 0, limit:hug.types.number = 0, response=None):
     r'''
     Given a query (a pickled ast file), return the files or status.
     WARNING: Python AST's are a known security issue and should not be used.
 
     Arguments:
-        body                The Pickle of the python AST representing the request
+        body                The Pickle of the python AST representing the request. It may be sent
+                            compressed, with a Content-Encoding of gzip (or zstd, if the zstandard
+                            package is installed).
+        cursor              Only return the files after the first cursor of them
+        limit               Return at most this many files (0 means all). Use the next_cursor in the
+                            result as the cursor to ask for the next ones.
+
+    A new query waits its turn at find_did behind those of other clients, by its X-Client-ID header, and
+    goes ahead of bigger queries, by its X-Dataset-Size-Hint header (bytes).
 
     Returns:
-        Results of the run
+        Results of the run. This includes the hash of the request - use it with GET /query/{hash}
+        to follow the progress of the request without sending the AST again. The X-Correlation-ID
+        response header is the id the request can be found by in the logs of the other services.
     '''
-    # If they are sending something too big, then we are just going to bail out of this now.
-    if body.stream_len > 1024*1000*100:
-        raise BaseException("Too big an AST to process!")
+    if cursor < 0 or limit < 0:
+        raise falcon.HTTPBadRequest(description='cursor and limit can not be negative')
 
-    # Read the AST in from the incoming data.
-    raw_data = body.stream.read(body.stream_len)
-    a = pickle.loads(raw_data)
-    if a is None or not isinstance(a, ast.AST):
-        raise BadASTException(f'Incoming AST is not the proper type: {type(a)}.')
-    if not isinstance(a, ResultTTree):
-        raise BadASTException(f'The AST must end with a ResultTTree - that is all this server can resolve, not {a}')
+    # An id to follow this request by through the other services
+    correlation_id = str(uuid.uuid4())
+    if response is not None:
+        response.set_header('X-Correlation-ID', correlation_id)
 
-    # Now, send it into the system, and wait for a response that tells us what to do with this. This is a little messy since
-    # we have to correlate a return items.
-    result = do_rpc_call(a)
+    # Read the AST in from the incoming data.
+    with received_query(body, request.get_header('Content-Encoding') if request is not None else None) as (a, raw_data):
+        # If this query has already finished, we already know the answer.
+        with QUERY_STAGE_SECONDS.time(stage='hash'):
+            hash = calc_ast_hash(a)
+        with QUERY_STAGE_SECONDS.time(stage='cache'):
+            result = result_cache.get(hash)
+        if result is None:
+            # Now, send it into the system, and wait for a response that tells us what to do with this. This is a little messy since
+            # we have to correlate a return items.
+            with QUERY_STAGE_SECONDS.time(stage='rpc'):
+                metadata = request_metadata(request.get_header) if request is not None else {}
+                result = do_rpc_call(raw_data, hash, correlation_id, dict(metadata, **paging_headers(cursor, limit)))
+            result_cache.put(hash, result)
+    result['hash'] = hash
+    page_files(result, cursor, limit)
 
     # Rewrite the files.
-    if 'LOCAL_FILE_URL' in os.environ:
-        prefix = os.environ['LOCAL_FILE_URL']
-        result['localfiles'] = [[f'{prefix}{u}', tn] for u,tn in result['files']]
+    with QUERY_STAGE_SECONDS.time(stage='rewrite'):
+        return rewrite_file_urls(result)
+
+@hug.post('/queries')
+def queries(body, request=None):
+    r'''
+    Submit many queries at once. They all go to the ingester in a single message.
+    WARNING: Python AST's are a known security issue and should not be used.
+
+    Arguments:
+        body                The Pickle of a list of python ASTs. It may be compressed, and is read against
+                            the same limits, as POST /query. The X-Client-ID and X-Dataset-Size-Hint
+                            headers apply to all of them (see POST /query).
+
+    Returns:
+        A list with the results of each query, in the order they were sent, as POST /query returns them.
+    '''
+    with received_upload(body, request.get_header('Content-Encoding') if request is not None else None, asts_from_stream) as (asts, _):
+        hashes = [calc_ast_hash(a) for a in asts]
+
+        # Anything we already know is done doesn't need to go to the ingester. Nor does anything
+        # sent twice in the same batch.
+        results = {}
+        to_send = {}
+        for h, a in zip(hashes, asts):
+            if h not in results and h not in to_send:
+                r = result_cache.get(h)
+                if r is None:
+                    to_send[h] = pickle.dumps(a)
+                else:
+                    results[h] = r
+
+        if len(to_send) > 0:
+            for h, r in zip(to_send.keys(), do_rpc_batch_call(list(to_send.values()), list(to_send.keys()),
+                                                                request_metadata(request.get_header) if request is not None else None)):
+                result_cache.put(h, r)
+                results[h] = r
+
+    return [rewrite_file_urls(dict(results[h], hash=h)) for h in hashes]
+
+@hug.get('/query/{hash}')
+def query_status(hash:str, response, wait:hug.types.float_number = 0, cursor:hug.types.number = 0, limit:hug.types.number = 0):
+    r'''
+    Return the files or status of a query that has already been submitted, by its hash.
+
+    Arguments:
+        hash                The hash returned by POST /query
+        wait                If the query isn't done, hold on to the request until its phase, file list,
+                            number of jobs or done flag changes, or this many seconds (at most QUERY_MAX_WAIT)
+                            have passed. The wait ties up a worker - query_web_async waits without.
+        cursor              Only return the files after the first cursor of them
+        limit               Return at most this many files (0 means all)
+
+    Returns:
+        Results of the run, just as POST /query returns them. Only the requested page of files is
+        loaded from the db, so a client can poll for just the new files of a large request by passing back
+        the next_cursor it got last time.
+    '''
+    if cursor < 0 or limit < 0:
+        response.status = hug.HTTP_400
+        return {'message': 'cursor and limit can not be negative'}
+
+    result = result_cache.get(hash)
+    if result is not None:
+        page_files(result, cursor, limit)
+    else:
+        info = lookup_after_change(hash, min(wait, MAX_STATUS_WAIT), cursor, limit) if wait > 0 else lookup_page(hash, cursor, limit)
+        if info is None:
+            response.status = hug.HTTP_404
+            return {'message': f'No query with hash {hash} is known'}
+        result = result_from_info(info)
+        if cursor == 0 and limit == 0:
+            result_cache.put(hash, result)
+        result['next_cursor'] = cursor + len(result['files'])
+    result['hash'] = hash
+
+    return rewrite_file_urls(result)
+
+def lookup_page(hash:str, cursor:int = 0, limit:int = 0) -> Optional[ADLRequestInfo]:
+    'Look up a request, loading only the files from cursor on (at most limit of them, 0 for all)'
+    return get_db().lookup_results(hash, files_from=cursor, max_files=limit if limit > 0 else None)
+
+def lookup_after_change(hash:str, wait:float, cursor:int = 0, limit:int = 0) -> Optional[ADLRequestInfo]:
+    'Look up a request, waiting up to wait seconds for it to change first if it is not done'
+    notifier = get_notifier()
+    # Subscribe before looking so a change between the two isn't missed.
+    events = notifier.subscribe(hash)
+    try:
+        info = lookup_page(hash, cursor, limit)
+        if info is None or info.done:
+            return info
+        try:
+            events.get(timeout=wait)
+        except queue.Empty:
+            return info
+        return lookup_page(hash, cursor, limit)
+    finally:
+        notifier.unsubscribe(hash, events)
+
+class FileEventStream(ProgressEvents):
+    r'''
+    Server-Sent Events stream of a query's progress (see ProgressEvents). The web server reads it like a
+    file, and each read blocks until there is something to send. The stream ends after the final 'done'
+    or 'crashed' event.
+    '''
+    def __init__(self, hash:str, info:ADLRequestInfo, events:queue.Queue, notifier:StatusNotifier,
+                 keepalive:float = 15.0, max_duration:float = 3600.0):
+        ProgressEvents.__init__(self, info)
+        self._hash = hash
+        self._events = events
+        self._notifier = notifier
+        self._keepalive = keepalive
+        self._end_time = time.monotonic() + max_duration
+
+    def read(self, size:int = -1) -> bytes:
+        while len(self.chunks) == 0:
+            if self.finished or time.monotonic() > self._end_time:
+                return b''
+            try:
+                self.on_event(self._events.get(timeout=self._keepalive))
+            except queue.Empty:
+                return SSE_KEEPALIVE
+        return self.chunks.popleft()
+
+    def close(self):
+        self._notifier.unsubscribe(self._hash, self._events)
+
+@hug.format.content_type('text/event-stream')
+def event_stream(content, **kwargs):
+    'Server-Sent Events, read from a file-like object'
+    return content
+
+@hug.get('/query/{hash}/events', output=event_stream)
+def query_events(hash:str, response):
+    r'''
+    Stream the progress of a query as Server-Sent Events (see FileEventStream). Files are pushed as soon
+    as the state updater records them, so a client can start on the first files while the rest are
+    still being made. The stream ties up a worker for as long as it is open - deployments with many
+    clients watching their queries should serve it from query_web_async, which does not.
+    '''
+    notifier = get_notifier()
+    events = notifier.subscribe(hash)
+    info = get_db().lookup_results(hash)
+    if info is None:
+        notifier.unsubscribe(hash, events)
+        response.status = hug.HTTP_404
+        response.content_type = 'text/plain; charset=utf-8'
+        return f'No query with hash {hash} is known'.encode('utf-8')
+    return FileEventStream(hash, info, events, notifier)
+
+@hug.get('/query/{hash}/log', output=hug.output_format.text)
+def query_log(hash:str, response):
+    r'''
+    Stream back the full crash log of a query. The /query result only has the last few lines
+    of it, and a log_ref, the hash to use here.
+    '''
+    log = get_db().open_log(hash)
+    if log is None:
+        response.status = hug.HTTP_404
+        return f'No log found for {hash}'
+    return log
+
+@hug.get('/admin/queries')
+def list_queries(response, phase:str = None, min_age:hug.types.float_number = 0, max_age:hug.types.float_number = 0,
+                 cursor:str = None, limit:hug.types.number = 50):
+    r'''
+    Page through the queries the broker knows about, newest first.
+
+    Arguments:
+        phase               Only queries in this phase
+        min_age             Only queries submitted at least this many seconds ago
+        max_age             Only queries submitted at most this many seconds ago (0 for no limit)
+        cursor              The next_cursor of the previous page
+        limit               Most queries to return
+
+    Returns:
+        {'queries': [...], 'next_cursor': ...}. Each query has its hash, phase, done, jobs, message
+        and when it was created. next_cursor is null on the last page.
+    '''
+    try:
+        page, next_cursor = get_db().list_requests(phase=phase or None, min_age=min_age or None, max_age=max_age or None,
+                                                   cursor=cursor or None, limit=limit)
+    except ValueError as e:
+        response.status = hug.HTTP_400
+        return {'message': str(e)}
+    return {'queries': page, 'next_cursor': next_cursor}
+
+@hug.format.content_type(CONTENT_TYPE)
+def prometheus_text(content, **kwargs):
+    'The Prometheus text exposition format'
+    return content.encode('utf-8')
 
-    if 'HTTP_PREFIX' in os.environ:
-        prefix = os.environ['HTTP_PREFIX']
-        result['httpfiles'] = [[f'{prefix}{u}', tn] for u,tn in result['files']]
+@hug.get('/metrics', output=prometheus_text)
+def metrics():
+    'Timings and counters of this worker, for Prometheus to scrape'
+    return REGISTRY.render()
 
-    if 'FILE_URL' in os.environ:
-        # Do this last b.c. it rewrites the files guy.
-        prefix = os.environ['FILE_URL']
-        result['files'] = [[f'{prefix}{u}', tn] for u,tn in result['files']]
+@hug.get('/cache/stats')
+def cache_stats():
+    'Hit/miss counters for the completed query cache'
+    return result_cache.stats()
 
-    return result
+@hug.response_middleware()
+def compress_response(request, response, resource):
+    'gzip big responses (a long file list compresses well) for clients that say they can take it'
+    data = response.data
+    if data is None or len(data) < MIN_COMPRESS_SIZE or response.get_header('Content-Encoding') is not None:
+        return
+    if 'gzip' not in (request.get_header('Accept-Encoding') or ''):
+        return
+    response.data = gzip.compress(data, compresslevel=5)
+    response.set_header('Content-Encoding', 'gzip')
+    response.append_header('Vary', 'Accept-Encoding')
 
 # Pay attention to the signal docker and kubectl will send us
 # so we can shut down fast.
@@ -0,0 +1,397 @@
+# asyncio version of the query_web front end. All the waiting for replies from the ingester happens on
+# a single event loop, so thousands of outstanding /query requests do not need thousands of workers.
+#
+# To test, run with python query_web_async.py. By default this starts on port 8000. In production, run
+# under gunicorn: gunicorn query_web_async:app --worker-class aiohttp.GunicornWebWorker
+#
+import asyncio
+import functools
+import json
+import pickle
+import time
+import uuid
+import os
+import logging
+from aiohttp import web
+from func_adl_request_broker.async_rpc_client import AsyncRabbitRPCClient
+from func_adl_request_broker.async_status_notifier import AsyncRabbitStatusListener, AsyncStatusNotifier
+from func_adl_request_broker.rpc_client import RPCTimeout
+from func_adl_request_broker.query_utils import BadASTException, MAX_AST_SIZE, ast_from_pickle, asts_from_pickle, page_files, paging_headers, pending_response, \
+    reply_timeout, request_metadata, result_from_info, rewrite_file_urls, ProgressEvents, SSE_KEEPALIVE
+from func_adl_request_broker.db_access import open_db
+from func_adl_request_broker.result_cache import result_cache_from_env
+from func_adl_request_broker.upload import ByteBudget, CopyingReader, ServerBusy, UploadTooLarge
+from func_adl_request_broker.metrics import CONTENT_TYPE, QUERY_STAGE_SECONDS, REGISTRY, RPC_CALL_SECONDS, TimedDBAccess
+from func_adl.xAOD.backend.ast.ast_hash import calc_ast_hash
+logging.basicConfig(level=logging.INFO)
+
+routes = web.RouteTableDef()
+
+# Results of queries that are done - they never change, so we need not ask the ingester again.
+result_cache = result_cache_from_env()
+result_cache.register_metrics()
+
+# The longest (seconds) a client can ask us to hold a status request open waiting for a change.
+MAX_STATUS_WAIT = float(os.environ.get('QUERY_MAX_WAIT', '60'))
+
+# How often (seconds) an event stream with nothing to say sends a keepalive, and how long it stays open
+EVENTS_KEEPALIVE = 15.0
+EVENTS_MAX_DURATION = 3600.0
+
+# The most bytes of queries this worker will hold in memory at once. Past that, new ones are turned away
+# with a 503 until some finish.
+upload_budget = ByteBudget(int(os.environ.get('QUERY_INFLIGHT_BYTES', str(4*MAX_AST_SIZE))))
+
+# Responses at least this big are compressed for clients that accept it
+MIN_COMPRESS_SIZE = int(os.environ.get('QUERY_COMPRESS_MIN_BYTES', '1024'))
+
+
+async def rpc_client_ctx(app:web.Application):
+    'Open the RPC client when the app starts, and close it when it shuts down'
+    client = AsyncRabbitRPCClient(os.environ['RABBIT_NODE'], os.environ['RABBIT_USER'], os.environ['RABBIT_PASS'])
+    await client.connect()
+    app['rpc_client'] = client
+    yield
+    await client.close()
+
+
+async def notifier_ctx(app:web.Application):
+    'Start listening for status changes from the state updater when the app starts'
+    app['notifier'] = AsyncStatusNotifier()
+    listener = AsyncRabbitStatusListener(app['notifier'])
+    await listener.connect(os.environ['RABBIT_NODE'], os.environ['RABBIT_USER'], os.environ['RABBIT_PASS'])
+    yield
+    await listener.close()
+
+
+def files_page(request:web.Request):
+    'The cursor and limit query parameters, for paging through the file list'
+    try:
+        cursor, limit = int(request.query.get('cursor', 0)), int(request.query.get('limit', 0))
+    except ValueError:
+        raise web.HTTPBadRequest(text='cursor and limit must be integers')
+    if cursor < 0 or limit < 0:
+        raise web.HTTPBadRequest(text='cursor and limit can not be negative')
+    return cursor, limit
+
+
+async def db_ctx(app:web.Application):
+    'Open the db (at MONGO_DB_SERVER) when the app starts'
+    app['db'] = TimedDBAccess(open_db(os.environ['MONGO_DB_SERVER']))
+    yield
+
+
+@routes.post('/query')
+async def query(request:web.Request):
+    r'''
+    Given a query (a pickled ast file), return the files or status. If the ingester does not
+    answer within QUERY_REPLY_TIMEOUT seconds a pending status is returned and the client should poll again.
+    The cursor and limit query parameters select a page of the file list (see GET /query/{hash}). The
+    X-Correlation-ID response header is the id to find the request by in the logs of the other services.
+    A new query waits its turn at find_did by its X-Client-ID and X-Dataset-Size-Hint headers. The query may be sent compressed (any Content-Encoding aiohttp can decode - gzip, deflate and, with the
+    right packages installed, br and zstd).
+    WARNING: Python AST's are a known security issue and should not be used.
+    '''
+    correlation_id = str(uuid.uuid4())
+    cursor, limit = files_page(request)
+    return await within_budget(request, functools.partial(run_query, correlation_id=correlation_id, cursor=cursor, limit=limit))
+
+
+async def within_budget(request:web.Request, handler) -> web.Response:
+    r'''
+    Run handler(request, reservation) with the upload's share of upload_budget, turning uploads that are
+    too big away with a 413, and ones there is no room for with a 503.
+    '''
+    try:
+        with upload_budget.reserve(request.content_length or 0) as reservation:
+            return await handler(request, reservation)
+    except UploadTooLarge as e:
+        raise web.HTTPRequestEntityTooLarge(MAX_AST_SIZE, request.content_length or 0, text=str(e))
+    except ServerBusy as e:
+        raise web.HTTPServiceUnavailable(text=str(e), headers={'Retry-After': '1'})
+
+
+async def read_upload(request:web.Request, reservation) -> CopyingReader:
+    r'''
+    Read the body of the POST, keeping it within MAX_AST_SIZE and the reservation as it arrives. It is
+    all read in before it is unpickled: unpickling as it arrives would hold a thread of the pool for as
+    long as the client takes to send it.
+    '''
+    # aiohttp has already undone any Content-Encoding.
+    reader = CopyingReader(None, MAX_AST_SIZE, reservation)
+    with QUERY_STAGE_SECONDS.time(stage='read'):
+        async for chunk in request.content.iter_chunked(65536):
+            reader.keep(chunk)
+    return reader
+
+
+async def run_query(request:web.Request, reservation, correlation_id:str, cursor:int, limit:int) -> web.Response:
+    'POST /query, once the upload has its share of the budget'
+    raw_data = (await read_upload(request, reservation)).data
+
+    # Unpickling a big AST is CPU work - keep it off the event loop.
+    try:
+        with QUERY_STAGE_SECONDS.time(stage='unpickle'):
+            a = await asyncio.get_running_loop().run_in_executor(None, ast_from_pickle, raw_data)
+    except BadASTException as e:
+        raise web.HTTPBadRequest(text=str(e))
+
+    # If this query has already finished, we already know the answer. Hashing a big AST is CPU work too.
+    with QUERY_STAGE_SECONDS.time(stage='hash'):
+        hash = await asyncio.get_running_loop().run_in_executor(None, calc_ast_hash, a)
+    with QUERY_STAGE_SECONDS.time(stage='cache'):
+        result = result_cache.get(hash)
+    if result is None:
+        logging.info(f"Sending a request ({correlation_id})")
+        start = time.perf_counter()
+        try:
+            headers = dict(request_metadata(request.headers.get), hash=hash, **paging_headers(cursor, limit))
+            reply = await request.app['rpc_client'].call(raw_data, timeout=reply_timeout(), headers=headers, correlation_id=correlation_id)
+            RPC_CALL_SECONDS.observe(time.perf_counter() - start, outcome='ok')
+            result = json.loads(reply)
+            result_cache.put(hash, result)
+        except RPCTimeout:
+            RPC_CALL_SECONDS.observe(time.perf_counter() - start, outcome='timeout')
+            logging.warning(f"Timed out waiting for a reply from the ingester ({correlation_id})")
+            result = pending_response()
+        QUERY_STAGE_SECONDS.observe(time.perf_counter() - start, stage='rpc')
+    result['hash'] = hash
+    page_files(result, cursor, limit)
+
+    with QUERY_STAGE_SECONDS.time(stage='rewrite'):
+        result = rewrite_file_urls(result)
+    return web.json_response(result, headers={'X-Correlation-ID': correlation_id})
+
+
+@routes.post('/queries')
+async def queries(request:web.Request):
+    r'''
+    Submit a pickled list of queries at once. They all go to the ingester in a single message. Returns
+    a list with the results of each query, in the order they were sent. The upload is held to the same
+    limits as POST /query.
+    WARNING: Python AST's are a known security issue and should not be used.
+    '''
+    return await within_budget(request, run_queries)
+
+
+def hash_asts(asts:list) -> list:
+    'The hash of each query of a batch. CPU work, so run it off the event loop.'
+    return [calc_ast_hash(a) for a in asts]
+
+
+def pickle_batch(asts:list) -> bytes:
+    'The message body of a batch for the ingester: a pickled list of the pickled ASTs. CPU work, so run it off the event loop.'
+    return pickle.dumps([pickle.dumps(a) for a in asts])
+
+
+async def run_queries(request:web.Request, reservation) -> web.Response:
+    'POST /queries, once the upload has its share of the budget'
+    reader = await read_upload(request, reservation)
+
+    loop = asyncio.get_running_loop()
+    try:
+        asts = await loop.run_in_executor(None, asts_from_pickle, reader.data)
+    except BadASTException as e:
+        raise web.HTTPBadRequest(text=str(e))
+    hashes = await loop.run_in_executor(None, hash_asts, asts)
+
+    # Skip the ones we know are done, and anything sent twice in the same batch.
+    results = {}
+    to_send = {}
+    for h, a in zip(hashes, asts):
+        if h not in results and h not in to_send:
+            r = result_cache.get(h)
+            if r is None:
+                to_send[h] = a
+            else:
+                results[h] = r
+
+    if len(to_send) > 0:
+        logging.info(f"Sending a batch of {len(to_send)} requests")
+        sent = list(to_send.keys())
+        body = await loop.run_in_executor(None, pickle_batch, list(to_send.values()))
+        try:
+            reply = await request.app['rpc_client'].call(body, timeout=reply_timeout(), headers=dict(request_metadata(request.headers.get), hashes=sent))
+            replies = json.loads(reply)
+        except RPCTimeout:
+            logging.warning("Timed out waiting for a reply from the ingester")
+            replies = [pending_response() for _ in sent]
+        for h, r in zip(sent, replies):
+            result_cache.put(h, r)
+            results[h] = r
+
+    return web.json_response([rewrite_file_urls(dict(results[h], hash=h)) for h in hashes])
+
+
+async def run_db(request:web.Request, method:str, *args, **kwargs):
+    'Call a method of the db. pymongo blocks, so it runs on the default thread pool.'
+    f = functools.partial(getattr(request.app['db'], method), *args, **kwargs)
+    return await asyncio.get_running_loop().run_in_executor(None, f)
+
+
+async def lookup_page(request:web.Request, hash:str, cursor:int = 0, limit:int = 0):
+    'Look up a request, loading only the files from cursor on (at most limit of them, 0 for all)'
+    return await run_db(request, 'lookup_results', hash, files_from=cursor, max_files=limit if limit > 0 else None)
+
+
+async def lookup_after_change(request:web.Request, hash:str, wait:float, cursor:int = 0, limit:int = 0):
+    'Look up a request, waiting up to wait seconds for it to change first if it is not done'
+    notifier = request.app['notifier']
+    # Subscribe before looking so a change between the two isn't missed.
+    events = notifier.subscribe(hash)
+    try:
+        info = await lookup_page(request, hash, cursor, limit)
+        if info is None or info.done:
+            return info
+        try:
+            await asyncio.wait_for(events.get(), wait)
+        except asyncio.TimeoutError:
+            return info
+        return await lookup_page(request, hash, cursor, limit)
+    finally:
+        notifier.unsubscribe(hash, events)
+
+
+@routes.get('/query/{hash}')
+async def query_status(request:web.Request):
+    r'''
+    Return the files or status of a query that has already been submitted, by the hash POST /query returned.
+    Only the files from the cursor query parameter on are returned, at most limit of them (0, the default,
+    for all). Pass back the next_cursor of the result to get just the files that have arrived since. With
+    wait, a query that isn't done is held until it changes, or that many seconds (at most QUERY_MAX_WAIT)
+    have passed. Waiting costs nothing but the connection.
+    '''
+    hash = request.match_info['hash']
+    cursor, limit = files_page(request)
+    try:
+        wait = min(float(request.query.get('wait', 0)), MAX_STATUS_WAIT)
+    except ValueError:
+        raise web.HTTPBadRequest(text='wait must be a number')
+    result = result_cache.get(hash)
+    if result is not None:
+        page_files(result, cursor, limit)
+    else:
+        info = await lookup_after_change(request, hash, wait, cursor, limit) if wait > 0 else await lookup_page(request, hash, cursor, limit)
+        if info is None:
+            raise web.HTTPNotFound(text=f'No query with hash {hash} is known')
+        result = result_from_info(info)
+        if cursor == 0 and limit == 0:
+            result_cache.put(hash, result)
+        result['next_cursor'] = cursor + len(result['files'])
+    result['hash'] = hash
+
+    return web.json_response(rewrite_file_urls(result))
+
+
+@routes.get('/query/{hash}/events')
+async def query_events(request:web.Request):
+    r'''
+    Stream the progress of a query as Server-Sent Events (see ProgressEvents). Files are pushed as soon
+    as the state updater records them, so a client can start on the first files while the rest are
+    still being made.
+    '''
+    hash = request.match_info['hash']
+    notifier = request.app['notifier']
+    events = notifier.subscribe(hash)
+    try:
+        info = await run_db(request, 'lookup_results', hash)
+        if info is None:
+            raise web.HTTPNotFound(text=f'No query with hash {hash} is known')
+
+        response = web.StreamResponse(headers={'Content-Type': 'text/event-stream', 'Cache-Control': 'no-cache'})
+        await response.prepare(request)
+        progress = ProgressEvents(info)
+        end_time = time.monotonic() + EVENTS_MAX_DURATION
+        while True:
+            while len(progress.chunks) > 0:
+                await response.write(progress.chunks.popleft())
+            if progress.finished or time.monotonic() > end_time:
+                break
+            try:
+                progress.on_event(await asyncio.wait_for(events.get(), EVENTS_KEEPALIVE))
+            except asyncio.TimeoutError:
+                await response.write(SSE_KEEPALIVE)
+        await response.write_eof()
+        return response
+    finally:
+        notifier.unsubscribe(hash, events)
+
+
+@routes.get('/query/{hash}/log')
+async def query_log(request:web.Request):
+    r'''
+    Stream back the full crash log of a query. The /query result only has the last few lines
+    of it, and a log_ref, the hash to use here.
+    '''
+    hash = request.match_info['hash']
+    log = await run_db(request, 'open_log', hash)
+    if log is None:
+        raise web.HTTPNotFound(text=f'No log found for {hash}')
+    try:
+        response = web.StreamResponse(headers={'Content-Type': 'text/plain; charset=utf-8'})
+        await response.prepare(request)
+        loop = asyncio.get_running_loop()
+        while True:
+            chunk = await loop.run_in_executor(None, log.read, 65536)
+            if len(chunk) == 0:
+                break
+            await response.write(chunk)
+        await response.write_eof()
+        return response
+    finally:
+        log.close()
+
+
+@routes.get('/admin/queries')
+async def list_queries(request:web.Request):
+    r'''
+    Page through the queries the broker knows about, newest first. The query parameters are phase, min_age
+    and max_age (seconds since they were submitted), cursor (the next_cursor of the previous page) and limit.
+    Returns {'queries': [...], 'next_cursor': ...}, just as the hug front end does.
+    '''
+    q = request.query
+    try:
+        min_age, max_age, limit = float(q.get('min_age', 0)), float(q.get('max_age', 0)), int(q.get('limit', 50))
+        page, next_cursor = await run_db(request, 'list_requests', phase=q.get('phase') or None, min_age=min_age or None,
+                                         max_age=max_age or None, cursor=q.get('cursor') or None, limit=limit)
+    except ValueError as e:
+        raise web.HTTPBadRequest(text=str(e))
+    return web.json_response({'queries': page, 'next_cursor': next_cursor})
+
+
+@routes.get('/metrics')
+async def metrics(request:web.Request):
+    'Timings and counters of this worker, for Prometheus to scrape'
+    return web.Response(body=REGISTRY.render().encode('utf-8'), headers={'Content-Type': CONTENT_TYPE})
+
+
+@routes.get('/cache/stats')
+async def cache_stats(request:web.Request):
+    'Hit/miss counters for the completed query cache'
+    return web.json_response(result_cache.stats())
+
+
+@web.middleware
+async def compress_response(request:web.Request, handler):
+    'Compress big responses (a long file list compresses well) for clients that say they can take it'
+    response = await handler(request)
+    if isinstance(response, web.Response) and response.body is not None and len(response.body) >= MIN_COMPRESS_SIZE:
+        # Picks gzip or deflate from the request's Accept-Encoding, or leaves it alone if neither is there
+        response.enable_compression()
+    return response
+
+
+def make_app() -> web.Application:
+    'Build the web application'
+    # Anything larger than the biggest AST we accept is rejected before we read it.
+    app = web.Application(client_max_size=MAX_AST_SIZE, middlewares=[compress_response])
+    app.add_routes(routes)
+    app.cleanup_ctx.append(rpc_client_ctx)
+    app.cleanup_ctx.append(db_ctx)
+    app.cleanup_ctx.append(notifier_ctx)
+    return app
+
+app = make_app()
+
+if __name__ == '__main__':
+    web.run_app(app, port=8000)
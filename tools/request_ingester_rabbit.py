@@ -6,48 +6,307 @@ import base64
 import json
 import pika
 import os
-from func_adl_request_broker.db_access import FuncADLDBAccess, ADLRequestInfo
+import time
+import zlib
+from typing import Dict, List, Optional
+from func_adl_request_broker.db_access import ADLRequestInfo, hash_from_arg, open_db
+from func_adl_request_broker.query_utils import CLIENT_ID_HEADER, FILES_FROM_HEADER, MAX_FILES_HEADER, MAX_PRIORITY, SIZE_HINT_HEADER, \
+    priority_from_size_hint, result_from_info
+from func_adl_request_broker.metrics import FAIR_SHARE_DEPTH, FAIR_SHARE_DISPATCHED, FAIR_SHARE_QUEUED, FAIR_SHARE_WAIT_SECONDS, FIND_DID_DEPTH, \
+    INGESTER_STAGE_SECONDS, MESSAGES_PUBLISHED, SENT_AT_HEADER, TimedDBAccess, metrics_dump_from_env, observe_queue_wait
 import logging
 
-def process_message(db, ch, method, properties, body):
-    'Process the incoming message'
+def hash_from_message(properties, body) -> Optional[str]:
+    r'''
+    Find the hash of the request. The web front end computes it and sends it in the headers. If it isn't
+    there (an older sender), unpickle the AST and hash it ourselves.
+
+    Returns:
+        The hash, or None if the body isn't an AST.
+    '''
+    if properties.headers is not None and 'hash' in properties.headers:
+        return properties.headers['hash']
 
-    # Get the AST out of the body of the message.
     a = pickle.loads(body)
     if a is None or not isinstance(a, ast.AST):
         logging.warning (f"Body of message wasn't of type AST: {a}")
-        ch.basic_ack(delivery_tag=method.delivery_tag)
-        return
+        return None
+    return hash_from_arg(a)
 
-    # Great. Next - see if we know about this already.
-    status = db.lookup_results(a)
-    
-    # If we know nothing about this, then fire off a new task
-    if status is None:
-        status = db.save_results(a, ADLRequestInfo(done=False, files=[], jobs=-1, phase='waiting_for_data', hash='', log=None, message=None))
+# Who a request is for, if the client didn't say
+ANONYMOUS_TENANT = 'anonymous'
+
+# The header a request waiting for its turn at find_did carries the time it started waiting in
+QUEUED_AT_HEADER = 'queued_at'
+
+def fair_share_queue(bucket:int) -> str:
+    'The queue requests in a fair share bucket wait in for their turn at find_did'
+    return f'find_did.fair.{bucket}'
+
+class FairDispatcher:
+    r'''
+    Shares find_did out fairly between clients. New requests don't go to find_did straight away, but to
+    one of n_buckets queues, picked by client id, so all of a client's requests wait in the same one. The
+    dispatcher keeps find_did topped up to target_depth requests by taking them from those queues in turn -
+    weighted round robin, each bucket giving up to its weight of requests a turn - so a client who sends
+    hundreds of requests holds the others up by only a request or so each. The bucket queues are priority
+    queues, so within a bucket requests go by AMQP priority (see priority_from_size_hint) and small queries
+    overtake big ones.
+
+    The waiting requests are all in RabbitMQ, so none are lost if the ingester restarts, and find_did is
+    still a plain queue, so its consumers don't change. Clients whose ids land in the same bucket share it.
+
+    Only the buckets thought to have requests in them are asked for one: those this dispatcher sent
+    requests to, and every rescan seconds all of them (other ingesters send to them too).
+    '''
+    def __init__(self, channel, n_buckets:int, target_depth:int = 10, interval:float = 0.1, weights:Optional[Dict[str, int]] = None,
+                 rescan:float = 1.0):
+        r'''
+        Arguments:
+            channel         Where to declare the queues and move the requests
+            n_buckets       Number of fair share queues
+            target_depth    How many requests to keep waiting in find_did. Fewer makes the sharing fairer, but
+                            find_did's consumers may run dry between checks.
+            interval        Seconds between checks of how many requests find_did has left
+            weights         Client id -> how many requests its bucket gives up each turn (default 1)
+            rescan          Seconds between looks in every bucket, for requests other ingesters queued
+        '''
+        self._channel = channel
+        self._n_buckets = n_buckets
+        self._target_depth = target_depth
+        self._interval = interval
+        self._weights = [1] * n_buckets
+        for tenant, weight in (weights or {}).items():
+            b = self.bucket_of(tenant)
+            self._weights[b] = max(self._weights[b], weight)
+        self._bucket = 0
+        self._taken = 0
+        self._depth = 0
+        self._rescan = rescan
+        self._last_scan = time.monotonic()
+        # Buckets that may have requests waiting - to start with, any of them (left from before a restart)
+        self._pending = set(range(n_buckets))
+
+        for b in range(n_buckets):
+            channel.queue_declare(queue=fair_share_queue(b), arguments={'x-max-priority': MAX_PRIORITY})
+        channel.connection.call_later(interval, self._on_timer)
+
+    def bucket_of(self, tenant:str) -> int:
+        'The bucket a client\'s requests wait in. crc32 so it does not change from run to run.'
+        return zlib.crc32(tenant.encode('utf-8')) % self._n_buckets
+
+    def submit(self, tenant:str, properties:pika.BasicProperties, body:bytes):
+        'Queue a request for find_did, and pass on requests up to the turn of its bucket if find_did has room'
+        bucket = self.bucket_of(tenant)
+        properties.headers[QUEUED_AT_HEADER] = time.time()
+        self._channel.basic_publish(exchange='', routing_key=fair_share_queue(bucket), properties=properties, body=body)
+        FAIR_SHARE_QUEUED.inc(bucket=bucket)
+        self._pending.add(bucket)
+        self.pump(until=bucket)
+
+    def pump(self, until:Optional[int] = None):
+        r'''
+        Move requests to find_did, in turn, until it has target_depth of them or there are none left.
+
+        Arguments:
+            until           Stop once this bucket has had its turn
+        '''
+        while self._depth < self._target_depth and len(self._pending) > 0:
+            if self._taken >= self._weights[self._bucket] or self._bucket not in self._pending:
+                self._bucket = (self._bucket + 1) % self._n_buckets
+                self._taken = 0
+                continue
+            bucket = self._bucket
+            method, properties, body = self._channel.basic_get(queue=fair_share_queue(bucket))
+            left = 0 if method is None else method.message_count
+            FAIR_SHARE_DEPTH.set(left, bucket=bucket)
+            if left == 0:
+                self._pending.discard(bucket)
+            if method is not None:
+                self._forward(method, properties, body)
+            if bucket == until:
+                break
+        FIND_DID_DEPTH.set(self._depth)
+
+    def _forward(self, method, properties:pika.BasicProperties, body:bytes):
+        'Pass a request taken from the current bucket on to find_did'
+        self._channel.basic_publish(exchange='', routing_key='find_did', properties=properties, body=body)
+        self._channel.basic_ack(delivery_tag=method.delivery_tag)
+        self._taken += 1
+        self._depth += 1
+
+        headers = properties.headers or {}
+        FAIR_SHARE_DISPATCHED.inc(bucket=self._bucket)
+        if QUEUED_AT_HEADER in headers:
+            FAIR_SHARE_WAIT_SECONDS.observe(max(0.0, time.time() - float(headers[QUEUED_AT_HEADER])), bucket=self._bucket)
+        MESSAGES_PUBLISHED.inc(queue='find_did')
+
+    def _on_timer(self):
+        if time.monotonic() - self._last_scan >= self._rescan:
+            self._pending.update(range(self._n_buckets))
+            self._last_scan = time.monotonic()
+        self._depth = self._channel.queue_declare(queue='find_did', passive=True).method.message_count
+        self.pump()
+        self._channel.connection.call_later(self._interval, self._on_timer)
+
+def start_request(ch, hash:str, body:bytes, legacy_find_did:bool, correlation_id:Optional[str] = None,
+                  metadata:Optional[dict] = None, dispatcher:Optional[FairDispatcher] = None):
+    r'''
+    Send a new request off to find_did. The pickled AST goes along untouched. The correlation id of the
+    request that started it goes along too, so it can be traced through find_did.
+
+    Arguments:
+        metadata            Who the request is for and how big it is (see query_utils.request_metadata). It
+                            sets the request's AMQP priority, and goes along in the headers. The priority only
+                            counts in a priority queue: the fair share queues, or find_did if it was declared
+                            as one (see setup_consumers).
+        dispatcher          If given, the request waits its turn with the dispatcher rather than going straight
+                            to find_did.
+    '''
+    logging.info (f'Running new request: {hash} ({correlation_id})')
+    metadata = metadata or {}
+    priority = priority_from_size_hint(metadata.get(SIZE_HINT_HEADER))
+    headers = dict(metadata, **{SENT_AT_HEADER: time.time()})
+    if legacy_find_did:
         finder_message = {
-            'hash': status.hash,
-            'ast': base64.b64encode(pickle.dumps(a)).decode(),
+            'hash': hash,
+            'ast': base64.b64encode(body).decode(),
         }
-        logging.info (f'Running new request: {status.hash}')
-        ch.basic_publish(exchange='', routing_key='find_did', body=json.dumps(finder_message))
+        properties = pika.BasicProperties(correlation_id=correlation_id, priority=priority, headers=headers)
+        body = json.dumps(finder_message)
+    else:
+        properties = pika.BasicProperties(content_type='application/x-python-pickle', correlation_id=correlation_id,
+                                          priority=priority, headers=dict(headers, hash=hash))
+    if dispatcher is not None:
+        dispatcher.submit(metadata.get(CLIENT_ID_HEADER, ANONYMOUS_TENANT), properties, body)
+    else:
+        ch.basic_publish(exchange='', routing_key='find_did', properties=properties, body=body)
+        MESSAGES_PUBLISHED.inc(queue='find_did')
+
+def new_request_info() -> ADLRequestInfo:
+    'What we record for a request we have never seen before'
+    return ADLRequestInfo(done=False, files=[], jobs=-1, phase='waiting_for_data', hash='', log=None, message=None)
+
+def process_batch(db, ch, hashes:List[str], bodies:List[bytes], legacy_find_did:bool, correlation_id:Optional[str] = None,
+                  metadata:Optional[dict] = None, dispatcher:Optional[FairDispatcher] = None) -> List[ADLRequestInfo]:
+    r'''
+    Claim a batch of requests, starting the ones that are new.
+
+    Arguments:
+        hashes              The hashes of the requests, without duplicates
+        bodies              The pickled AST of each request
+        metadata            Who the requests are for (see start_request)
+
+    Returns:
+        The status of each request, in the same order
+    '''
+    with INGESTER_STAGE_SECONDS.time(stage='claim'):
+        claims = db.claim_requests(hashes, new_request_info())
+    with INGESTER_STAGE_SECONDS.time(stage='find_did'):
+        for (status, created), body in zip(claims, bodies):
+            if created:
+                start_request(ch, status.hash, body, legacy_find_did, correlation_id, metadata, dispatcher)
+    logging.info (f'Batch of {len(hashes)} requests, {sum(1 for _, c in claims if c)} new ({correlation_id}).')
+    return [status for status, _ in claims]
+
+def process_message(db, ch, method, properties, body, legacy_find_did:bool = False, dispatcher:Optional[FairDispatcher] = None):
+    r'''
+    Process the incoming message. It is either a single request (the hash in the 'hash' header and the
+    pickled AST as the body), or a batch of them (the hashes in the 'hashes' header and the body a pickled
+    list of the pickled ASTs). The reply is the status, or a list of them for a batch. A single request can
+    ask for just a page of the file list with the files_from and max_files headers; the reply then has the
+    next_cursor.
+
+    Arguments:
+        legacy_find_did     If true, send find_did the old JSON message with the base64 encoded AST
+                            instead of forwarding the pickled AST as is.
+        dispatcher          If given, new requests wait their turn at find_did with it (see FairDispatcher)
+    '''
+    observe_queue_wait('as_request', properties)
+    correlation_id = properties.correlation_id
+    metadata = {k: v for k, v in (properties.headers or {}).items() if k in (CLIENT_ID_HEADER, SIZE_HINT_HEADER)}
+    if properties.headers is not None and 'hashes' in properties.headers:
+        with INGESTER_STAGE_SECONDS.time(stage='unpickle'):
+            bodies = pickle.loads(body)
+        statuses = process_batch(db, ch, properties.headers['hashes'], bodies, legacy_find_did, correlation_id, metadata, dispatcher)
+        reply = [result_from_info(s) for s in statuses]
     else:
-        logging.info (f'Request already running: {status.hash} Phase: {status.phase} Files: {status.files}')
+        with INGESTER_STAGE_SECONDS.time(stage='hash'):
+            hash = hash_from_message(properties, body)
+        if hash is None:
+            ch.basic_ack(delivery_tag=method.delivery_tag)
+            return
+
+        # Great. Next - see if we know about this already, and if not, record it. This is atomic, so
+        # if several ingesters see the same request at once only one of them will start it.
+        headers = properties.headers or {}
+        files_from = int(headers.get(FILES_FROM_HEADER, 0))
+        max_files = headers.get(MAX_FILES_HEADER)
+        with INGESTER_STAGE_SECONDS.time(stage='claim'):
+            status, created = db.claim_request(hash, new_request_info(), files_from, None if max_files is None else int(max_files))
+
+        # If we know nothing about this, then fire off a new task.
+        if created:
+            with INGESTER_STAGE_SECONDS.time(stage='find_did'):
+                start_request(ch, status.hash, body, legacy_find_did, correlation_id, metadata, dispatcher)
+        else:
+            logging.info (f'Request already running: {status.hash} Phase: {status.phase} Files: {len(status.files or [])} ({correlation_id})')
+        reply = result_from_info(status)
+        if files_from > 0 or max_files is not None:
+            reply['next_cursor'] = files_from + len(reply['files'] or [])
 
     # Next, we have to let everyone know the thing is off and going (or done, or whatever).
-    ch.basic_publish(exchange='',
-        routing_key=properties.reply_to,
-        properties=pika.BasicProperties(correlation_id = properties.correlation_id),
-        body=json.dumps({'files': status.files, 'phase': status.phase, 'done': status.done, 'jobs': status.jobs, 'log': status.log, 'message': status.message}))
+    with INGESTER_STAGE_SECONDS.time(stage='reply'):
+        ch.basic_publish(exchange='',
+            routing_key=properties.reply_to,
+            properties=pika.BasicProperties(correlation_id = properties.correlation_id),
+            body=json.dumps(reply))
     
     # Done!
     ch.basic_ack(delivery_tag=method.delivery_tag)
 
-def listen_to_queue(rabbit_node:str, mongo_db_server:str, rabbit_user:str, rabbit_pass:str):
+def setup_consumers(channel, db, legacy_find_did:bool = False, fair_share_buckets:int = 0, target_depth:int = 10,
+                    weights:Optional[Dict[str, int]] = None, find_did_max_priority:int = 0):
+    r'''
+    Declare the queues we use and attach the request handler.
+
+    Arguments:
+        fair_share_buckets  If more than 0, new requests are shared out to find_did fairly between clients,
+                            through this many queues (see FairDispatcher). Otherwise they go straight there.
+        target_depth        How many requests the fair share dispatcher keeps waiting in find_did
+        weights             Client id -> its share of find_did, relative to the default of 1
+        find_did_max_priority   If more than 0, find_did is declared as a priority queue with this many levels,
+                            so requests for small datasets are taken first. RabbitMQ can't change a queue that
+                            is already there, so find_did has to be deleted (once empty) before this is turned
+                            on or off, and find_did's consumers must declare it the same way.
+    '''
+    # as_reqeusts - the queue where the initial requests come in on.
+    channel.queue_declare(queue='as_request')
+
+    # find_did - where we send out on the first step when some work needs to be done.
+    channel.queue_declare(queue='find_did', arguments={'x-max-priority': find_did_max_priority} if find_did_max_priority > 0 else None)
+
+    dispatcher = FairDispatcher(channel, fair_share_buckets, target_depth=target_depth, weights=weights) if fair_share_buckets > 0 else None
+
+    # And setup our listener
+    channel.basic_consume(queue='as_request', on_message_callback=lambda ch, method, properties, body: process_message(db, ch, method, properties, body, legacy_find_did, dispatcher), auto_ack=False)
+
+def tenant_weights(text:str) -> Dict[str, int]:
+    'Parse client weights written as client1=2,client2=3'
+    weights = {}
+    for item in text.split(','):
+        if '=' in item:
+            tenant, weight = item.rsplit('=', 1)
+            weights[tenant.strip()] = int(weight)
+    return weights
+
+def listen_to_queue(rabbit_node:str, mongo_db_server:str, rabbit_user:str, rabbit_pass:str, legacy_find_did:bool = False,
+                    fair_share_buckets:int = 0, target_depth:int = 10, weights:Optional[Dict[str, int]] = None,
+                    find_did_max_priority:int = 0):
     'Download and pass on datasets as we see them'
 
     # Save the connection to the mongo db.
-    db = FuncADLDBAccess(mongo_db_server)
+    db = TimedDBAccess(open_db(mongo_db_server))
 
     # Connect and setup the queues we will listen to and push once we've done.
     if rabbit_pass in os.environ:
@@ -55,15 +314,8 @@ def listen_to_queue(rabbit_node:str, mongo_db_server:str, rabbit_user:str, rabbi
     credentials = pika.PlainCredentials(rabbit_user, rabbit_pass)
     connection = pika.BlockingConnection(pika.ConnectionParameters(host=rabbit_node, credentials=credentials))
     channel = connection.channel()
-
-    # as_reqeusts - the queue where the initial requests come in on.
-    channel.queue_declare(queue='as_request')
-
-    # find_did - where we send out on the first step when some work needs to be done.
-    channel.queue_declare(queue='find_did')
-
-    # And setup our listener
-    channel.basic_consume(queue='as_request', on_message_callback=lambda ch, method, properties, body: process_message(db, ch, method, properties, body), auto_ack=False)
+    setup_consumers(channel, db, legacy_find_did, fair_share_buckets=fair_share_buckets, target_depth=target_depth, weights=weights,
+                    find_did_max_priority=find_did_max_priority)
 
     # We are setup. Off we go. We'll never come back.
     channel.start_consuming()
@@ -76,4 +328,14 @@ if __name__ == '__main__':
         print ("Usage: python request_ingester_rabbit.py <rabbit-mq-node-address> <mongo-db-server> <rabbit-username> <rabbit-password>")
     else:
         logging.info ("Starting up ingester...")
-        listen_to_queue (sys.argv[1], sys.argv[2], sys.argv[3], sys.argv[4])
\ No newline at end of file
+        metrics_dump_from_env()
+        # Consumers of find_did that still want the JSON message with the base64 AST set FIND_DID_LEGACY_JSON.
+        # Fair sharing of find_did between clients is turned on by setting FIND_DID_FAIR_SHARE_BUCKETS. Requests
+        # for small datasets only go first within the fair share queues, unless find_did itself is made a
+        # priority queue with FIND_DID_MAX_PRIORITY (delete find_did first - see setup_consumers).
+        listen_to_queue (sys.argv[1], sys.argv[2], sys.argv[3], sys.argv[4],
+                         legacy_find_did=os.environ.get('FIND_DID_LEGACY_JSON', '') not in ('', '0', 'false'),
+                         fair_share_buckets=int(os.environ.get('FIND_DID_FAIR_SHARE_BUCKETS', '0')),
+                         target_depth=int(os.environ.get('FIND_DID_TARGET_DEPTH', '10')),
+                         weights=tenant_weights(os.environ.get('FIND_DID_TENANT_WEIGHTS', '')),
+                         find_did_max_priority=int(os.environ.get('FIND_DID_MAX_PRIORITY', '0')))
\ No newline at end of file
@@ -3,108 +3,650 @@ import pika
 import json
 import sys
 import os
-from func_adl_request_broker.db_access import FuncADLDBAccess, ADLRequestInfo
+import threading
+import time
+import zlib
+from collections import deque
+from functools import partial
+from typing import Callable, Dict, Optional
+from func_adl_request_broker.db_access import DB_ERRORS, open_db
+from func_adl_request_broker.metrics import EVENTS_EXPIRED, EVENTS_HELD, EVENTS_REPLAYED, HANDLER_SECONDS, MESSAGES_PUBLISHED, UPDATES_COALESCED, TimedDBAccess, metrics_dump_from_env, observe_queue_wait
+from func_adl_request_broker.status_notifier import declare_status_exchange, publish_status_event
 import logging
 
-def process_add_file(db, ch, method, properties, body):
+# The queues status messages come in on. When the updates are spread over several workers, each worker
+# has its own copy of each queue (see shard_queue).
+STATUS_QUEUES = ('status_add_file', 'status_change_state', 'status_number_jobs', 'crashed_request')
+
+def shard_of(hash:str, n_shards:int) -> int:
+    'The worker that handles all the updates for a request. crc32 so it does not change from run to run.'
+    return zlib.crc32(hash.encode('utf-8')) % n_shards
+
+def shard_queue(queue:str, shard:Optional[int]) -> str:
+    'The name of a worker\'s copy of a status queue (shard None is the queue itself)'
+    return queue if shard is None else f'{queue}.{shard}'
+
+class EarlyEvents:
+    r'''
+    Holds status messages that arrive before the ingester has written their request to the db (find_did
+    can beat the ingester's save), rather than dropping them. A request's messages are retried together, in
+    the order they came in, first after first_retry seconds and then backing off up to every max_retry
+    seconds, until they can be applied or they are max_age seconds old. Once a request has messages held,
+    any more for it are held behind them, so they are still applied in order.
+
+    The messages stay un-acked while they are held, so none are lost if the updater restarts. If there is a
+    prefetch limit, keep max_events below it, or a full buffer will stop the worker taking new messages
+    until the held ones expire.
+    '''
+    def __init__(self, connection, max_events:int = 1000, max_age:float = 60.0, first_retry:float = 0.1, max_retry:float = 5.0):
+        self._connection = connection
+        self._max_events = max_events
+        self._max_age = max_age
+        self._first_retry = first_retry
+        self._max_retry = max_retry
+        # hash -> deque of (queue, apply, ack, what, expires), oldest first
+        self._held: Dict[str, deque] = {}
+        # hash -> (timer, delay) of the next retry
+        self._timers: Dict[str, tuple] = {}
+        self._n_held = 0
+
+    def __len__(self) -> int:
+        return self._n_held
+
+    def holding(self, hash:str) -> bool:
+        'True if there are messages held for this request'
+        return hash in self._held
+
+    def hold(self, queue:str, hash:str, apply:Callable[[], bool], ack:Callable[[], None], what:str):
+        r'''
+        Hold a message until its request turns up.
+
+        Arguments:
+            queue               The queue the message came in on (for the metrics)
+            hash                The request it updates
+            apply               Makes the update. Returns False if the request still isn't there.
+            ack                 Acks the message
+            what                What the message does, for the log
+        '''
+        if self._n_held >= self._max_events:
+            print(f'Too many status messages held ({self._n_held}). Ignoring {what} for hash {hash}.')
+            EVENTS_EXPIRED.inc(queue=queue, reason='full')
+            ack()
+            return
+        self._held.setdefault(hash, deque()).append((queue, apply, ack, what, time.monotonic() + self._max_age))
+        self._n_held += 1
+        EVENTS_HELD.inc(queue=queue)
+        if hash not in self._timers:
+            self._schedule(hash, self._first_retry)
+
+    def replay(self, hash:str):
+        'Apply the messages held for a request, in order, up to the first that still can not be'
+        held = self._held.get(hash)
+        while held:
+            queue, apply, ack, _, _ = held[0]
+            if not apply():
+                break
+            held.popleft()
+            self._n_held -= 1
+            ack()
+            EVENTS_REPLAYED.inc(queue=queue)
+        self._forget_if_empty(hash)
+
+    def _schedule(self, hash:str, delay:float):
+        self._timers[hash] = (self._connection.call_later(delay, partial(self._on_timer, hash)), delay)
+
+    def _on_timer(self, hash:str):
+        _, delay = self._timers.pop(hash)
+        try:
+            self.replay(hash)
+        except Exception:
+            # This runs inside pika's event loop - anything that got out would stop the consumer. The
+            # messages stay held, and are tried again on the next retry (or expire).
+            logging.exception(f'Failed to apply the status messages held for {hash}. Will try again.')
+        self._expire(hash)
+        if hash in self._held:
+            self._schedule(hash, min(2*delay, self._max_retry))
+
+    def _expire(self, hash:str):
+        'Give up on the messages for a request that have been held too long'
+        held = self._held.get(hash)
+        now = time.monotonic()
+        while held and held[0][4] <= now:
+            queue, _, ack, what, _ = held.popleft()
+            self._n_held -= 1
+            print(f'Unable to find an entry for hash {hash} after {self._max_age} seconds. Ignoring {what}.')
+            EVENTS_EXPIRED.inc(queue=queue, reason='timeout')
+            ack()
+        self._forget_if_empty(hash)
+
+    def _forget_if_empty(self, hash:str):
+        if hash in self._held and len(self._held[hash]) == 0:
+            del self._held[hash]
+            if hash in self._timers:
+                self._connection.remove_timeout(self._timers.pop(hash)[0])
+
+def apply_or_hold(early:Optional[EarlyEvents], queue:str, hash:str, apply:Callable[[], bool], ch, method, what:str):
+    r'''
+    Make the update a status message asks for, and ack it. If the request isn't in the db yet, or earlier
+    messages for it are being held, hold the message in early to try again later (without early, it is
+    dropped).
+    '''
+    ack = partial(ch.basic_ack, delivery_tag=method.delivery_tag)
+    if early is not None and early.holding(hash):
+        early.hold(queue, hash, apply, ack, what)
+        early.replay(hash)
+    elif apply():
+        ack()
+    elif early is not None:
+        early.hold(queue, hash, apply, ack, what)
+    else:
+        print(f'Unable to find an entry for hash {hash}. Ignoring {what}.')
+        ack()
+
+def process_add_file(db, ch, method, properties, body, early:Optional[EarlyEvents] = None):
     info = json.loads(body)
     hash = info['hash']
     file_ref = info['file']
     treename = info['treename']
 
-    # Update state. Just silently ignore if this thing isn't there.
-    state = db.lookup_results(hash)
-    if state is not None:
-        new_files = list(state.files)
-        new_files.append((file_ref, treename))
-        new_files = list(set(new_files))
-        new_done = len(new_files) >= state.jobs
-        new_state = ADLRequestInfo(done=new_done, files=new_files, jobs=state.jobs, phase=state.phase, hash=state.hash if not new_done else 'done', log=state.log, message=state.message)
-        db.save_results(hash, new_state)
-    else:
-        print(f'Unable to find an entry for hash {hash}. Ignoring adding file {file_ref}.')
+    def apply() -> bool:
+        if not db.add_file(hash, file_ref, treename):
+            return False
+        publish_status_event(ch, hash, 'file', properties.correlation_id, file=file_ref, treename=treename)
+        return True
+    apply_or_hold(early, 'status_add_file', hash, apply, ch, method, f'adding file {file_ref}')
+
+class AddFileBatcher:
+    r'''
+    Collects status_add_file messages and writes them to the db in one go, either when max_items messages
+    have come in or max_wait seconds after the first one did, whichever is first. Files for the same request
+    are merged into a single update. The messages are only acked once the write has succeeded - if it fails
+    they are put back on the queue. Files for requests that aren't in the db yet are handed to early, if
+    given, to be added when the request turns up.
+    '''
+    def __init__(self, db, connection, max_items:int, max_wait:float, early:Optional[EarlyEvents] = None):
+        self._db = db
+        self._connection = connection
+        self._max_items = max_items
+        self._max_wait = max_wait
+        self._early = early
+        self._pending = []
+        self._timer = None
+
+    def on_message(self, ch, method, properties, body):
+        'Queue up the file to be written'
+        info = json.loads(body)
+        if self._early is not None and self._early.holding(info['hash']):
+            # Has to wait its turn behind the ones already held
+            apply_or_hold(self._early, 'status_add_file', info['hash'], partial(self._add_one, ch, info), ch, method, f'adding file {info["file"]}')
+            return
+        self._pending.append((ch, method.delivery_tag, info))
+        if len(self._pending) >= self._max_items:
+            self.flush()
+        elif self._timer is None:
+            self._timer = self._connection.call_later(self._max_wait, self._on_timer)
+
+    def _add_one(self, ch, info:dict) -> bool:
+        'Add a single (held) file'
+        if not self._db.add_file(info['hash'], info['file'], info['treename']):
+            return False
+        publish_status_event(ch, info['hash'], 'file', file=info['file'], treename=info['treename'])
+        return True
+
+    def _on_timer(self):
+        self._timer = None
+        self.flush()
+
+    def flush(self):
+        'Write everything we are holding to the db and ack it'
+        if self._timer is not None:
+            self._connection.remove_timeout(self._timer)
+            self._timer = None
+        if len(self._pending) == 0:
+            return
+        pending, self._pending = self._pending, []
+
+        # Merge the files for each request, keeping the order they arrived in
+        files = {}
+        for _, _, info in pending:
+            entries = files.setdefault(info['hash'], [])
+            entry = (info['file'], info['treename'])
+            if entry not in entries:
+                entries.append(entry)
+
+        try:
+            n_found = self._db.add_files(files)
+            missing = set()
+            if n_found != len(files) and self._early is not None:
+                # Find out which ones weren't there. Adding the files again is harmless for those that were.
+                missing = {h for h, entries in files.items() if self._db.add_files({h: entries}) == 0}
+        except DB_ERRORS as e:
+            logging.error(f'Failed to write {len(pending)} files to the db ({e}). Returning them to the queue.')
+            for ch, tag, _ in pending:
+                ch.basic_nack(delivery_tag=tag, requeue=True)
+            return
 
-    ch.basic_ack(delivery_tag=method.delivery_tag)
+        if n_found != len(files) and self._early is None:
+            print(f'Unable to find entries for {len(files) - n_found} of {len(files)} hashes. Ignoring the files added to them.')
+        for ch, tag, info in pending:
+            if info['hash'] in missing:
+                self._early.hold('status_add_file', info['hash'], partial(self._add_one, ch, info),
+                                 partial(ch.basic_ack, delivery_tag=tag), f'adding file {info["file"]}')
+            else:
+                ch.basic_ack(delivery_tag=tag)
+        for hash, entries in files.items():
+            if hash not in missing:
+                for file_ref, treename in entries:
+                    publish_status_event(pending[0][0], hash, 'file', file=file_ref, treename=treename)
 
-def process_update_state(db, ch, method, properties, body):
+def process_update_state(db, ch, method, properties, body, early:Optional[EarlyEvents] = None):
     info = json.loads(body)
     hash = info['hash']
     new_phase = info['phase']
 
-    # Update state. Just silently ignore if this thing isn't there.
-    state = db.lookup_results(hash)
-    if state is not None:
-        new_state = ADLRequestInfo(done=state.done, files=state.files, jobs=state.jobs, phase=new_phase, hash=state.hash, log=state.log, message=state.message)
-        db.save_results(hash, new_state)
-    else:
-        print(f'Unable to find an entry for hash {hash} to update it to state {new_phase}.')
-
-    ch.basic_ack(delivery_tag=method.delivery_tag)
+    def apply() -> bool:
+        if not db.set_phase(hash, new_phase):
+            return False
+        publish_status_event(ch, hash, 'phase', properties.correlation_id, phase=new_phase)
+        return True
+    apply_or_hold(early, 'status_change_state', hash, apply, ch, method, f'updating it to state {new_phase}')
 
-def process_crashed(db, ch, method, properties, body):
+def process_crashed(db, ch, method, properties, body, early:Optional[EarlyEvents] = None):
     info = json.loads(body)
     hash = info['hash']
     message = info['message']
     log = info['log']
 
-    # Update state. Just silently ignore if this thing isn't there.
-    state = db.lookup_results(hash)
-    if state is not None:
-        new_state = ADLRequestInfo(done=True, files=state.files, jobs=state.jobs, phase=state.phase, hash=state.hash, log=log, message=message)
-        db.save_results(hash, new_state)
-    else:
-        print(f'Unable to find an entry for hash {hash} to update it to state {new_phase}.')
-
-    ch.basic_ack(delivery_tag=method.delivery_tag)
+    def apply() -> bool:
+        if not db.mark_crashed(hash, message, log):
+            return False
+        publish_status_event(ch, hash, 'crashed', properties.correlation_id, message=message)
+        return True
+    apply_or_hold(early, 'crashed_request', hash, apply, ch, method, f'marking it as crashed ({message})')
 
-def process_number_jobs(db, ch, method, properties, body):
+def process_number_jobs(db, ch, method, properties, body, early:Optional[EarlyEvents] = None):
     info = json.loads(body)
     hash = info['hash']
     new_n_jobs = info['njobs']
 
-    # Update state. Just silently ignore if this thing isn't there.
-    state = db.lookup_results(hash)
-    if state is not None:
-        new_state = ADLRequestInfo(done=state.done, files=state.files, jobs=new_n_jobs, phase=state.phase, hash=state.hash, log=state.log, message=state.message)
-        db.save_results(hash, new_state)
+    def apply() -> bool:
+        if not db.set_jobs(hash, new_n_jobs):
+            return False
+        publish_status_event(ch, hash, 'njobs', properties.correlation_id, njobs=new_n_jobs)
+        return True
+    apply_or_hold(early, 'status_number_jobs', hash, apply, ch, method, f'setting the number of jobs to {new_n_jobs}')
+
+class StatusUpdate:
+    'The phase, number of jobs and crash messages for one request, merged. The last of each to arrive wins.'
+    def __init__(self):
+        self.phase = None
+        self.njobs = None
+        self.crash = None
+        self.correlation_ids = {}
+        self.messages = []
+
+    def add(self, queue:str, ch, tag:int, properties, info:dict):
+        if queue == 'status_change_state':
+            self.phase = info['phase']
+            event = 'phase'
+        elif queue == 'status_number_jobs':
+            self.njobs = info['njobs']
+            event = 'njobs'
+        else:
+            self.crash = (info['message'], info['log'])
+            event = 'crashed'
+        self.correlation_ids[event] = getattr(properties, 'correlation_id', None)
+        self.messages.append((queue, ch, tag))
+
+    def what(self) -> str:
+        'What the update does, for the log'
+        parts = ([f'updating it to state {self.phase}'] if self.phase is not None else []) \
+            + ([f'setting the number of jobs to {self.njobs}'] if self.njobs is not None else []) \
+            + ([f'marking it as crashed ({self.crash[0]})'] if self.crash is not None else [])
+        return ', '.join(parts)
+
+class StatusCoalescer:
+    r'''
+    Merges the status_change_state, status_number_jobs and crashed_request messages for a request that come
+    in within window seconds of the first of them (or until max_items messages are waiting) into a single
+    write. The last phase and the last number of jobs to arrive are written, along with the crash if there
+    was one - a crash is never dropped in favour of a later phase, and the db still marks the request done
+    when the new number of jobs is met. All the merged messages are acked once the write has succeeded; if
+    it fails they are put back on the queue. Requests that aren't in the db yet are handed to early, if given.
+    '''
+    def __init__(self, db, connection, window:float, max_items:int = 100, early:Optional[EarlyEvents] = None):
+        self._db = db
+        self._connection = connection
+        self._window = window
+        self._max_items = max_items
+        self._early = early
+        self._pending: Dict[str, StatusUpdate] = {}
+        self._n_pending = 0
+        self._timer = None
+
+    def on_message(self, queue:str, ch, method, properties, body):
+        'Merge the message into the update for its request'
+        info = json.loads(body)
+        hash = info['hash']
+        if self._early is not None and self._early.holding(hash):
+            # Has to wait its turn behind the ones already held
+            update = StatusUpdate()
+            update.add(queue, ch, method.delivery_tag, properties, info)
+            apply_or_hold(self._early, queue, hash, partial(self._apply, hash, update), ch, method, update.what())
+            return
+        update = self._pending.setdefault(hash, StatusUpdate())
+        if len(update.messages) > 0:
+            UPDATES_COALESCED.inc(queue=queue)
+        update.add(queue, ch, method.delivery_tag, properties, info)
+        self._n_pending += 1
+        if self._n_pending >= self._max_items:
+            self.flush()
+        elif self._timer is None:
+            self._timer = self._connection.call_later(self._window, self._on_timer)
+
+    def _on_timer(self):
+        self._timer = None
+        self.flush()
+
+    def _apply(self, hash:str, update:StatusUpdate) -> bool:
+        'Write an update, in one write to the db. False if the request is not in the db.'
+        if update.crash is not None:
+            if not self._db.mark_crashed(hash, *update.crash, phase=update.phase, njobs=update.njobs):
+                return False
+        elif not self._db.update_status(hash, phase=update.phase, njobs=update.njobs):
+            return False
+
+        ch = update.messages[0][1]
+        if update.phase is not None:
+            publish_status_event(ch, hash, 'phase', update.correlation_ids['phase'], phase=update.phase)
+        if update.njobs is not None:
+            publish_status_event(ch, hash, 'njobs', update.correlation_ids['njobs'], njobs=update.njobs)
+        if update.crash is not None:
+            publish_status_event(ch, hash, 'crashed', update.correlation_ids['crashed'], message=update.crash[0])
+        return True
+
+    @staticmethod
+    def _ack(update:StatusUpdate):
+        for _, ch, tag in update.messages:
+            ch.basic_ack(delivery_tag=tag)
+
+    def flush(self):
+        'Write all the merged updates and ack their messages'
+        if self._timer is not None:
+            self._connection.remove_timeout(self._timer)
+            self._timer = None
+        pending, self._pending, self._n_pending = self._pending, {}, 0
+
+        for hash, update in pending.items():
+            if self._early is not None and self._early.holding(hash):
+                # Something else for this request turned up first and is waiting for it
+                self._early.hold(update.messages[0][0], hash, partial(self._apply, hash, update), partial(self._ack, update), update.what())
+                continue
+            try:
+                found = self._apply(hash, update)
+            except DB_ERRORS as e:
+                logging.error(f'Failed to update {hash} in the db ({e}). Returning {len(update.messages)} messages to the queue.')
+                for _, ch, tag in update.messages:
+                    ch.basic_nack(delivery_tag=tag, requeue=True)
+                continue
+            if found:
+                self._ack(update)
+            elif self._early is not None:
+                self._early.hold(update.messages[0][0], hash, partial(self._apply, hash, update), partial(self._ack, update), update.what())
+            else:
+                print(f'Unable to find an entry for hash {hash}. Ignoring {update.what()}.')
+                self._ack(update)
+
+def setup_consumers(connection, channel, db, batch_size:int = 0, batch_ms:float = 50, prefetch:int = 0, shard:Optional[int] = None,
+                    hold_max:int = 1000, hold_seconds:float = 60, coalesce_ms:float = 0):
+    r'''
+    Declare the status queues and attach the handlers to them.
+
+    Arguments:
+        connection          The connection to RabbitMQ
+        channel             The channel to consume on
+        db                  The db access object to update
+        batch_size          If larger than 1, status_add_file messages are written in batches of up to this many
+        batch_ms            The longest (milliseconds) a status_add_file message is held before its batch is written
+        prefetch            Most un-acked messages RabbitMQ will hand us at once (0 means no limit). When batching,
+                            this defaults to twice the batch size.
+        shard               If given, consume this worker's copies of the queues (see ShardRouter) rather
+                            than the queues themselves.
+        hold_max            Most messages to hold for requests that aren't in the db yet (see EarlyEvents).
+                            0 drops them straight away.
+        hold_seconds        How long to keep trying a held message before dropping it
+        coalesce_ms         If more than 0, the phase, number of jobs and crash messages for a request that
+                            come in within this many milliseconds are merged into one write (see StatusCoalescer)
+    '''
+    if batch_size > 1 and prefetch == 0:
+        prefetch = 2 * batch_size
+    if prefetch > 0:
+        channel.basic_qos(prefetch_count=prefetch)
+
+    # status_updates - where we tell everyone else (the web front ends) about changes we've made.
+    declare_status_exchange(channel)
+
+    def consume(queue:str, handler:Callable):
+        def timed_handler(ch, method, properties, body):
+            observe_queue_wait(queue, properties)
+            with HANDLER_SECONDS.time(queue=queue):
+                handler(ch, method, properties, body)
+        channel.queue_declare(queue=shard_queue(queue, shard))
+        channel.basic_consume(queue=shard_queue(queue, shard), on_message_callback=timed_handler, auto_ack=False)
+
+    # Updates that beat the ingester's save of their request wait here for it. Held messages are un-acked,
+    # so leave room under the prefetch limit for new ones.
+    if prefetch > 0:
+        hold_max = min(hold_max, prefetch // 2)
+    early = EarlyEvents(connection, max_events=hold_max, max_age=hold_seconds) if hold_max > 0 else None
+
+    # status_add_file - sent when a file is done and ready for someone downstream to use
+    if batch_size > 1:
+        batcher = AddFileBatcher(db, connection, batch_size, batch_ms / 1000.0, early=early)
+        consume('status_add_file', batcher.on_message)
+    else:
+        consume('status_add_file', lambda ch, method, properties, body: process_add_file(db, ch, method, properties, body, early))
+
+    if coalesce_ms > 0:
+        # status_change_state, status_number_jobs and crashed_request - merged into one write per request
+        coalescer = StatusCoalescer(db, connection, coalesce_ms / 1000.0, max_items=max(1, prefetch // 2) if prefetch > 0 else 100, early=early)
+        for queue in ('status_change_state', 'status_number_jobs', 'crashed_request'):
+            consume(queue, partial(coalescer.on_message, queue))
     else:
-        print(f'Unable to find an entry for hash {hash} to update it to state {new_phase}.')
+        # status_change_state - sent when the state needs to change for a particular job
+        consume('status_change_state', lambda ch, method, properties, body: process_update_state(db, ch, method, properties, body, early))
 
-    ch.basic_ack(delivery_tag=method.delivery_tag)
+        # status_n_jobs - The total number of jobs that are running to deal with this request needs to be updated.
+        consume('status_number_jobs', lambda ch, method, properties, body: process_number_jobs(db, ch, method, properties, body, early))
 
-def listen_to_queue(rabbit_node, mongo_db_server, rabbit_user, rabbit_pass):
+        # crashed_request - where things go that totally bomb out.
+        consume('crashed_request', lambda ch, method, properties, body: process_crashed(db, ch, method, properties, body, early))
+
+def route_of(queue:str, body:bytes, n_shards:int) -> str:
+    'The queue a status message goes to with n_shards workers (the status queue itself with just one)'
+    if n_shards <= 1:
+        return queue
+    try:
+        hash = json.loads(body)['hash']
+    except (ValueError, KeyError, TypeError):
+        # The worker will complain about it.
+        hash = ''
+    return shard_queue(queue, shard_of(hash, n_shards))
+
+class ShardRouter:
+    r'''
+    Spreads the status messages over several workers. Each message is moved from its status queue to one
+    worker's copy of that queue, picked by the request's hash, so all the updates for a request are made,
+    in the order they were sent, by one worker, while different requests are updated in parallel. The
+    router only reads the hash - it does not touch the db - so it can keep many workers busy.
+
+    The cost is that every message goes through the broker twice, and the router is a single consumer of
+    the status queues. Routing is much cheaper than an update, so it only becomes the limit with many
+    workers. The workers are threads of one process: they spend their time waiting on the db, which
+    they do in parallel, but CPU-bound work does not spread (run more updaters for that).
+    '''
+    def __init__(self, n_shards:int):
+        self._n_shards = n_shards
+
+    def on_message(self, queue:str, ch, method, properties, body):
+        'Pass a message on to the worker for its request'
+        ch.basic_publish(exchange='', routing_key=route_of(queue, body, self._n_shards), properties=properties, body=body)
+        MESSAGES_PUBLISHED.inc(queue=queue)
+        ch.basic_ack(delivery_tag=method.delivery_tag)
+
+def setup_router(channel, n_shards:int):
+    'Declare the status queues and every worker\'s copy of them, and route from the one to the others'
+    router = ShardRouter(n_shards)
+    for queue in STATUS_QUEUES:
+        channel.queue_declare(queue=queue)
+        for shard in range(n_shards):
+            channel.queue_declare(queue=shard_queue(queue, shard))
+        channel.basic_consume(queue=queue, on_message_callback=partial(router.on_message, queue), auto_ack=False)
+
+def drain_shards(connection, n_shards:int) -> int:
+    r'''
+    Move the messages left in the copies of the status queues of workers there no longer are (after
+    STATE_UPDATER_WORKERS was lowered) to the queues they go to now, and delete those copies. Run it before
+    routing anything, so the moved messages are not behind newer ones for the same request, and after the
+    queues they go to are declared.
+
+    Arguments:
+        connection          The connection to do it on. Each look for a queue is on a channel of its own,
+                            as the broker closes the channel when it is not there.
+        n_shards            The number of workers there are now
+
+    Returns:
+        The number of messages moved.
+    '''
+    # Workers are numbered from 0, so the first one with none of its queues left is past the last one.
+    moved = 0
+    shard = n_shards if n_shards > 1 else 0
+    while True:
+        found = False
+        for queue in STATUS_QUEUES:
+            name = shard_queue(queue, shard)
+            channel = connection.channel()
+            try:
+                channel.queue_declare(queue=name, passive=True)
+            except pika.exceptions.ChannelClosedByBroker:
+                continue
+            found = True
+            while True:
+                method, properties, body = channel.basic_get(queue=name)
+                if method is None:
+                    break
+                channel.basic_publish(exchange='', routing_key=route_of(queue, body, n_shards), properties=properties, body=body)
+                channel.basic_ack(delivery_tag=method.delivery_tag)
+                moved += 1
+            channel.queue_delete(queue=name, if_empty=True)
+            channel.close()
+            logging.warning(f'Moved the messages left in {name} (a worker that is no longer there) and deleted it.')
+        if not found:
+            return moved
+        shard += 1
+
+class ShardWorker(threading.Thread):
+    r'''
+    Updates the db from one worker's copy of the status queues. It has its own connection (they can't be
+    shared between threads) and so its own prefetch limit. The db access is shared - every backend is thread safe.
+    If it fails, on_failure is called - nothing else would pick up its requests, so the updater should stop.
+    '''
+    def __init__(self, shard:int, connection_factory:Callable, db, batch_size:int = 0, batch_ms:float = 50, prefetch:int = 0,
+                 hold_max:int = 1000, hold_seconds:float = 60, coalesce_ms:float = 0, on_failure:Optional[Callable] = None):
+        threading.Thread.__init__(self, name=f'state-updater-{shard}', daemon=True)
+        self._shard = shard
+        self._on_failure = on_failure
+        self._connection_factory = connection_factory
+        self._db = db
+        self._batch_size = batch_size
+        self._batch_ms = batch_ms
+        self._prefetch = prefetch
+        self._hold_max = hold_max
+        self._hold_seconds = hold_seconds
+        self._coalesce_ms = coalesce_ms
+
+    def run(self):
+        connection = None
+        try:
+            connection = self._connection_factory()
+            channel = connection.channel()
+            setup_consumers(connection, channel, self._db, batch_size=self._batch_size, batch_ms=self._batch_ms,
+                            prefetch=self._prefetch, shard=self._shard, hold_max=self._hold_max, hold_seconds=self._hold_seconds,
+                            coalesce_ms=self._coalesce_ms)
+            channel.start_consuming()
+        except Exception:
+            logging.exception(f'State updater worker {self._shard} failed.')
+            if connection is not None and connection.is_open:
+                # Anything it had not acked goes back on its queue
+                connection.close()
+            if self._on_failure is not None:
+                self._on_failure()
+
+def listen_to_queue(rabbit_node, mongo_db_server, rabbit_user, rabbit_pass, batch_size:int = 0, batch_ms:float = 50, prefetch:int = 0,
+                    workers:int = 1, hold_max:int = 1000, hold_seconds:float = 60, coalesce_ms:float = 0):
+    r'''
+    Update the db from the status queues, forever.
+
+    Arguments:
+        workers             If more than one, the updates are spread over this many worker threads by request
+                            hash (see ShardRouter). Each worker has its own prefetch limit. Workers have their own
+                            copies of the status queues (<queue>.<n>) - any left over from a run with more
+                            workers are moved back at startup (see drain_shards).
+        hold_max            Most messages each worker holds for requests that aren't in the db yet
+        hold_seconds        How long a held message is retried before it is dropped
+        coalesce_ms         Window to merge a request's phase, number of jobs and crash messages over
+    '''
     if rabbit_pass in os.environ:
         rabbit_pass = os.environ[rabbit_pass]
     credentials = pika.PlainCredentials(rabbit_user, rabbit_pass)
-    connection = pika.BlockingConnection(pika.ConnectionParameters(host=rabbit_node, credentials=credentials))
+    connection_factory = lambda: pika.BlockingConnection(pika.ConnectionParameters(host=rabbit_node, credentials=credentials))
+    connection = connection_factory()
     channel = connection.channel()
 
     # Open up the mongo db which we will be doing lots of updates to.
-    db = FuncADLDBAccess(mongo_db_server)
+    db = TimedDBAccess(open_db(mongo_db_server))
 
-    # status_add_file - sent when a file is done and ready for someone downstream to use
-    channel.queue_declare(queue='status_add_file')
-    channel.basic_consume(queue='status_add_file', on_message_callback=lambda ch, method, properties, body: process_add_file(db, ch, method, properties, body), auto_ack=False)
-
-    # status_change_state - sent when the state needs to change for a particular job
-    channel.queue_declare(queue='status_change_state')
-    channel.basic_consume(queue='status_change_state', on_message_callback=lambda ch, method, properties, body: process_update_state(db, ch, method, properties, body), auto_ack=False)
+    failed = threading.Event()
+    def on_failure():
+        # Stop the main loop, on its own thread, so the whole updater exits and gets restarted.
+        failed.set()
+        connection.add_callback_threadsafe(channel.stop_consuming)
 
-    # status_n_jobs - The total number of jobs that are running to deal with this request needs to be updated.
-    channel.queue_declare(queue='status_number_jobs')
-    channel.basic_consume(queue='status_number_jobs', on_message_callback=lambda ch, method, properties, body: process_number_jobs(db, ch, method, properties, body), auto_ack=False)
+    if workers > 1:
+        setup_router(channel, workers)
+        for shard in range(workers):
+            ShardWorker(shard, connection_factory, db, batch_size=batch_size, batch_ms=batch_ms, prefetch=prefetch,
+                        hold_max=hold_max, hold_seconds=hold_seconds, coalesce_ms=coalesce_ms, on_failure=on_failure).start()
+    else:
+        setup_consumers(connection, channel, db, batch_size=batch_size, batch_ms=batch_ms, prefetch=prefetch,
+                        hold_max=hold_max, hold_seconds=hold_seconds, coalesce_ms=coalesce_ms)
 
-    # crashed_request - where things go that totally bomb out.
-    channel.queue_declare(queue='crashed_request')
-    channel.basic_consume(queue='crashed_request', on_message_callback=lambda ch, method, properties, body: process_crashed(db, ch, method, properties, body), auto_ack=False)
+    # Anything left for workers that are no longer there (from a run with more of them) - now the queues it
+    # goes to are declared, but before the router takes anything newer.
+    drain_shards(connection, workers)
 
-    # We are setup. Off we go. We'll never come back.
+    # We are setup. Off we go. We only come back if a worker failed.
     channel.start_consuming()
+    connection.close()
+    if failed.is_set():
+        sys.exit(1)
 
 if __name__ == '__main__':
     logging.basicConfig(level=logging.INFO)
+    metrics_dump_from_env()
     bad_args = len(sys.argv) != 5
     if bad_args:
         print ("Usage: python state_updater.py <rabbit-mq-node-address> <mongo-db-server> <rabbit-user> <rabbit-pass>")
     else:
-        listen_to_queue (sys.argv[1], sys.argv[2], sys.argv[3], sys.argv[4])
\ No newline at end of file
+        # Batching of status_add_file writes is turned on by setting ADD_FILE_BATCH_SIZE larger than 1, and
+        # spreading the updates over several workers by setting STATE_UPDATER_WORKERS larger than 1. Updates
+        # for requests not in the db yet are held (up to STATUS_HOLD_MAX of them, for STATUS_HOLD_SECONDS).
+        # Setting STATUS_COALESCE_MS merges bursts of phase/number of jobs/crash messages into one write.
+        listen_to_queue (sys.argv[1], sys.argv[2], sys.argv[3], sys.argv[4],
+                         batch_size=int(os.environ.get('ADD_FILE_BATCH_SIZE', '0')),
+                         batch_ms=float(os.environ.get('ADD_FILE_BATCH_MS', '50')),
+                         prefetch=int(os.environ.get('STATE_UPDATER_PREFETCH', '0')),
+                         workers=int(os.environ.get('STATE_UPDATER_WORKERS', '1')),
+                         hold_max=int(os.environ.get('STATUS_HOLD_MAX', '1000')),
+                         hold_seconds=float(os.environ.get('STATUS_HOLD_SECONDS', '60')),
+                         coalesce_ms=float(os.environ.get('STATUS_COALESCE_MS', '0')))
\ No newline at end of file